@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+Warm agent running the scripts without their start up cost.
+
+`agent.py --vserver ... --username ... --password ...` imports pyVmomi and
+the scripts once, logs in, keeps the session alive (and with --mirror the
+local inventory mirror current) and listens on a UNIX socket. When it
+runs, create_clone.py, create_vm.py, destroy_vm.py, manage_snapshot.py,
+guestops.py and reconcile.py are thin clients: they send their arguments
+to it before importing anything heavy and print the output streamed back.
+Each invocation runs in a process forked from the agent, with the working
+directory and VSPHERE_* variables of the client.
+
+The socket is VSPHERE_AGENT_SOCKET (~/.vsphere-api/agent.sock by default),
+owner only. VSPHERE_AGENT=0 makes the scripts run on their own. The agent
+sends clients back to a local run when the scripts changed since it started.
+
+This module only imports the standard library until serve() is called.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+SOCKET_PATH = os.environ.get('VSPHERE_AGENT_SOCKET',
+                             os.path.join(os.path.expanduser('~'), '.vsphere-api', 'agent.sock'))
+
+# Scripts the agent runs for clients
+SCRIPTS = ['create_clone.py', 'create_vm.py', 'destroy_vm.py', 'manage_snapshot.py', 'guestops.py', 'reconcile.py']
+
+# Modules imported before serving, optional ones are skipped when missing
+PRELOAD = ['pyVmomi', 'session', 'inventory', 'mirror', 'tracing', 'taskwait', 'readiness', 'placement',
+           'bulk', 'journal', 'snapshots', 'guestops', 'create_clone', 'destroy_vm', 'manage_snapshot', 'reconcile',
+           'create_vm']
+
+# Seconds between two session keep alive calls
+KEEPALIVE = 300
+
+
+def enabled():
+    return os.environ.get('VSPHERE_AGENT', '1') not in ('0', 'no', 'false')
+
+
+# Frames: "<kind> <size>\n" then size bytes; O stdout, E stderr, X exit code, L run locally
+
+def _send(conn, kind, data=''):
+    conn.sendall('%s %d\n%s' % (kind, len(data), data))
+
+
+class _FrameWriter(object):
+    """File-like object sending what is written as frames of one kind."""
+
+    def __init__(self, conn, kind):
+        self.conn = conn
+        self.kind = kind
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data:
+            with self.lock:
+                _send(self.conn, self.kind, data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def delegate(script):
+    """Run the calling script in the agent when one listens, and exit with its code.
+
+    Return without doing anything when no agent is reachable (or it asks
+    for a local run), the script then goes on by itself.
+
+    :param script: __file__ of the script
+    """
+    if not enabled() or not os.path.exists(SOCKET_PATH):
+        return
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(SOCKET_PATH)
+    except socket.error:
+        conn.close()
+        return
+
+    request = dict(script=os.path.basename(script).replace('.pyc', '.py'), argv=sys.argv[1:], cwd=os.getcwd(),
+                   env=dict((k, v) for k, v in os.environ.items() if k.startswith('VSPHERE_')))
+    stream = conn.makefile('rb')
+    try:
+        conn.sendall(json.dumps(request) + '\n')
+        while True:
+            header = stream.readline()
+            if not header:
+                sys.exit("Agent connection closed before the end of %s" % request['script'])
+            kind, size = header.split()
+            data = stream.read(int(size))
+            if kind == 'O':
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            elif kind == 'E':
+                sys.stderr.write(data)
+                sys.stderr.flush()
+            elif kind == 'X':
+                sys.exit(int(data))
+            elif kind == 'L':
+                return
+    except KeyboardInterrupt:
+        # The agent side stops when the connection goes away
+        sys.exit(130)
+    finally:
+        stream.close()
+        conn.close()
+
+
+class Agent(object):
+    """Warm process forking one child per client request.
+
+    :param path: UNIX socket path
+    :param connection: dict vserver, username, password, port of the session kept alive
+    :param mirror: Keep the local inventory mirror of that vCenter current
+    """
+
+    def __init__(self, path, connection, mirror=False):
+        self.path = path
+        self.connection = connection
+        self.mirror = mirror
+        self.mtimes = self._mtimes()
+        self.si = None
+
+    def _mtimes(self):
+        mtimes = dict()
+        for name in os.listdir(REPO):
+            if name.endswith('.py'):
+                mtimes[name] = os.stat(os.path.join(REPO, name)).st_mtime
+        return mtimes
+
+    def preload(self):
+        for name in PRELOAD:
+            try:
+                __import__(name)
+            except ImportError, e:
+                print "Not preloaded %s: %s" % (name, e)
+
+    def connect(self):
+        import session
+        c = self.connection
+        self.si = session.connect(host=c['vserver'], user=c['username'], pwd=c['password'], port=int(c['port']))
+
+    def keepalive(self):
+        # Sessions expire when idle, clients would have to log in again
+        import session
+        from pyVmomi import vmodl
+        while True:
+            time.sleep(KEEPALIVE)
+            try:
+                self.si.CurrentTime()
+            except (vmodl.MethodFault, IOError), e:
+                print "Session lost (%s), logging in again" % e
+                session.logout(self.si)
+                try:
+                    self.connect()
+                except (vmodl.MethodFault, IOError), e:
+                    print "Login failed: %s" % e
+
+    def sync_mirror(self):
+        import mirror
+        from pyVmomi import vmodl
+        c = self.connection
+        if not os.path.isdir(mirror.MIRROR_DIR):
+            os.makedirs(mirror.MIRROR_DIR, 0700)
+        local = mirror.Mirror(mirror.mirror_path(c['vserver'], c['port']))
+        while True:
+            try:
+                mirror.sync(self.si, local)
+            except (vmodl.MethodFault, IOError), e:
+                print "Mirror sync stopped (%s), starting again" % e
+                time.sleep(10)
+
+    def _listen(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Socket owner only, it hands out the vCenter session
+        umask = os.umask(0077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(64)
+        return listener
+
+    def serve(self):
+        import signal
+        self.preload()
+        self.connect()
+        for target in [self.keepalive] + ([self.sync_mirror] if self.mirror else []):
+            thread = threading.Thread(target=target, name=target.__name__)
+            thread.daemon = True
+            thread.start()
+
+        listener = self._listen()
+        # Children are reaped by the system
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        print "Agent of %s listening on %s" % (self.connection['vserver'], self.path)
+        try:
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except socket.error, e:
+                    if e.errno == 4:
+                        continue  # EINTR
+                    raise
+                if self._mtimes() != self.mtimes:
+                    print "Scripts changed since the agent started, restart it"
+                    _send(conn, 'L')
+                    conn.close()
+                    continue
+                if os.fork() == 0:
+                    listener.close()
+                    self._child(conn)
+                conn.close()
+        finally:
+            listener.close()
+            os.remove(self.path)
+
+    def _child(self, conn):
+        # Never returns: the child exits once the script is done
+        import atexit
+        import runpy
+        import traceback
+        import session
+        import tracing
+
+        code = 1
+        try:
+            stream = conn.makefile('rb')
+            request = json.loads(stream.readline())
+            if request['script'] not in SCRIPTS:
+                raise ValueError("%s is not run by the agent" % request['script'])
+            os.chdir(request['cwd'])
+            os.environ.update(request['env'])
+            # The script runs here, it must not delegate again
+            os.environ['VSPHERE_AGENT'] = '0'
+            # Exit handlers of the agent (session logout, ...) are not the script's
+            del atexit._exithandlers[:]
+            tracing.reset()
+            session.after_fork()
+
+            # Stop when the client goes away (Ctrl-C)
+            def watch():
+                stream.read()
+                os._exit(130)
+            watcher = threading.Thread(target=watch)
+            watcher.daemon = True
+            watcher.start()
+
+            sys.stdout = _FrameWriter(conn, 'O')
+            sys.stderr = _FrameWriter(conn, 'E')
+            script = os.path.join(REPO, request['script'])
+            sys.argv = [script] + request['argv']
+            try:
+                runpy.run_path(script, run_name='__main__')
+                code = 0
+            except SystemExit, e:
+                if e.code is None:
+                    code = 0
+                elif isinstance(e.code, int):
+                    code = e.code
+                else:
+                    sys.stderr.write('%s\n' % e.code)
+            except BaseException:
+                traceback.print_exc()
+            # Exit handlers (trace report, ...) write before the exit frame
+            atexit._run_exitfuncs()
+            _send(conn, 'X', str(code))
+        except BaseException:
+            traceback.print_exc(file=sys.__stderr__)
+        finally:
+            os._exit(code)
+
+
+def main(**kwargs):
+    connection = dict((k, kwargs[k]) for k in ('vserver', 'username', 'password', 'port'))
+    Agent(kwargs['socket'], connection, kwargs['mirror']).serve()
+
+
+"""
+ Main program
+"""
+if __name__ == "__main__":
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser(description='Keep a logged in vCenter session and run the scripts for thin clients')
+    parser.add_argument('--vserver', type=str, help='fqdn or ip addr for the vcenter', required=True)
+    parser.add_argument('--username', type=str, help='Username to use for login into vcenter', required=True)
+    parser.add_argument('--password', type=str, help='Username password', required=True)
+    parser.add_argument('--port', type=int, help='port for vCenter', default=443)
+    parser.add_argument('--socket', type=str, help='UNIX socket the agent listens on', default=SOCKET_PATH)
+    parser.add_argument('--mirror', help='Also keep the local inventory mirror of the vCenter current', action='store_true')
+
+    # Parse arguments and hand off to main()
+    args = parser.parse_args()
+    try:
+        main(**vars(args))
+    except KeyboardInterrupt:
+        pass
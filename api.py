@@ -0,0 +1,610 @@
+#!/usr/bin/env python
+"""
+HTTP job API over the scripts.
+
+`api.py --listen 127.0.0.1:8080` runs clone(), create_vm(), destroy_vm()
+and the snapshot actions as jobs in one process: a POST queues a job and
+returns its id at once, a bounded pool of worker threads runs the jobs
+(at most --per-vcenter at once against one vCenter) over the sessions of
+session.py, shared by every job of the same vCenter.
+
+    POST   /jobs                 {"operation": "clone", "params": {...}}
+    GET    /jobs                 every job, ?status=running to filter
+    GET    /jobs/<id>            status, phase, result or error
+    GET    /jobs/<id>/output     printed output, ?offset=N&follow=1 streams it
+    DELETE /jobs/<id>            cancel a queued job
+
+Params are the command line arguments of the script, underscores instead
+of dashes. vserver, username, password and port default to the ones the
+service was started with, a job on another vCenter gives its own
+username and password. The phase of a job is the last span / phase of
+tracing.py its workflow went through (clone, network, clone_task, ...).
+
+Set VSPHERE_API_TOKEN (or --token) to require "Authorization: Bearer
+<token>" on every request.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import os
+import Queue
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import traceback
+import urlparse
+import uuid
+
+import session
+import tracing
+import bulk
+from bulk import KeyedSemaphore
+
+# Worker threads running jobs
+WORKERS = 16
+
+# Jobs waiting for a worker before new ones are refused
+MAX_QUEUED = 1000
+
+# Seconds a finished job is kept
+JOB_TTL = 3600
+
+# Output lines kept per job, the oldest are dropped beyond
+MAX_OUTPUT_LINES = 10000
+
+# Seconds a name index is shared by the jobs of one vCenter
+INVENTORY_TTL = 30
+
+CONNECTION = ('vserver', 'username', 'password', 'port')
+
+# Params of each operation not in CONNECTION, with the defaults of the command line
+OPERATIONS = dict(
+    clone=dict(required=['hostname', 'vlans'],
+               defaults=dict(template='Centos7-x86', cpus=1, mem=1, domain='prod.dmd', datacenter='MyDC',
+                             cluster='prod', datastore='svc1_esx_poc-55', dns=['192.168.139.1'],
+                             disks=['0'], bootstrap_file=None, customization='bootstrap', ips=None, gateway=None,
+                             host=None, placement=False, datastore_pattern=None, resource_pool=None,
+                             linked_clone=False, linked_snapshot=None, linked_fallback='full',
+                             max_chain_depth=None)),
+    create_vm=dict(required=['name', 'memory', 'sockets', 'cores', 'vlan'],
+                   defaults=dict(datastore=None, cluster=None, placement=False)),
+    destroy=dict(required=['vmname'],
+                 defaults=dict(datacenter='MYDC', max_inflight=None)),
+    snapshot=dict(required=[],
+                  defaults=dict(vmname=[], match=None, action='create', snapshot=['mysnapshot'], recursive='no',
+                                parallel=None, datacenter=None, folder=None, max_age=None, keep=None,
+                                pattern=None, dry_run=False, per_datastore=2)),
+)
+
+# Params taking a list, a string is split on spaces
+LISTS = ('vlans', 'disks', 'dns', 'ips', 'vmname', 'snapshot')
+
+_context = threading.local()
+_inventories = dict()
+_inventories_lock = threading.Lock()
+
+
+class BadRequest(Exception):
+    """Raised when a job can not be created from a request."""
+
+
+class QueueFull(Exception):
+    """Raised when MAX_QUEUED jobs already wait for a worker."""
+
+
+class JobFailed(Exception):
+    """Raised by an operation ending in error, its output tells why."""
+
+
+"""
+ Operations, run in a worker thread with the job as context
+"""
+def _connect(params):
+    return session.connect(host=params['vserver'], user=params['username'], pwd=params['password'],
+                           port=int(params['port']))
+
+
+def _inventory(si):
+    # Name index of a vCenter shared by its jobs, rebuilt (with the mirror state) when old
+    from inventory import Inventory
+    import mirror
+    key = session.endpoint(si)
+    with _inventories_lock:
+        entry = _inventories.get(key)
+        if entry is None or time.time() - entry[0] > INVENTORY_TTL:
+            entry = (time.time(), Inventory(si, ttl=INVENTORY_TTL, mirror=mirror.open_for(si)))
+            _inventories[key] = entry
+        return entry[1]
+
+
+def _clone(params):
+    import create_clone
+    deploy_settings = create_clone.build_deploy_settings(**params)
+    si = _connect(params)
+    inventory = _inventory(si)
+    if deploy_settings['placement']:
+        create_clone.place_vms(si, inventory, [deploy_settings])
+    report = dict()
+    exit_code = create_clone.clone(deploy_settings, list(deploy_settings['vlans']), si=si, inventory=inventory,
+                                   report=report)
+    if exit_code:
+        raise JobFailed("clone exit code %s" % exit_code)
+    return dict(vm=report['vm']._moId, mode=report.get('mode'), fallback=report.get('fallback'),
+                chains=report.get('chains'))
+
+
+def _create_vm(params):
+    import create_vm
+    import journal
+    try:
+        vm = create_vm.provision(_connect(params), params['name'], params['memory'], params['sockets'],
+                                 params['cores'], params['vlan'], datastore=params['datastore'],
+                                 cluster=params['cluster'], placement=params['placement'])
+    except journal.SettingsChanged, e:
+        raise JobFailed(str(e))
+    return dict(vm=vm._moId)
+
+
+def _destroy(params):
+    import destroy_vm
+    if not destroy_vm.destroy_vm(**params):
+        raise JobFailed("Not every VM was destroyed")
+
+
+def _check_snapshot(params):
+    if params['action'] == 'prune':
+        if params['max_age'] is None and params['keep'] is None:
+            raise BadRequest("prune needs max_age and/or keep")
+    elif not params['vmname'] and not params['match']:
+        raise BadRequest("vmname or match is required")
+
+
+def _snapshot(params):
+    import manage_snapshot
+    if not manage_snapshot.main(**params):
+        raise JobFailed("Snapshot %s failed" % params['action'])
+
+
+RUNNERS = dict(clone=_clone, create_vm=_create_vm, destroy=_destroy, snapshot=_snapshot)
+
+# Checks of params across several of them, before the job is queued
+CHECKS = dict(snapshot=_check_snapshot)
+
+
+"""
+ Jobs and the output of their threads
+"""
+class Job(object):
+    """One operation run by a worker, with its printed output."""
+
+    def __init__(self, operation, params):
+        self.id = uuid.uuid4().hex
+        self.operation = operation
+        self.params = params
+        self.status = 'queued'
+        self.phase = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.lines = []
+        self.dropped = 0
+        self.partial = ''
+        self.changed = threading.Condition()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with self.changed:
+            data = self.partial + data
+            lines = data.split('\n')
+            self.partial = lines.pop()
+            self.lines.extend(line + '\n' for line in lines)
+            if len(self.lines) > MAX_OUTPUT_LINES:
+                extra = len(self.lines) - MAX_OUTPUT_LINES
+                del self.lines[:extra]
+                self.dropped += extra
+            self.changed.notify_all()
+
+    def start(self):
+        """Mark the job running, False when it was cancelled meanwhile."""
+        with self.changed:
+            if self.status != 'queued':
+                return False
+            self.status = 'running'
+            self.started = time.time()
+            self.changed.notify_all()
+            return True
+
+    def finish(self, status, result=None, error=None):
+        with self.changed:
+            if self.partial:
+                self.lines.append(self.partial + '\n')
+                self.partial = ''
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished = time.time()
+            # Credentials are not kept once used
+            self.params.pop('password', None)
+            self.changed.notify_all()
+
+    def done(self):
+        return self.status in ('succeeded', 'failed', 'cancelled')
+
+    def read(self, offset, timeout=None):
+        """Output lines from offset, waiting up to timeout for new ones.
+
+        :return: (lines, next offset, job done)
+        """
+        with self.changed:
+            end = self.dropped + len(self.lines)
+            if timeout and offset >= end and not self.done():
+                self.changed.wait(timeout)
+                end = self.dropped + len(self.lines)
+            lines = self.lines[max(0, offset - self.dropped):]
+            return lines, end, self.done()
+
+    def summary(self):
+        with self.changed:
+            return dict(id=self.id, operation=self.operation, status=self.status, phase=self.phase,
+                        result=self.result, error=self.error, created=self.created, started=self.started,
+                        finished=self.finished, output_lines=self.dropped + len(self.lines),
+                        params=dict((k, v) for k, v in self.params.items() if k != 'password'))
+
+
+class _JobOutput(object):
+    """sys.stdout / sys.stderr writing to the job of the current thread."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    # print state of each thread, a shared one adds spaces to other threads lines
+    softspace = property(lambda self: getattr(self.local, 'softspace', 0),
+                         lambda self, value: setattr(self.local, 'softspace', value))
+
+    def write(self, data):
+        job = getattr(_context, 'job', None)
+        if job is None:
+            self.stream.write(data)
+        else:
+            job.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if getattr(_context, 'job', None) is None:
+            self.stream.flush()
+
+    def isatty(self):
+        return False
+
+
+def _on_phase(name):
+    job = getattr(_context, 'job', None)
+    if job is not None:
+        job.phase = name
+
+
+def _job_context():
+    # Run by a job thread starting bulk.py workers, the workers belong to its job
+    job = getattr(_context, 'job', None)
+
+    def enter():
+        _context.job = job
+    return enter
+
+
+def _route_output():
+    """Send what jobs print to their output, bulk.py workers they start included."""
+    if isinstance(sys.stdout, _JobOutput):
+        return
+    sys.stdout = _JobOutput(sys.stdout)
+    sys.stderr = _JobOutput(sys.stderr)
+    tracing.listeners.append(_on_phase)
+    bulk.contexts.append(_job_context)
+
+
+class JobService(object):
+    """Queue of jobs run by a bounded pool of worker threads.
+
+    :param connection: dict vserver, username, password, port used when a job gives none
+    :param workers: Number of jobs running at once
+    :param per_vcenter: Max number of jobs running at once against one vCenter, 0 for no limit
+    :param max_queued: Number of jobs waiting for a worker before submit() refuses new ones
+    """
+
+    def __init__(self, connection=None, workers=WORKERS, per_vcenter=0, max_queued=MAX_QUEUED):
+        self.connection = dict((k, v) for k, v in (connection or dict()).items() if v is not None)
+        self.workers = workers
+        self.per_vcenter = KeyedSemaphore(per_vcenter) if per_vcenter else None
+        self.max_queued = max_queued
+        self.jobs = dict()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='job-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def params(self, operation, params):
+        """Operation params completed with defaults, checked against what the script takes."""
+        if operation not in OPERATIONS:
+            raise BadRequest("Unknown operation %s, one of %s" % (operation, ', '.join(sorted(OPERATIONS))))
+        if not isinstance(params, dict):
+            raise BadRequest("params must be an object")
+        spec = OPERATIONS[operation]
+        unknown = set(params) - set(spec['defaults']) - set(spec['required']) - set(CONNECTION)
+        if unknown:
+            raise BadRequest("Unknown params of %s: %s" % (operation, ', '.join(sorted(unknown))))
+        complete = dict(port=443)
+        # The service credentials are only used on its own vCenter, by jobs
+        # naming no user: a job giving a user (or a vCenter) gives its password
+        complete.update((key, value) for key, value in self.connection.items() if key in ('vserver', 'port'))
+        own = [key for key in ('username', 'password') if params.get(key) not in (None, '')]
+        if not own and params.get('vserver') in (None, '', self.connection.get('vserver')):
+            complete.update(self.connection)
+        complete.update(spec['defaults'])
+        complete.update(params)
+        missing = [k for k in list(CONNECTION) + spec['required'] if complete.get(k) in (None, '', [])]
+        if missing:
+            raise BadRequest("Missing params of %s: %s" % (operation, ', '.join(missing)))
+        for key in LISTS:
+            if isinstance(complete.get(key), basestring):
+                complete[key] = complete[key].split()
+        if operation in CHECKS:
+            CHECKS[operation](complete)
+        return complete
+
+    def submit(self, operation, params):
+        params = self.params(operation, params)
+        with self.lock:
+            self._expire()
+            if len([j for j in self.jobs.values() if j.status == 'queued']) >= self.max_queued:
+                raise QueueFull("%d jobs already queued" % self.max_queued)
+            job = Job(operation, params)
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self, status=None):
+        with self.lock:
+            self._expire()
+            jobs = sorted(self.jobs.values(), key=lambda j: j.created)
+        return [j for j in jobs if status is None or j.status == status]
+
+    def cancel(self, job_id):
+        """Cancel a queued job, a running one goes on (its vCenter tasks would anyway).
+
+        :return: True when the job will not run
+        """
+        job = self.get(job_id)
+        with job.changed:
+            if job.status != 'queued':
+                return job.status == 'cancelled'
+            job.finish('cancelled')
+            return True
+
+    def _expire(self):
+        now = time.time()
+        for job_id, job in self.jobs.items():
+            if job.done() and now - job.finished > JOB_TTL:
+                del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job.status != 'queued':
+                continue
+            vcenter = job.params['vserver']
+            if self.per_vcenter is not None:
+                self.per_vcenter.acquire(vcenter)
+            try:
+                self._run(job)
+            finally:
+                if self.per_vcenter is not None:
+                    self.per_vcenter.release(vcenter)
+
+    def _run(self, job):
+        if not job.start():
+            return
+        _context.job = job
+        try:
+            result = RUNNERS[job.operation](dict(job.params))
+            job.finish('succeeded', result)
+        except SystemExit, e:
+            # The scripts exit with their error message
+            job.finish('failed', error=str(e.code) if e.code not in (None, 0) else 'exited')
+        except JobFailed, e:
+            job.finish('failed', error=str(e))
+        except BaseException, e:
+            traceback.print_exc()
+            job.finish('failed', error=getattr(e, 'msg', None) or str(e) or e.__class__.__name__)
+        finally:
+            _context.job = None
+
+
+"""
+ HTTP front end
+"""
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # The JobService is self.server.service
+
+    server_version = 'vsphere-api'
+
+    def _reply(self, code, body):
+        data = json.dumps(body, indent=2, sort_keys=True) + '\n'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        # (path parts, query dict) once authorized, None when a reply was sent
+        token = self.server.token
+        if token and self.headers.get('Authorization') != 'Bearer ' + token:
+            self._reply(401, dict(error='Unauthorized'))
+            return None
+        url = urlparse.urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        query = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).items())
+        if not parts or parts[0] != 'jobs' or len(parts) > 3 or (len(parts) == 3 and parts[2] != 'output'):
+            self._reply(404, dict(error='Not found'))
+            return None
+        if len(parts) > 1 and self.server.service.get(parts[1]) is None:
+            self._reply(404, dict(error='No job %s' % parts[1]))
+            return None
+        return parts, query
+
+    def do_GET(self):
+        route = self._route()
+        if route is None:
+            return
+        parts, query = route
+        service = self.server.service
+        if len(parts) == 1:
+            self._reply(200, [j.summary() for j in service.list(query.get('status'))])
+        elif len(parts) == 2:
+            self._reply(200, service.get(parts[1]).summary())
+        else:
+            try:
+                offset = int(query.get('offset', 0))
+            except ValueError:
+                return self._reply(400, dict(error='offset must be a number'))
+            self._output(service.get(parts[1]), offset, query.get('follow') in ('1', 'true', 'yes'))
+
+    def _output(self, job, offset, follow):
+        # Without follow the next offset is in X-Next-Offset, with it the
+        # response goes on until the job is done
+        lines, end, done = job.read(offset)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('X-Job-Status', job.status)
+        if not follow:
+            data = ''.join(lines)
+            self.send_header('X-Next-Offset', str(end))
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            while True:
+                self.wfile.write(''.join(lines))
+                self.wfile.flush()
+                if done:
+                    return
+                lines, end, done = job.read(end, timeout=1)
+        except socket.error:
+            # Client went away, the job goes on
+            pass
+
+    def do_POST(self):
+        route = self._route()
+        if route is None:
+            return
+        parts, _ = route
+        if len(parts) != 1:
+            return self._reply(405, dict(error='POST only on /jobs'))
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or '{}')
+            if not isinstance(request, dict):
+                raise ValueError("not an object")
+        except ValueError, e:
+            return self._reply(400, dict(error='Invalid JSON: %s' % e))
+        try:
+            job = self.server.service.submit(request.get('operation'), request.get('params') or dict())
+        except BadRequest, e:
+            return self._reply(400, dict(error=str(e)))
+        except QueueFull, e:
+            return self._reply(503, dict(error=str(e)))
+        self._reply(202, job.summary())
+
+    def do_DELETE(self):
+        route = self._route()
+        if route is None:
+            return
+        parts, _ = route
+        if len(parts) != 2:
+            return self._reply(405, dict(error='DELETE only on /jobs/<id>'))
+        service = self.server.service
+        if not service.cancel(parts[1]):
+            return self._reply(409, dict(error='Job already %s' % service.get(parts[1]).status))
+        self._reply(200, service.get(parts[1]).summary())
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(service, address, token=None):
+    """Run the job service behind an HTTP server until interrupted.
+
+    :param address: (host, port) to listen on
+    """
+    # Imported once here rather than by the first job of each kind
+    for name in ('create_clone', 'create_vm', 'destroy_vm', 'manage_snapshot'):
+        try:
+            __import__(name)
+        except ImportError, e:
+            print "Not loaded %s: %s" % (name, e)
+
+    _route_output()
+    service.start()
+    server = _Server(address, _Handler)
+    server.service = service
+    server.token = token
+    print "Job API listening on http://%s:%d/jobs" % server.server_address
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main(**kwargs):
+    host, _, port = kwargs['listen'].rpartition(':')
+    connection = dict((k, kwargs[k]) for k in CONNECTION)
+    service = JobService(connection, workers=kwargs['workers'], per_vcenter=kwargs['per_vcenter'],
+                         max_queued=kwargs['max_queued'])
+    serve(service, (host or '127.0.0.1', int(port)), token=kwargs['token'])
+
+
+"""
+ Main program
+"""
+if __name__ == "__main__":
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser(description='Run clone, create, destroy and snapshot operations as HTTP jobs')
+    parser.add_argument('--listen', type=str, help='host:port the API listens on', default='127.0.0.1:8080')
+    parser.add_argument('--vserver', type=str, help='fqdn or ip addr of the vcenter of jobs not giving one')
+    parser.add_argument('--username', type=str, help='Username to use for login into vcenter, for jobs not giving one')
+    parser.add_argument('--password', type=str, help='Username password, for jobs not giving one')
+    parser.add_argument('--port', type=int, help='port for vCenter', default=443)
+    parser.add_argument('--workers', type=int, help='Max number of jobs running at once', default=WORKERS)
+    parser.add_argument('--per-vcenter', type=int, help='Max number of jobs running at once against one vCenter, 0 for no limit', default=0)
+    parser.add_argument('--max-queued', type=int, help='Max number of jobs waiting for a worker', default=MAX_QUEUED)
+    parser.add_argument('--token', type=str, help='Bearer token required on requests (default VSPHERE_API_TOKEN)',
+                        default=os.environ.get('VSPHERE_API_TOKEN'))
+
+    # Parse arguments and hand off to main()
+    args = parser.parse_args()
+    try:
+        main(**vars(args))
+    except KeyboardInterrupt:
+        pass
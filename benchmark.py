@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""
+Benchmark the scripts against the in-process vCenter simulator (vcsim.py).
+
+Each scenario runs in its own process on a fresh simulated inventory and
+records wall time, SOAP round trips (total, per VM, top methods) and peak
+memory. Results are appended to a JSON lines file and compared with the
+previous run of the same scenario and scale, so regressions are visible.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import session
+from vcsim import Simulator, TASK_LATENCY, RTT
+
+SCENARIOS = ['clone', 'linked_clone', 'create_vm', 'destroy', 'snapshot_create', 'snapshot_list', 'snapshot_delete',
+             'reconcile']
+
+SCALES = [1, 10, 1000]
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+CONNECTION = dict(vserver='vcsim', username='sim', password='sim', port=443)
+
+
+class Skip(Exception):
+    """Raised when a scenario cannot run in this environment."""
+
+
+def _names(sim):
+    return sorted(sim.get(vm, 'name') for vm in sim.vms())
+
+
+def setup_clone(sim, scale):
+    manifest = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    json.dump(dict(vms=[dict(hostname='bench-%05d' % i, vlans=['vlan-1', 'vlan-2'], disks=[10, 20])
+                        for i in range(scale)]), manifest)
+    manifest.close()
+    return manifest.name
+
+
+def _bulk_clone(manifest, **options):
+    import create_clone
+    kwargs = dict(CONNECTION, hostname=None, vlans=None, template='Centos7-x86', cpus=1, mem=1,
+                  domain='bench.local', datacenter='MyDC', cluster='prod', datastore='svc1_esx_poc-55',
+                  dns='192.168.139.1', disks=['0'], manifest=manifest, parallel=8, per_datastore=0,
+                  per_host=0, bootstrap_file=os.path.join(REPO, 'vm-bootstrap.bash'))
+    kwargs.update(options)
+    try:
+        create_clone.bulk_clone(**kwargs)
+    finally:
+        os.remove(manifest)
+
+
+def run_clone(sim, scale, manifest):
+    _bulk_clone(manifest)
+
+
+def setup_linked_clone(sim, scale):
+    import create_clone
+    sim.add_snapshots(sim.template, [create_clone.LINKED_SNAPSHOT])
+    return setup_clone(sim, scale)
+
+
+def run_linked_clone(sim, scale, manifest):
+    _bulk_clone(manifest, linked_clone=True, linked_fallback='fail')
+
+
+def setup_create_vm(sim, scale):
+    content = sim.si.RetrieveContent()
+    datacenter = content.rootFolder.childEntity[0]
+    return datacenter.vmFolder, datacenter.hostFolder.childEntity[0].resourcePool
+
+
+def run_create_vm(sim, scale, placement):
+    try:
+        import create_vm
+    except ImportError, e:
+        # create_vm.py needs tools.cli from pyvmomi-community-samples
+        raise Skip(str(e))
+    vm_folder, resource_pool = placement
+    for i in range(scale):
+        create_vm.create_vm('bench-%05d' % i, sim.si, vm_folder, resource_pool,
+                            'svc1_esx_poc-55', 1024, 1, 1, 'vlan-1')
+
+
+def run_destroy(sim, scale, names):
+    import destroy_vm
+    destroy_vm.destroy_vm(vmname=names, datacenter='MyDC', max_inflight=20, **CONNECTION)
+
+
+def _snapshot_kwargs(names, action):
+    return dict(CONNECTION, vmname=names, action=action, snapshot=['bench'], recursive='no',
+                match=None, parallel=8, per_datastore=2)
+
+
+def run_snapshot_create(sim, scale, names):
+    import manage_snapshot
+    manage_snapshot.main(**_snapshot_kwargs(names, 'create'))
+
+
+def setup_snapshots(sim, scale):
+    for vm in sim.vms():
+        sim.add_snapshots(vm, ['base', 'bench', 'after'])
+    return _names(sim)
+
+
+def run_snapshot_list(sim, scale, names):
+    import manage_snapshot
+    manage_snapshot.main(**_snapshot_kwargs(names, 'list'))
+
+
+def run_snapshot_delete(sim, scale, names):
+    import manage_snapshot
+    manage_snapshot.main(**_snapshot_kwargs(names, 'delete'))
+
+
+def setup_reconcile(sim, scale):
+    datacenter = sim.si.RetrieveContent().rootFolder.childEntity[0]
+    datacenter.vmFolder.CreateFolder('bench')
+    return setup_clone(sim, scale)
+
+
+def run_reconcile(sim, scale, manifest):
+    # Plan and apply, then plan again: a converged folder has nothing left to do
+    import reconcile
+    from pyVmomi import vim
+    from inventory import Inventory
+    kwargs = dict(CONNECTION, hostname=None, vlans=None, manifest=manifest, datacenter='MyDC', folder='bench',
+                  recursive=False, prune=False, yes=False, dry_run=False, parallel=8, per_datastore=0,
+                  template='Centos7-x86', cpus=1, mem=1, domain='bench.local', cluster='prod',
+                  datastore='svc1_esx_poc-55', dns=['192.168.139.1'], disks=['0'], placement=False,
+                  bootstrap_file=os.path.join(REPO, 'vm-bootstrap.bash'))
+    try:
+        if reconcile.main(**kwargs):
+            raise RuntimeError("reconcile failed")
+        inventory = Inventory(sim.si)
+        root = inventory.get(vim.Folder, 'bench')
+        desired = reconcile.desired_state(kwargs)
+        steps, _, _ = reconcile.plan(desired, reconcile.actual_state(sim.si, root, False),
+                                     reconcile.template_disks(sim.si, inventory, desired))
+        if steps:
+            raise RuntimeError("second plan not empty: %s" % ', '.join(
+                '%s %s' % (step['name'], step['action']) for step in steps))
+    finally:
+        os.remove(manifest)
+
+
+# scenario -> (inventory VMs, setup, run); setup returns the run argument
+PLANS = dict(
+    clone=(lambda scale: 10, setup_clone, run_clone),
+    linked_clone=(lambda scale: 10, setup_linked_clone, run_linked_clone),
+    create_vm=(lambda scale: 10, setup_create_vm, run_create_vm),
+    destroy=(lambda scale: scale, lambda sim, scale: _names(sim), run_destroy),
+    snapshot_create=(lambda scale: scale, lambda sim, scale: _names(sim), run_snapshot_create),
+    snapshot_list=(lambda scale: scale, setup_snapshots, run_snapshot_list),
+    snapshot_delete=(lambda scale: scale, setup_snapshots, run_snapshot_delete),
+    reconcile=(lambda scale: 10, setup_reconcile, run_reconcile),
+)
+
+
+def run_scenario(scenario, scale, task_latency, rtt):
+    """Run one scenario on a fresh simulator, return its measures."""
+    inventory_size, setup, run = PLANS[scenario]
+    datacenter = 'FARMAN' if scenario == 'create_vm' else 'MyDC'
+    sim = Simulator(vms=inventory_size(scale), datacenter=datacenter, task_latency=task_latency, rtt=rtt)
+    session.register(CONNECTION['vserver'], CONNECTION['username'], sim.si, CONNECTION['port'],
+                     CONNECTION['password'])
+    arg = setup(sim, scale)
+    sim.stub.reset_calls()
+
+    result = dict(scenario=scenario, scale=scale, status='ok', error=None)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        run(sim, scale, arg)
+    except Skip, e:
+        result.update(status='skipped', error=str(e))
+    except BaseException, e:
+        result.update(status='failed', error='%s: %s' % (e.__class__.__name__, e))
+    finally:
+        wall = time.time() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    round_trips = sim.stub.round_trips()
+    result.update(wall_seconds=round(wall, 3), round_trips=round_trips,
+                  round_trips_per_vm=round(float(round_trips) / scale, 1),
+                  top_calls=dict(sim.stub.calls.most_common(10)),
+                  peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    return result
+
+
+def _child(queue, scenario, scale, task_latency, rtt):
+    try:
+        queue.put(run_scenario(scenario, scale, task_latency, rtt))
+    except BaseException, e:
+        queue.put(dict(scenario=scenario, scale=scale, status='failed', error=str(e)))
+
+
+def _previous(path, scenario, scale):
+    last = None
+    if os.path.exists(path):
+        with open(path, 'r') as results:
+            for line in results:
+                row = json.loads(line)
+                if row['scenario'] == scenario and row['scale'] == scale and row['status'] == 'ok':
+                    last = row
+    return last
+
+
+def _delta(new, old):
+    if not old:
+        return '-'
+    return '%+.0f%%' % (100.0 * (new - old) / old)
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(**kwargs):
+    commit = _commit()
+    print "%-16s %6s %-8s %9s %8s %7s %9s %7s %7s" % (
+        'SCENARIO', 'SCALE', 'STATUS', 'WALL(s)', 'RT', 'RT/VM', 'PEAK(MB)', 'dWALL', 'dRT')
+    for scenario in kwargs['scenarios']:
+        for scale in kwargs['scales']:
+            # One process per run so peak memory is the scenario's own
+            queue = multiprocessing.Queue()
+            child = multiprocessing.Process(target=_child, args=(queue, scenario, scale,
+                                                                 kwargs['task_latency'], kwargs['rtt']))
+            child.start()
+            result = queue.get()
+            child.join()
+
+            result.update(date=time.strftime('%Y-%m-%dT%H:%M:%S'), commit=commit,
+                          task_latency=kwargs['task_latency'], rtt=kwargs['rtt'])
+            previous = _previous(kwargs['results'], scenario, scale)
+            if result['status'] == 'ok':
+                print "%-16s %6d %-8s %9.2f %8d %7.1f %9.1f %7s %7s" % (
+                    scenario, scale, 'ok', result['wall_seconds'], result['round_trips'],
+                    result['round_trips_per_vm'], result['peak_rss_kb'] / 1024.0,
+                    _delta(result['wall_seconds'], previous and previous['wall_seconds']),
+                    _delta(result['round_trips'], previous and previous['round_trips']))
+            else:
+                print "%-16s %6d %-8s %s" % (scenario, scale, result['status'], result['error'])
+
+            with open(kwargs['results'], 'a') as results:
+                results.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+"""
+ Main program
+"""
+if __name__ == "__main__":
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark the scripts against a simulated vCenter')
+    parser.add_argument('--scenarios', type=str, help='Scenarios to run', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--scales', type=int, help='Number of VMs handled by each scenario', nargs='+', default=SCALES)
+    parser.add_argument('--task-latency', type=float, help='Seconds each simulated task runs', default=TASK_LATENCY)
+    parser.add_argument('--rtt', type=float, help='Seconds added to each simulated SOAP call', default=RTT)
+    parser.add_argument('--results', type=str, help='JSON lines file results are appended to', default='bench-results.jsonl')
+
+    # Parse arguments and hand off to main()
+    args = parser.parse_args()
+    main(**vars(args))
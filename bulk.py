@@ -0,0 +1,207 @@
+"""
+Helpers to run one workflow over many VMs concurrently.
+
+run_parallel() runs a worker over a list of items on a bounded pool of
+threads, with optional extra caps per key (datastore, host, ...), and
+returns one result dict per item in input order. run_graph() does the
+same for items depending on other items, and run_stages() for the stages
+of a single workflow.
+"""
+
+import sys
+import threading
+import time
+import traceback
+import Queue
+
+import tracing
+
+# Number of workflows running at the same time when not specified
+DEFAULT_PARALLEL = 8
+
+# Callables run by the thread starting workers, each returns a callable the
+# workers run first to take over its context (e.g. the job of api.py)
+contexts = []
+
+
+class KeyedSemaphore(object):
+    """Bounded semaphore created on demand for each key."""
+
+    def __init__(self, size):
+        self.size = size
+        self._semaphores = dict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            sem = self._semaphores.get(key)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.size)
+                self._semaphores[key] = sem
+            return sem
+
+    def acquire(self, key):
+        self._get(key).acquire()
+
+    def release(self, key):
+        self._get(key).release()
+
+
+def _run_one(item, worker, limits):
+    # Always take per-key slots in the same order to avoid deadlocks
+    held = []
+    for key_fn, sem in limits:
+        key = key_fn(item)
+        if key is not None:
+            sem.acquire(key)
+            held.append((sem, key))
+
+    start = time.time()
+    res = dict(item=item, status='ok', result=None, error=None)
+    try:
+        res['result'] = worker(item)
+    except BaseException, e:
+        res['status'] = 'failed'
+        res['error'] = getattr(e, 'msg', None) or str(e) or e.__class__.__name__
+        res['traceback'] = traceback.format_exc()
+    finally:
+        for sem, key in reversed(held):
+            sem.release(key)
+    res['seconds'] = round(time.time() - start, 1)
+    return res
+
+
+def _start(run, count):
+    enters = [context() for context in contexts]
+
+    def run_in_context():
+        for enter in enters:
+            enter()
+        run()
+
+    threads = []
+    for i in range(max(1, count)):
+        t = threading.Thread(target=run_in_context, name='bulk-%d' % i)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        # join() without timeout ignores KeyboardInterrupt on python 2
+        while t.is_alive():
+            t.join(1)
+
+
+def run_parallel(items, worker, parallel=DEFAULT_PARALLEL, limits=None):
+    """Run worker(item) for every item, at most parallel at once.
+
+    :param items: List of items handed to worker
+    :param worker: Callable taking one item, its return value is kept as result
+    :param parallel: Global number of concurrent workers
+    :param limits: List of (key_function, cap), at most cap items sharing the
+                   same key_function(item) run at once. A None key is not limited.
+    :return: List of dict (item, status, result, error, seconds) in items order
+    """
+    limits = [(key_fn, KeyedSemaphore(cap)) for key_fn, cap in (limits or []) if cap]
+    results = [None] * len(items)
+    jobs = Queue.Queue()
+    for index, item in enumerate(items):
+        jobs.put((index, item))
+
+    def run():
+        while True:
+            try:
+                index, item = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            results[index] = _run_one(item, worker, limits)
+
+    _start(run, min(parallel, len(items)))
+    return results
+
+
+def run_graph(items, worker, requires, parallel=DEFAULT_PARALLEL, limits=None):
+    """Run worker(item) for every item once the items it requires are done.
+
+    Items run in list order as soon as their requirements succeeded; an
+    item whose requirement failed or was skipped is skipped.
+
+    :param requires: Callable giving the indexes of the items an item
+                     requires, always lower than its own index
+    :return: List of dict (item, status, result, error, seconds) in items order,
+             status is ok, failed or skipped
+    """
+    limits = [(key_fn, KeyedSemaphore(cap)) for key_fn, cap in (limits or []) if cap]
+    results = [None] * len(items)
+    required = [list(requires(item)) for item in items]
+    pending = range(len(items))
+    done = threading.Condition()
+
+    def next_job():
+        with done:
+            while pending:
+                for position, index in enumerate(pending):
+                    if all(results[r] is not None for r in required[index]):
+                        del pending[position]
+                        return index
+                done.wait(1)
+        return None
+
+    def run():
+        while True:
+            index = next_job()
+            if index is None:
+                return
+            failed = [r for r in required[index] if results[r]['status'] != 'ok']
+            if failed:
+                res = dict(item=items[index], status='skipped', result=None, seconds=0.0,
+                           error='requires %s' % results[failed[0]]['status'])
+            else:
+                res = _run_one(items[index], worker, limits)
+            with done:
+                results[index] = res
+                done.notify_all()
+
+    _start(run, min(parallel, len(items)))
+    return results
+
+
+def run_stages(stages):
+    """Run the stages of one workflow, each as soon as the stages it requires are done.
+
+    Stages independent of each other run at the same time, the workflow
+    takes the time of its longest chain of stages instead of their sum.
+
+    :param stages: List of (name, function, names of the stages required), a stage
+                   after the ones it requires. function(results) gets the dict
+                   stage name -> return value of the stages done.
+    :return: dict stage name -> return value of its function
+    :raise: The exception of the first stage failing, once the stages started have ended;
+            the stages requiring it are not run
+    """
+    positions = dict((stage[0], i) for i, stage in enumerate(stages))
+    results = dict()
+    errors = []
+    parent = tracing.current()
+
+    def worker(stage):
+        name, function, _ = stage
+        try:
+            with tracing.span(name, parent):
+                results[name] = function(results)
+        except BaseException:
+            errors.append(sys.exc_info())
+            raise
+
+    run_graph(stages, worker, lambda stage: [positions[name] for name in stage[2]], parallel=len(stages))
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def print_summary(results, label):
+    """Print one line per item, label(item) gives its name."""
+    failed = [r for r in results if r['status'] != 'ok']
+    print "%-40s %-8s %8s  %s" % ('NAME', 'STATUS', 'SECONDS', 'ERROR')
+    for r in results:
+        print "%-40s %-8s %8.1f  %s" % (label(r['item']), r['status'], r['seconds'], r['error'] or '')
+    print "%d ok, %d failed" % (len(results) - len(failed), len(failed))
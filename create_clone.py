@@ -12,244 +12,588 @@ pyvmomi==5.5.0
 wsgiref==0.1.2
 """
 
+if __name__ == "__main__":
+    # Thin client of the warm agent when one listens (agent.py)
+    import agent
+    agent.delegate(__file__)
+
 import requests
-from pyVim.connect import SmartConnect, Disconnect
+import session
 from pyVmomi import vim, vmodl
-import atexit
 import os
 import sys
 from pprint import pprint, pformat
-import time
-from netaddr import IPNetwork, IPAddress
+import json
+from netaddr import IPNetwork, IPAddress, AddrFormatError
 import argparse
 import getpass
+import threading
+import time
 from copy import deepcopy
-from tools import tasks
+from throttle import run_task
+from inventory import Inventory, retrieve_objects
+from readiness import wait_for_guest, wait_for_process, wait_for_customization, CustomizationFailed
+from snapshots import SnapshotIndex
+from placement import Placement, NoCandidate, GB, MB
+import guestops
+import journal
+import mirror
+import tracing
+from bulk import run_parallel, run_stages, print_summary, DEFAULT_PARALLEL
 
 # Disable certicat check
 requests.packages.urllib3.disable_warnings()
 
+# Bootstrap script uploaded into the new VM
+BOOTSTRAP_FILE = '/scripts/vmware/vm-bootstrap.bash'
+
+# Post boot script of VMs configured by a customization spec (salt install only)
+SALT_FILE = '/scripts/vmware/vm-salt.bash'
+
+# Template snapshot whose disks linked clones are based on
+LINKED_SNAPSHOT = 'linked-clone-base'
+
+# Max number of files in the disk chain of a linked clone
+MAX_CHAIN_DEPTH = 8
+
+# Settings the cloned VM is made from, an interrupted clone is only resumed with the same ones
+JOURNAL_SETTINGS = ['template_name', 'cpus', 'mem', 'disks', 'vlans', 'domain', 'customization', 'ips', 'gateway',
+                    'dns', 'linked']
+
+# Seconds a template found unfit for linked clones is remembered
+LINKED_RETRY = 60
+
+_linked_bases = dict()
+_linked_lock = threading.Lock()
+
 """
- Waits and provides updates on a vSphere task
+ Connect to vCenter server
 """
-def WaitTask(task, actionName='job', hideResult=False):
-    #print 'Waiting for %s to complete.' % actionName
-    
-    while task.info.state == vim.TaskInfo.State.running:
-       time.sleep(2)
-    
-    if task.info.state == vim.TaskInfo.State.success:
-       if task.info.result is not None and not hideResult:
-          out = '%s completed successfully, result: %s' % (actionName, task.info.result)
-       else:
-          out = '%s completed successfully.' % actionName
+def connect(deploy_settings):
+    try:
+        si = session.connect(host=deploy_settings["vserver"], user=deploy_settings["username"], pwd=deploy_settings["password"], port=int(deploy_settings["port"]))
+    except IOError, e:
+        sys.exit("Unable to connect to vsphere server. Error message: %s" % e)
+        
+    # Session is cached for next runs, so no logout at exit
+
+    return si
+
+"""
+ Build device changes creating additional disks during the clone
+ Controller and unit numbers are derived once from the template devices
+"""
+def disks_device_change(template_devices, disks):
+    changes = []
+
+    # Get controller SCSI 0
+    controller = None
+    for device in template_devices:
+        if isinstance(device, vim.vm.device.VirtualSCSIController) and device.busNumber == 0:
+            controller = device
+
+    if controller is None:
+        # Template without SCSI controller, add one in the same spec
+        lsi = vim.vm.device.VirtualDeviceSpec()
+        lsi.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
+        lsi.device = vim.vm.device.VirtualLsiLogicController()
+        lsi.device.key = -200
+        lsi.device.busNumber = 0
+        lsi.device.sharedBus = vim.vm.device.VirtualSCSIController.Sharing.noSharing
+        changes.append(lsi)
+        controller = lsi.device
+        used_units = set()
     else:
-       out = '%s did not complete successfully: %s' % (actionName, task.info.error)
-       print out
-       raise task.info.error # should be a Fault... check XXX
-    
-    # may not always be applicable, but can't hurt.
-    return task.info.result
+        used_units = set(d.unitNumber for d in template_devices if d.controllerKey == controller.key)
+
+    # Unit 7 is the SCSI controller itself
+    used_units.add(7)
+    unit_number = 0
+
+    for key, size in enumerate(disks):
+        if int(size) <= 0:
+            continue
+
+        while unit_number in used_units:
+            unit_number += 1
+        if unit_number > 15:
+            raise ValueError("No free unit number left on SCSI controller 0")
+        used_units.add(unit_number)
+
+        # Define the disk
+        disk = vim.vm.device.VirtualDisk()
+        disk.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo()
+        disk.backing.diskMode = 'persistent'
+        disk.backing.thinProvisioned = False
+        #disk.backing.eagerlyScrub = True
+        disk.backing.eagerlyScrub = False
+        # No file name, the VMDK is created in the VM directory
+        disk.backing.fileName = ''
+
+        disk.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+        disk.connectable.startConnected = True
+        disk.connectable.allowGuestControl = False
+        disk.connectable.connected = True
+
+        disk.key = -100 - key
+        disk.controllerKey = controller.key # id of scsi controller
+        disk.unitNumber = unit_number
+        disk.capacityInKB = int(size) * 1024 * 1024 # Size in arg is in GB
+
+        # Create disk's spec
+        device_spec = vim.vm.device.VirtualDeviceSpec()
+        device_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
+        device_spec.fileOperation = vim.vm.device.VirtualDeviceSpec.FileOperation.create
+        device_spec.device = disk
+        changes.append(device_spec)
+
+    return changes
 
 """
- Get the vsphere object associated with a given text name
+ Build the customization spec applied by the clone task: hostname, static
+ IP/prefix of each NIC (DHCP without IPs), gateway and DNS servers
+ The gateway goes on the NIC whose network contains it, the first one otherwise
 """
-def get_obj(content, vimtype, name):
-    obj = None
-    container = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
-    for c in container.view:
-        if c.name == name:
-            obj = c
-            break
-    return obj
+def customization_spec(deploy_settings, vlans_settings):
+    ident = vim.vm.customization.LinuxPrep()
+    ident.hostName = vim.vm.customization.FixedName(name=deploy_settings["new_vm_name"])
+    ident.domain = deploy_settings["domain"]
+    ident.hwClockUTC = True
+
+    globalip = vim.vm.customization.GlobalIPSettings()
+    globalip.dnsServerList = deploy_settings["dns"]
+    globalip.dnsSuffixList = [deploy_settings["domain"]]
+
+    networks = [IPNetwork(ip) for ip in deploy_settings["ips"]]
+    gateway_nic = 0
+    if deploy_settings.get("gateway"):
+        for key, network in enumerate(networks):
+            if IPAddress(deploy_settings["gateway"]) in network:
+                gateway_nic = key
+                break
+
+    adaptermaps = []
+    for key, vlan in enumerate(vlans_settings):
+        guest_map = vim.vm.customization.AdapterMapping()
+        guest_map.adapter = vim.vm.customization.IPSettings()
+        if networks:
+            guest_map.adapter.ip = vim.vm.customization.FixedIp(ipAddress=str(networks[key].ip))
+            guest_map.adapter.subnetMask = str(networks[key].netmask)
+            if deploy_settings.get("gateway") and key == gateway_nic:
+                guest_map.adapter.gateway = [deploy_settings["gateway"]]
+        else:
+            guest_map.adapter.ip = vim.vm.customization.DhcpIpGenerator()
+        adaptermaps.append(guest_map)
+
+    customspec = vim.vm.customization.Specification()
+    customspec.identity = ident
+    customspec.globalIPSettings = globalip
+    customspec.nicSettingMap = adaptermaps
+    return customspec
 
+"""
+ Backing chain of each disk of a device list, from the disk file to its base
+"""
+def backing_chains(devices):
+    chains = dict()
+    for device in devices:
+        if isinstance(device, vim.vm.device.VirtualDisk):
+            chain = []
+            backing = device.backing
+            while backing is not None:
+                chain.append(backing.fileName)
+                backing = getattr(backing, 'parent', None)
+            chains[device.deviceInfo.label] = chain
+    return chains
+
+"""
+ Find or create the template snapshot linked clones are based on
+ Return (snapshot, None), or (None, reason) when a linked clone is not possible
+ Concurrent clones share the result of a template and cluster, a cached
+ snapshot is checked to still exist, a failure is retried after LINKED_RETRY
+"""
+def linked_clone_base(si, template_vm, cluster, deploy_settings):
+    snapshot_name = deploy_settings['linked_snapshot']
+    key = (template_vm._moId, cluster._moId, snapshot_name)
+    content = si.RetrieveContent()
+    with _linked_lock:
+        cached = _linked_bases.get(key)
+        if cached is not None:
+            snapshot, reason, found_at = cached
+            if snapshot is None and time.time() - found_at < LINKED_RETRY:
+                return snapshot, reason
+            if snapshot is not None:
+                try:
+                    if retrieve_objects(content, [snapshot], ['vm']):
+                        return snapshot, reason
+                except vmodl.fault.ManagedObjectNotFound:
+                    pass
+                # Removed since, looked up or made again
+            del _linked_bases[key]
+
+        template = retrieve_objects(content, [template_vm], ['config.template', 'datastore', 'snapshot'])[template_vm]
+        visible = retrieve_objects(content, [cluster], ['datastore'])[cluster].get('datastore') or []
+
+        base, reason = None, None
+        hidden = [ds for ds in template.get('datastore') or [] if ds not in visible]
+        info = template.get('snapshot')
+        index = SnapshotIndex(template_vm, info.rootSnapshotList if info else None,
+                              info.currentSnapshot if info else None)
+        found = sorted(index.find(snapshot_name), key=lambda snap: snap.created)
+
+        if hidden:
+            # Delta disks need their base disks on a datastore the hosts see
+            reason = "template disks on datastores not visible from the cluster"
+        elif found:
+            base = found[-1]
+        elif template.get('config.template'):
+            reason = "no snapshot %s on template and a template can not be snapshotted" % snapshot_name
+        else:
+            print "Creating snapshot {} on {}...".format(snapshot_name, template_vm.name)
+            try:
+                run_task(si, lambda: template_vm.CreateSnapshot(snapshot_name, "Base of linked clones", False, False),
+                         'Linked clone base snapshot', datastore=(template.get('datastore') or [None])[0],
+                         idempotent=False)
+                base = SnapshotIndex.fetch(si, template_vm).find(snapshot_name)[-1]
+            except vmodl.MethodFault, e:
+                reason = "unable to snapshot template: %s" % (e.msg or e.__class__.__name__)
+
+        # A snapshot at depth d sits on d + 1 files, the clone adds its delta
+        if base is not None and base.depth + 2 > deploy_settings['max_chain_depth']:
+            base, reason = None, "disk chain of %d files is over %d" % (base.depth + 2, deploy_settings['max_chain_depth'])
+
+        _linked_bases[key] = (base.snapshot if base else None, reason, time.time())
+        return _linked_bases[key][:2]
+
+"""
+ Choose host and datastore of VMs from the load of their cluster, as one batch
+ pinned gives for each VM the settings to keep ('host', 'datastore')
+"""
+def place_vms(si, inventory, settings_list, pinned=None):
+    content = si.RetrieveContent()
+    placements = dict()
+    template_sizes = dict()
+    for position, deploy_settings in enumerate(settings_list):
+        keep = pinned[position] if pinned else ()
+        key = (deploy_settings['cluster'], deploy_settings.get('datastore_pattern'))
+        if key not in placements:
+            cluster = inventory.get(vim.ClusterComputeResource, deploy_settings['cluster'])
+            if not inventory.verify([(cluster, deploy_settings['cluster'])]):
+                cluster = inventory.get(vim.ClusterComputeResource, deploy_settings['cluster'])
+            if cluster is None:
+                sys.exit("Cluster %s not found" % deploy_settings['cluster'])
+            placements[key] = Placement(si, cluster, deploy_settings.get('datastore_pattern'))
+
+        # Full clones copy the template disks, linked clones only add deltas
+        size = 0
+        if not deploy_settings.get('linked'):
+            template_name = deploy_settings['template_name']
+            if template_name not in template_sizes:
+                template_vm = inventory.get(vim.VirtualMachine, template_name)
+                if not inventory.verify([(template_vm, template_name)]):
+                    template_vm = inventory.get(vim.VirtualMachine, template_name)
+                if template_vm is None:
+                    sys.exit("Template %s not found" % template_name)
+                storage = retrieve_objects(content, [template_vm], ['summary.storage.committed'])[template_vm]
+                template_sizes[template_name] = storage.get('summary.storage.committed') or 0
+            size = template_sizes[template_name]
+        # Additional disks and the swap file
+        size += sum(int(disk) for disk in deploy_settings['disks']) * GB + deploy_settings['mem'] * MB
+
+        try:
+            host, datastore = placements[key].place(
+                size, deploy_settings['cpus'], deploy_settings['mem'],
+                host=deploy_settings.get('host') if 'host' in keep else None,
+                datastore=deploy_settings['datastore'] if 'datastore' in keep else None)
+        except NoCandidate, e:
+            sys.exit("Unable to place %s: %s" % (deploy_settings['new_vm_name'], e))
+        deploy_settings['host'] = host
+        deploy_settings['datastore'] = datastore
+        print "{} placed on {} / {}".format(deploy_settings['new_vm_name'], host, datastore)
+
+    for placement in placements.values():
+        placement.print_summary()
+    return placements
 
 """
  Connect to vCenter server and deploy a VM from template
+ si and inventory can be given to share them between several clones
+ report (dict) is filled with the new VM, its clone mode and disk backing chains
+ folder (vim.Folder) receives the new VM, the VM folder of the datacenter by default
 """
-def clone(deploy_settings, vlans_settings):
+@tracing.traced('clone')
+def clone(deploy_settings, vlans_settings, si=None, inventory=None, report=None, folder=None):
     fqdn = "%s.%s" % (deploy_settings["new_vm_name"],deploy_settings["domain"])
 
     # connect to vCenter server
-    try:
-        si = SmartConnect(host=deploy_settings["vserver"], user=deploy_settings["username"], pwd=deploy_settings["password"], port=int(deploy_settings["port"]))
-    except IOError, e:
-        sys.exit("Unable to connect to vsphere server. Error message: %s" % e)
-        
-    # add a clean up routine
-    atexit.register(Disconnect, si)
+    if si is None:
+        si = connect(deploy_settings)
     
     content = si.RetrieveContent()
 
-    # get the vSphere objects associated with the human-friendly labels we supply
-    datacenter = get_obj(content, [vim.Datacenter], deploy_settings["datacenter"])
-    
-    # get the folder where VMs are kept for this datacenter
-    destfolder = datacenter.vmFolder
+    # Index every object type we need in one PropertyCollector pass
+    tracing.phase('inventory')
+    if inventory is None:
+        inventory = Inventory(si, mirror=mirror.open_for(si))
+    inventory.prefetch([vim.Datacenter, vim.ClusterComputeResource, vim.Datastore,
+                        vim.VirtualMachine, vim.dvs.DistributedVirtualPortgroup])
 
-    # Create datastore path
-    datastore_path = '[' + deploy_settings["datastore"] + '] ' + deploy_settings["new_vm_name"]
-    
-    cluster = get_obj(content, [vim.ClusterComputeResource], deploy_settings["cluster"])
-    resource_pool = cluster.resourcePool # use same root resource pool that my desired cluster uses
-    datastore = get_obj(content, [vim.Datastore], deploy_settings["datastore"])
-    template_vm = get_obj(content, [vim.VirtualMachine], deploy_settings["template_name"])
+    # get the vSphere objects associated with the human-friendly labels we supply
+    datacenter = inventory.get(vim.Datacenter, deploy_settings["datacenter"])
+    cluster = inventory.get(vim.ClusterComputeResource, deploy_settings["cluster"])
+    resource_pool = None
+    if deploy_settings.get('resource_pool'):
+        resource_pool = inventory.get(vim.ResourcePool, deploy_settings['resource_pool'])
+    datastore = inventory.get(vim.Datastore, deploy_settings["datastore"])
+    template_vm = inventory.get(vim.VirtualMachine, deploy_settings["template_name"])
 
     # Relocation spec
     relospec = vim.vm.RelocateSpec()
     relospec.datastore = datastore
+    if deploy_settings.get('host'):
+        relospec.host = inventory.get(vim.HostSystem, deploy_settings['host'])
+    portgroups = [inventory.get(vim.dvs.DistributedVirtualPortgroup, vlan) for vlan in vlans_settings]
+
+    # Objects read from the local mirror are checked before being used,
+    # everything is looked up again in vCenter if one is gone or renamed
+    found = [(datacenter, deploy_settings["datacenter"]), (cluster, deploy_settings["cluster"]),
+             (datastore, deploy_settings["datastore"]), (template_vm, deploy_settings["template_name"])]
+    found.extend(zip(portgroups, vlans_settings))
+    if deploy_settings.get('resource_pool'):
+        found.append((resource_pool, deploy_settings['resource_pool']))
+    if deploy_settings.get('host'):
+        found.append((relospec.host, deploy_settings['host']))
+    if not inventory.verify(found):
+        print "Local inventory mirror is out of date, looking up {} again".format(deploy_settings["new_vm_name"])
+        return clone(deploy_settings, vlans_settings, si=si, inventory=inventory, report=report, folder=folder)
+
+    # Properties read from vCenter, only once the objects are known to be there
+
+    # get the folder where VMs are kept for this datacenter
+    destfolder = folder or datacenter.vmFolder
+
+    if resource_pool is None:
+        resource_pool = cluster.resourcePool # use same root resource pool that my desired cluster uses
     relospec.pool = resource_pool
 
+    # Steps done by an interrupted run for this VM are reused (journal.py)
+    try:
+        run = journal.begin(si, 'clone', deploy_settings["new_vm_name"],
+                            dict((k, deploy_settings.get(k)) for k in JOURNAL_SETTINGS))
+    except journal.SettingsChanged, e:
+        print e
+        return -1
+
     '''
-     Networking config for VM
+     Stages of the clone, each started as soon as the ones it requires are done:
+     NIC, disk and linked base lookups run together, the disk backing chains
+     are read while the guest boots
     '''
-    devices = [] 
-    adaptermaps = []
-
-    
-    # create a Network device for each VLANs
-    for key, ip in enumerate(vlans_settings):
-
-        nic = vim.vm.device.VirtualDeviceSpec()
-        nic.operation = vim.vm.device.VirtualDeviceSpec.Operation.add  # or edit if a device exists
-        nic.device = vim.vm.device.VirtualVmxnet3()
-        nic.device.wakeOnLanEnabled = True
-        nic.device.addressType = 'assigned'
-        nic.device.key = 4000  # 4000 seems to be the value to use for a vmxnet3 device
-        nic.device.deviceInfo = vim.Description()
-        nic.device.deviceInfo.label = "Network Adapter %s" % key
-        nic.device.deviceInfo.summary = vlans_settings[key]
-        
-        # Connect virtual adapter 
-        nic.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-        nic.device.connectable.startConnected = True
-        nic.device.connectable.allowGuestControl = True
-
-        # Get distributed virtual portgroup obj
-        pg = get_obj(content, [vim.dvs.DistributedVirtualPortgroup], vlans_settings[key])
-
-        # Get connection information about connection between DVS and PorGroup
-        dvs_port_connection = vim.dvs.PortConnection()
-        dvs_port_connection.portgroupKey= pg.key
-        dvs_port_connection.switchUuid= pg.config.distributedVirtualSwitch.uuid
-        nic.device.backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
-        nic.device.backing.port = dvs_port_connection    
-        
-        # Add NIC spec to the device    
-        devices.append(nic)
-
-    
-    # VM config spec
-    vmconf = vim.vm.ConfigSpec()
-    vmconf.numCPUs = deploy_settings['cpus']
-    vmconf.memoryMB = deploy_settings['mem']
-    vmconf.cpuHotAddEnabled = True
-    vmconf.memoryHotAddEnabled = True
-    vmconf.deviceChange = devices
-
-    # Clone spec
-    clonespec = vim.vm.CloneSpec()
-    clonespec.location = relospec
-    clonespec.config = vmconf
-    clonespec.powerOn = True
-    clonespec.template = False
-
-    # Launch the clone task
-    print "Creating VM {}...".format(deploy_settings["new_vm_name"])
-    task = template_vm.Clone(folder=destfolder, name=deploy_settings["new_vm_name"], spec=clonespec)
-    result = WaitTask(task, 'VM clone task')
-
-    # Once clone is created, we create additionals disks
-
-    for key, size in enumerate(deploy_settings['disks']):
-        if int(size) > 0:
-            
-            # Create VMDK file
-            disk_filename = datastore_path + '/' + deploy_settings["new_vm_name"] + '-' + str(key + 1) + '.vmdk'
-            capacity_kb = int(size) * 1024 * 1024 # Size in arg is in GB 
-
-            disk_manager = content.virtualDiskManager
-
-            disk_spec = vim.VirtualDiskManager.FileBackedVirtualDiskSpec()
-            #disk_spec.diskType = 'eagerZeroedThick'
-            disk_spec.diskType = 'preallocated'
-            disk_spec.adapterType = 'lsiLogic'
-            disk_spec.capacityKb = capacity_kb
-
-            # VMDK Creation 
-            print "Creating VMDK {}...".format(disk_filename)
-            task2 = disk_manager.CreateVirtualDisk(disk_filename, datacenter, disk_spec)
-            tasks.wait_for_tasks(si, [task2])
-
-            # Connect additionals disks  to the VM
-
-            # Get the newly created VM
-            vmxfile = datastore_path + '/' + deploy_settings["new_vm_name"] + '.vmx'
-            search = content.searchIndex
-            vm = search.FindByDatastorePath(datacenter, vmxfile)
-
-            # Get controller SCSI  
-            controller = None
-            devices = vm.config.hardware.device
-            for device in devices:
-                if 'SCSI controller 0' in device.deviceInfo.label:
-                    controller = device
-
-            # Define the disk
-            disk = vim.vm.device.VirtualDisk()
-            disk.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo()
-            disk.backing.diskMode = 'persistent'
-            disk.backing.thinProvisioned = False
-            #disk.backing.eagerlyScrub = True
-            disk.backing.eagerlyScrub = False
-            disk.backing.fileName = disk_filename
-
-            disk.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-            disk.connectable.startConnected = True
-            disk.connectable.allowGuestControl = False
-            disk.connectable.connected = True
-
-            disk.key = -100
-            disk.controllerKey = controller.key # id of scsi controller
-            disk.unitNumber = len(controller.device) # number of SCSI device
-            
-            
-            # Create disk's spec
-            device_spec = vim.vm.device.VirtualDiskSpec()
-            device_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
-            device_spec.device = disk
-
-            spec = vim.vm.ConfigSpec()
-            spec.deviceChange = [device_spec]
-
-            # Reconfigure VM 
-            task3 = vm.ReconfigVM_Task(spec)
-            tasks.wait_for_tasks(si, [task3])
+    def network(results):
+        devices = []
+
+        # Keys of the portgroups and uuids of their switches, in two calls for every NIC
+        pg_props = retrieve_objects(content, portgroups, ['key', 'config.distributedVirtualSwitch'])
+        switches = list(set(props['config.distributedVirtualSwitch'] for props in pg_props.values()))
+        switch_props = retrieve_objects(content, switches, ['uuid'])
+
+        # create a Network device for each VLANs
+        for key, ip in enumerate(vlans_settings):
+
+            nic = vim.vm.device.VirtualDeviceSpec()
+            nic.operation = vim.vm.device.VirtualDeviceSpec.Operation.add  # or edit if a device exists
+            nic.device = vim.vm.device.VirtualVmxnet3()
+            nic.device.wakeOnLanEnabled = True
+            nic.device.addressType = 'assigned'
+            nic.device.key = 4000  # 4000 seems to be the value to use for a vmxnet3 device
+            nic.device.deviceInfo = vim.Description()
+            nic.device.deviceInfo.label = "Network Adapter %s" % key
+            nic.device.deviceInfo.summary = vlans_settings[key]
+
+            # Connect virtual adapter 
+            nic.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+            nic.device.connectable.startConnected = True
+            nic.device.connectable.allowGuestControl = True
+
+            # Get distributed virtual portgroup obj
+            pg = portgroups[key]
+
+            # Get connection information about connection between DVS and PorGroup
+            dvs_port_connection = vim.dvs.PortConnection()
+            dvs_port_connection.portgroupKey= pg_props[pg]['key']
+            dvs_port_connection.switchUuid= switch_props[pg_props[pg]['config.distributedVirtualSwitch']]['uuid']
+            nic.device.backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
+            nic.device.backing.port = dvs_port_connection    
+
+            # Add NIC spec to the device    
+            devices.append(nic)
+        return devices
+
+    def disks(results):
+        # Additional disks are created by the clone task itself, on the
+        # template's SCSI controller 0 (template layout read in one call)
+        template_devices = retrieve_objects(content, [template_vm], ['config.hardware.device'])[template_vm]
+        return disks_device_change(template_devices['config.hardware.device'], deploy_settings['disks'])
+
+    # Linked clone: new delta disks over a template snapshot, nothing is copied
+    clone_report = dict(mode='full', fallback=None, chains=dict())
+
+    def linked_base(results):
+        base, reason = linked_clone_base(si, template_vm, cluster, deploy_settings)
+        if base is not None:
+            clone_report['mode'] = 'linked'
+        elif deploy_settings['linked_fallback'] == 'fail':
+            sys.exit("Linked clone of %s not possible: %s" % (deploy_settings["new_vm_name"], reason))
+        else:
+            print "Linked clone not possible ({}), falling back to a full clone".format(reason)
+            clone_report['fallback'] = reason
+        return base
+
+    def clone_task(results):
+        # VM config spec
+        vmconf = vim.vm.ConfigSpec()
+        vmconf.numCPUs = deploy_settings['cpus']
+        vmconf.memoryMB = deploy_settings['mem']
+        vmconf.cpuHotAddEnabled = True
+        vmconf.memoryHotAddEnabled = True
+        vmconf.deviceChange = results['network'] + results['disks']
+
+        # Clone spec
+        clonespec = vim.vm.CloneSpec()
+        clonespec.location = relospec
+        clonespec.config = vmconf
+        clonespec.powerOn = True
+        clonespec.template = False
+
+        # Guest network and hostname set by the clone task itself, no bootstrap reboot
+        if deploy_settings.get('customization') == 'spec':
+            clonespec.customization = customization_spec(deploy_settings, vlans_settings)
+
+        if results.get('linked_base') is not None:
+            relospec.diskMoveType = 'createNewChildDiskBacking'
+            clonespec.snapshot = results['linked_base']
+
+        def start():
+            task = template_vm.Clone(folder=destfolder, name=deploy_settings["new_vm_name"], spec=clonespec)
+            # Recorded before waiting, a rerun waits for this task or adopts its VM.
+            # The task is kept as a moId: vCenter forgets tasks, not the VM
+            run.record('clone_submitted', task=task._moId, folder=destfolder, datastore=deploy_settings["datastore"],
+                       mode=clone_report['mode'], fallback=clone_report['fallback'])
+            return task
+
+        # Launch the clone task
+        print "Creating VM {}...".format(deploy_settings["new_vm_name"])
+        # Started when vCenter, host and datastore have room, retried when throttled
+        vm = run_task(si, start, 'VM clone task', host=relospec.host, datastore=datastore, idempotent=False)
+        run.record('clone', vm=vm, datastore=deploy_settings["datastore"], mode=clone_report['mode'],
+                   fallback=clone_report['fallback'])
+        print "VM {} is created.".format(deploy_settings["new_vm_name"])
+        return vm
+
+    # Interrupted while the clone task ran: wait for the task, or take the VM
+    # it made once vCenter forgot it, clone again only when it failed
+    def adopt_clone(results):
+        submitted = run.get('clone_submitted')
+        watch = journal.resume_task(si, submitted['task'], 'VM clone task')
+        if watch is None:
+            vm = content.searchIndex.FindChild(submitted['folder'], deploy_settings["new_vm_name"])
+            if not isinstance(vm, vim.VirtualMachine):
+                vm = None
+        else:
+            vm = watch.result if watch.succeeded else None
+        if vm is None:
+            results = dict(network=network(results), disks=disks(results))
+            if deploy_settings.get('linked'):
+                results['linked_base'] = linked_base(results)
+            return clone_task(results)
+        clone_report.update(mode=submitted['mode'], fallback=submitted['fallback'])
+        run.record('clone', vm=vm, datastore=submitted['datastore'], mode=submitted['mode'],
+                   fallback=submitted['fallback'])
+        print "VM {} is created.".format(deploy_settings["new_vm_name"])
+        return vm
+
+    cloned = run.get('clone')
+    if cloned is not None:
+        clone_report.update(mode=cloned['mode'], fallback=cloned['fallback'])
+        print "VM {} already cloned by an interrupted run, resuming".format(deploy_settings["new_vm_name"])
+        stages = [('clone_task', lambda results: cloned['vm'], [])]
+    elif run.get('clone_submitted') is not None:
+        stages = [('clone_task', adopt_clone, [])]
+    else:
+        stages = [('network', network, []), ('disks', disks, [])]
+        if deploy_settings.get('linked'):
+            stages.append(('linked_base', linked_base, []))
+        stages.append(('clone_task', clone_task, [name for name, _, _ in stages]))
+
+    def chains(results):
+        # Record the disk backing chains of the new VM
+        vm = results['clone_task']
+        vm_devices = retrieve_objects(content, [vm], ['config.hardware.device'])[vm]['config.hardware.device']
+        clone_report['chains'] = backing_chains(vm_devices)
+        clone_report['vm'] = vm
+        if report is not None:
+            report.update(clone_report)
+
+    # The spec is applied at first boot, then the guest reboots
+    def wait_customization(results):
+        print "Wait during guest customization ..."
+        waited = wait_for_customization(si, results['clone_task'])
+        print "Guest customized after %.0fs" % waited
+        run.record('customization', waited=waited)
+
+    # Wait for the vm tools to be up and guest operations ready
+    def wait_guest(results):
+        print "Wait during VM tools starting ..."
+        waited = wait_for_guest(si, results['clone_task'])
+        print "VM tools ready after %.0fs" % waited
 
     # Now customization of guest using a bootstrap script
     # We suppose bootstrap file is generated before 
     # We have to copy this file into the VM 
     # Then we execute it.
-
-    print "VM "+ vm.name + " is created."
-
-    bootstrap_file = '/scripts/vmware/vm-bootstrap.bash'
-
-    # Sleep during the vm tools booting.
-    print "Wait during VM tools starting ..."
-    time.sleep(25)
-
-    # Call upload file function
-    print "Starting customization"
-    bootstrap(si, datacenter, bootstrap_file, '/tmp/bootstrap.bash', vmxfile, 'root', 'password')
+    bootstrap_file = deploy_settings.get('bootstrap_file') or BOOTSTRAP_FILE
+
+    def bootstrap_guest(results):
+        # Printed here, not while other stages print
+        for label, chain in sorted(clone_report['chains'].items()):
+            print "{} ({} clone): {}".format(label, clone_report['mode'], ' -> '.join(chain))
+
+        # Placement may pick another datastore on a rerun, keep the VM's
+        datastore_path = '[' + run.get('clone')['datastore'] + '] ' + deploy_settings["new_vm_name"]
+        vmxfile = datastore_path + '/' + deploy_settings["new_vm_name"] + '.vmx'
+
+        # Call upload file function
+        print "Starting customization"
+        return bootstrap(si, datacenter, bootstrap_file, '/tmp/bootstrap.bash', vmxfile, 'root', 'password')
+
+    stages.append(('chains', chains, ['clone_task']))
+    booted = 'clone_task'
+    if deploy_settings.get('customization') == 'spec' and run.get('customization') is None:
+        stages.append(('wait_customization', wait_customization, ['clone_task']))
+        booted = 'wait_customization'
+    stages.append(('wait_guest', wait_guest, [booted]))
+    stages.append(('bootstrap', bootstrap_guest, ['wait_guest', 'chains']))
+
+    # Wall time of the stages, whose own spans overlap
+    tracing.phase('pipeline')
+    try:
+        results = run_stages(stages)
+    except CustomizationFailed, e:
+        print e
+        return -1
+    exit_code = results['bootstrap']
+    if exit_code == 0:
+        run.finish()
+    return exit_code
 
 def bootstrap(si, datacenter, upload_file, upload_file_path, vmxfile, vm_user, vm_pwd):
     """
     Function uploading a file from host to guest
-    And execute bootstrap file
+    And execute bootstrap file, return its exit code
     """
 
     # Upload file
+    tracing.phase('upload')
 
     try:
         content = si.RetrieveContent()
@@ -267,34 +611,41 @@ def bootstrap(si, datacenter, upload_file, upload_file_path, vmxfile, vm_user, v
 
         creds = vim.vm.guest.NamePasswordAuthentication(
             username=vm_user, password=vm_pwd)
-        with open(upload_file, 'r') as myfile:
-            args = myfile.read()
 
         try:
-            file_attribute = vim.vm.guest.FileManager.FileAttributes()
-            url = content.guestOperationsManager.fileManager.InitiateFileTransferToGuest(vm, creds, upload_file_path, file_attribute, len(args), True)
-            resp = requests.put(url, data=args, verify=False)
-            if not resp.status_code == 200:
-                print "Error while uploading file"
-            else:
-                print "customization in progress"
+            # Streamed over the shared HTTPS session
+            guestops.upload_file(si, vm, creds, upload_file, upload_file_path)
+            print "customization in progress"
         except IOError, e:
+            print "Error while uploading file"
             print e
     except vmodl.MethodFault as error:
         print "Caught vmodl fault : " + error.msg
         return -1
 
     # Excute uploaded file
+    tracing.phase('run')
     bootstrap = vim.vm.guest.ProcessManager.ProgramSpec(arguments='start', programPath='/etc/init.d/bootstrap')
     bootstrap_pid = si.content.guestOperationsManager.processManager.StartProgramInGuest(vm=vm, auth=creds, spec=bootstrap)
 
-    time.sleep(20)
+    # Follow the bootstrap until it exits (or reboots the guest)
+    exit_code = wait_for_process(si, vm, creds, bootstrap_pid)
+    if exit_code is None:
+        print "Customization done, " + vm.name + " is rebooting."
+        return 0
+    if exit_code != 0:
+        print "Customization of " + vm.name + " failed, bootstrap exit code: %s" % exit_code
+        return exit_code
+
     print "Customization done, " + vm.name + " is ready."
 
     return 0
 
 
-def main(**kwargs):
+"""
+ Build clone settings from command line (or manifest) arguments
+"""
+def build_deploy_settings(**kwargs):
     deploy_settings = dict()
     deploy_settings["new_vm_name"] = kwargs['hostname'].lower()
     deploy_settings['cpus'] = kwargs['cpus']
@@ -309,8 +660,121 @@ def main(**kwargs):
     deploy_settings['cluster'] = kwargs['cluster']
     deploy_settings['datastore'] = kwargs['datastore']
     deploy_settings['vlans'] = kwargs['vlans']
-    deploy_settings['dns'] = kwargs['dns']
+    deploy_settings['dns'] = kwargs['dns'] if isinstance(kwargs['dns'], list) else [kwargs['dns']]
+    deploy_settings['customization'] = kwargs.get('customization') or 'bootstrap'
+    deploy_settings['ips'] = kwargs.get('ips') or []
+    deploy_settings['gateway'] = kwargs.get('gateway')
     deploy_settings['disks'] = kwargs['disks']
+    deploy_settings['host'] = kwargs.get('host')
+    deploy_settings['bootstrap_file'] = kwargs.get('bootstrap_file') or (
+        SALT_FILE if deploy_settings['customization'] == 'spec' else BOOTSTRAP_FILE)
+    deploy_settings['linked'] = kwargs.get('linked_clone') or False
+    deploy_settings['linked_snapshot'] = kwargs.get('linked_snapshot') or LINKED_SNAPSHOT
+    deploy_settings['linked_fallback'] = kwargs.get('linked_fallback') or 'full'
+    deploy_settings['max_chain_depth'] = kwargs.get('max_chain_depth') or MAX_CHAIN_DEPTH
+    deploy_settings['placement'] = kwargs.get('placement') or False
+    deploy_settings['datastore_pattern'] = kwargs.get('datastore_pattern')
+    deploy_settings['resource_pool'] = kwargs.get('resource_pool')
+
+    if deploy_settings['ips'] and len(deploy_settings['ips']) != len(deploy_settings['vlans'] or []):
+        sys.exit("%s: %d IPs given for %d VLANs" % (deploy_settings["new_vm_name"], len(deploy_settings['ips']),
+                                                     len(deploy_settings['vlans'] or [])))
+    for ip in deploy_settings['ips']:
+        try:
+            if '/' not in ip:
+                raise AddrFormatError("no prefix")
+            IPNetwork(ip)
+        except AddrFormatError, e:
+            sys.exit("%s: invalid IP/prefix %s (%s)" % (deploy_settings["new_vm_name"], ip, e))
+
+    return deploy_settings
+
+
+"""
+ Load a YAML or JSON manifest of VMs to clone
+ Either a list of VMs or a dict with a "vms" list and optional "defaults"
+"""
+def load_manifest(path):
+    with open(path, 'r') as manifest_file:
+        if path.endswith('.json'):
+            manifest = json.load(manifest_file)
+        else:
+            import yaml
+            manifest = yaml.safe_load(manifest_file)
+
+    defaults = dict()
+    if isinstance(manifest, dict):
+        defaults = manifest.get('defaults') or dict()
+        manifest = manifest.get('vms') or []
+
+    vms = list()
+    for entry in manifest:
+        vm = dict(defaults)
+        vm.update(entry)
+        if not vm.get('hostname') or not vm.get('vlans'):
+            sys.exit("Manifest entry without hostname or vlans: %s" % entry)
+        # Accept scalars where the command line takes lists
+        for key in ('vlans', 'disks'):
+            if not isinstance(vm.get(key, []), list):
+                vm[key] = str(vm[key]).split()
+        vms.append(vm)
+    return vms
+
+
+"""
+ Clone every VM of a manifest concurrently over one session and inventory
+"""
+def bulk_clone(**kwargs):
+    settings_list = list()
+    pinned = list()
+    for entry in load_manifest(kwargs['manifest']):
+        vm_args = dict(kwargs)
+        vm_args.update(entry)
+        settings_list.append(build_deploy_settings(**vm_args))
+        # Host and datastore set in the manifest are not placed
+        pinned.append(set(key for key in ('host', 'datastore') if entry.get(key)))
+
+    if not settings_list:
+        sys.exit("No VM in manifest %s" % kwargs['manifest'])
+
+    si = connect(settings_list[0])
+    inventory = Inventory(si, mirror=mirror.open_for(si))
+
+    # Spread the whole batch over the cluster before any clone starts
+    placed = [s for s in settings_list if s['placement']]
+    if placed:
+        place_vms(si, inventory, placed, [p for s, p in zip(settings_list, pinned) if s['placement']])
+
+    def worker(deploy_settings):
+        report = dict()
+        exit_code = clone(deploy_settings, list(deploy_settings['vlans']), si=si, inventory=inventory, report=report)
+        if exit_code:
+            raise RuntimeError("bootstrap exit code %s" % exit_code)
+        return report
+
+    print "Cloning {} VMs, {} at a time...".format(len(settings_list), kwargs['parallel'])
+    results = run_parallel(settings_list, worker, parallel=kwargs['parallel'],
+                           limits=[(lambda s: s['datastore'], kwargs['per_datastore']),
+                                   (lambda s: s.get('host'), kwargs['per_host'])])
+    print_summary(results, lambda s: s['new_vm_name'])
+
+    # Clone mode and longest disk chain of each VM
+    print "%-40s %-7s %6s  %s" % ('NAME', 'MODE', 'CHAIN', 'FALLBACK')
+    for r in results:
+        if r['result']:
+            depth = max([len(chain) for chain in r['result']['chains'].values()] or [0])
+            print "%-40s %-7s %6d  %s" % (r['item']['new_vm_name'], r['result']['mode'], depth,
+                                          r['result']['fallback'] or '')
+
+    if [r for r in results if r['status'] != 'ok']:
+        sys.exit(1)
+
+
+def main(**kwargs):
+    if kwargs.get('manifest'):
+        return bulk_clone(**kwargs)
+
+    deploy_settings = build_deploy_settings(**kwargs)
 
 
     # initialize a list to hold our network settings
@@ -326,7 +790,12 @@ def main(**kwargs):
         vlans_settings.append(vlan)
 
     # clone template to a new VM with our specified settings
-    clone(deploy_settings, vlans_settings)
+    if deploy_settings['placement']:
+        si = connect(deploy_settings)
+        inventory = Inventory(si, mirror=mirror.open_for(si))
+        place_vms(si, inventory, [deploy_settings])
+        return clone(deploy_settings, vlans_settings, si=si, inventory=inventory)
+    return clone(deploy_settings, vlans_settings)
 
 """
  Main program
@@ -340,8 +809,8 @@ if __name__ == "__main__":
     # Define command line arguments
     parser = argparse.ArgumentParser(description='Deploy a new VM in vSphere')
     parser.add_argument('--template', type=str, help='VMware template to clone', default='Centos7-x86')
-    parser.add_argument('--hostname', type=str, required=True, help='New host name',)
-    parser.add_argument('--vlans', type=str, help='VLAN labels for NIC, separated by a space', nargs='+', required=True)
+    parser.add_argument('--hostname', type=str, help='New host name',)
+    parser.add_argument('--vlans', type=str, help='VLAN labels for NIC, separated by a space', nargs='+')
     parser.add_argument('--cpus', type=int, help='Number of CPUs', default=1)
     parser.add_argument('--mem', type=int, help='Memory in GB', default=1)
     parser.add_argument('--domain', type=str, help='domain name', default='prod.dmd')
@@ -352,9 +821,26 @@ if __name__ == "__main__":
     parser.add_argument('--datacenter', type=str, help='Datacenter in Vcenter', default='MyDC')
     parser.add_argument('--cluster', type=str, help='Cluster in Vcenter', default='prod')
     parser.add_argument('--datastore', type=str, help='Datastore for the VM', default='svc1_esx_poc-55')
-    parser.add_argument('--dns', type=str, help='Dns server for the VM', default='192.168.139.1')
+    parser.add_argument('--dns', type=str, help='Dns servers for the VM, separated by a space', nargs='+', default=['192.168.139.1'])
     parser.add_argument('--disks', type=str, help='Size in GB for additional disk, separated by a space', nargs='+', default='0')
+    parser.add_argument('--bootstrap-file', type=str, help='Bootstrap script uploaded into the VM (default %s, %s with --customization spec)' % (BOOTSTRAP_FILE, SALT_FILE))
+    parser.add_argument('--customization', type=str, help='Configure the guest with the bootstrap script, or with a customization spec applied by the clone task', choices=['bootstrap', 'spec'], default='bootstrap')
+    parser.add_argument('--ips', type=str, help='IP/prefix of each VLAN NIC with --customization spec, e.g. 10.203.2.237/24, DHCP when not given', nargs='+')
+    parser.add_argument('--gateway', type=str, help='Default gateway with --customization spec')
+    parser.add_argument('--manifest', type=str, help='YAML/JSON file of VMs to clone in bulk (hostname, vlans, cpus, mem, disks, template, ...)')
+    parser.add_argument('--parallel', type=int, help='Max number of clones running at once in bulk mode', default=DEFAULT_PARALLEL)
+    parser.add_argument('--per-datastore', type=int, help='Max number of clones running at once on one datastore in bulk mode, 0 for no limit', default=4)
+    parser.add_argument('--per-host', type=int, help='Max number of clones running at once on one host in bulk mode, 0 for no limit', default=4)
+    parser.add_argument('--placement', help='Choose host and datastore from the cluster load instead of --datastore', action='store_true')
+    parser.add_argument('--datastore-pattern', type=str, help='Glob on names of datastores --placement can use, e.g. "svc1_*"')
+    parser.add_argument('--resource-pool', type=str, help='Resource pool for the VM, cluster root pool by default')
+    parser.add_argument('--linked-clone', help='Linked clone over a snapshot of the template instead of a full copy', action='store_true')
+    parser.add_argument('--linked-snapshot', type=str, help='Template snapshot linked clones are based on, created when missing', default=LINKED_SNAPSHOT)
+    parser.add_argument('--linked-fallback', type=str, help='What to do when a linked clone is not possible', choices=['full', 'fail'], default='full')
+    parser.add_argument('--max-chain-depth', type=int, help='Max number of files in the disk chain of a linked clone, full clone beyond', default=MAX_CHAIN_DEPTH)
     
     # Parse arguments and hand off to main()
     args = parser.parse_args()
-    main(**vars(args))
\ No newline at end of file
+    if args.manifest is None and (args.hostname is None or args.vlans is None):
+        parser.error('--hostname and --vlans are required without --manifest')
+    sys.exit(main(**vars(args)))
\ No newline at end of file
@@ -5,19 +5,29 @@
 vSphere SDK for Python program for creating  VMs
 """
 
-import atexit
+if __name__ == "__main__":
+    # Thin client of the warm agent when one listens (agent.py)
+    import agent
+    agent.delegate(__file__)
+
 import hashlib
 import json
 
 import random
+import sys
 import time
 
 import requests
-from pyVim import connect
+import session
 from pyVmomi import vim
 
-from tools import cli
-from tools import tasks
+from throttle import run_task
+from bulk import run_stages
+from inventory import Inventory
+from placement import Placement, NoCandidate, GB, MB
+import journal
+import mirror
+import tracing
 
 # Disable certicat check
 requests.packages.urllib3.disable_warnings()
@@ -28,12 +38,25 @@ def get_args():
     """
     Use the tools.cli methods and then add a few more arguments.
     """
+    # Only the command line needs the community samples tools
+    from tools import cli
+
     parser = cli.build_arg_parser()
 
     parser.add_argument('-d', '--datastore',
-                        required=True,
+                        required=False,
+                        action='store',
+                        help='Name of Datastore to create VM in, required without --placement')
+
+    parser.add_argument('--cluster',
+                        required=False,
                         action='store',
-                        help='Name of Datastore to create VM in')
+                        help='Name of the cluster or standalone host to create VM in, first one by default')
+
+    parser.add_argument('--placement',
+                        required=False,
+                        action='store_true',
+                        help='Choose host and datastore from the cluster load')
 
     parser.add_argument('-cs', '--sockets',
                         required=True,
@@ -64,21 +87,9 @@ def get_args():
 
     return cli.prompt_for_password(args)
 
-"""
- Get the vsphere object associated with a given text name
-"""
-def get_obj(content, vimtype, name):
-    obj = None
-    container = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
-    for c in container.view:
-        if c.name == name:
-            obj = c
-            break
-    return obj
-
-
+@tracing.traced('create_vm')
 def create_vm(name, service_instance, vm_folder, resource_pool,
-                    datastore,memSize, nbSockets, nbCores, vlan):
+                    datastore,memSize, nbSockets, nbCores, vlan, host=None):
     """Creates a VirtualMachine.
 
     :param name: String Name for the VirtualMachine
@@ -90,13 +101,36 @@ def create_vm(name, service_instance, vm_folder, resource_pool,
     :param nbSockets: Desired number of sockets for the VirtualMachine
     :param nbCores: Desired number of core by sockets for the VirtualMachine
     :param vlan: Name of Network to connect the VirtualMachine on
+    :param host: HostSystem to run the VirtualMachine on, chosen by DRS when None
 
     """
     content = service_instance.RetrieveContent()
 
     vm_name = name
 
-    dc = get_obj(content, [vim.Datacenter], 'FARMAN')
+    # Steps done by an interrupted run for this VM are reused (journal.py)
+    run = journal.begin(service_instance, 'create_vm', vm_name,
+                        dict(memory=int(memSize), sockets=int(nbSockets), cores=int(nbCores), vlan=vlan))
+    created = run.get('create')
+    submitted = run.get('create_submitted')
+    if created is not None or submitted is not None:
+        # Placement may pick another datastore on a rerun, keep the VM's
+        datastore = (created or submitted)['datastore']
+
+    # Index datacenters, networks and datastores in one PropertyCollector pass
+    tracing.phase('inventory')
+    inventory = Inventory(service_instance, mirror=mirror.open_for(service_instance))
+    inventory.prefetch([vim.Datacenter, vim.Network, vim.Datastore])
+    # Only keys the task windows of throttle.py
+    datastore_obj = inventory.get(vim.Datastore, datastore)
+
+    dc = inventory.get(vim.Datacenter, 'FARMAN')
+    network = inventory.get(vim.Network, vlan)
+
+    # Check what the local mirror returned, look it up in vCenter if out of date
+    if not inventory.verify([(dc, 'FARMAN'), (network, vlan)]):
+        dc = inventory.get(vim.Datacenter, 'FARMAN')
+        network = inventory.get(vim.Network, vlan)
 
     datastore_path = '[' + datastore + '] ' + vm_name
 
@@ -126,7 +160,7 @@ def create_vm(name, service_instance, vm_folder, resource_pool,
     nic.device.deviceInfo.label = "Network Adapter 0"
     nic.device.deviceInfo.summary = vlan
     nic.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
-    nic.device.backing.network = get_obj(content, [vim.Network], vlan) # Connect to the correct network
+    nic.device.backing.network = network # Connect to the correct network
     nic.device.backing.deviceName = vlan # Set name of the interface
     nic.device.backing.useAutoDetect = False
     nic.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
@@ -147,10 +181,37 @@ def create_vm(name, service_instance, vm_folder, resource_pool,
     # Apply change configuration NIC + SCSI controller
     config.deviceChange = devices
 
+    # The VMDK is created in the directory of the VM once the VM creation
+    # made it, then attached (bulk.run_stages)
+
     # Vm Creation
-    print "Creating VM {}...".format(vm_name)
-    task = vm_folder.CreateVM_Task(config=config, pool=resource_pool)
-    tasks.wait_for_tasks(service_instance, [task])
+    def create(results):
+        def start():
+            task = vm_folder.CreateVM_Task(config=config, pool=resource_pool, host=host)
+            # Recorded before waiting, a rerun waits for this task or adopts its VM
+            run.record('create_submitted', task=task._moId, folder=vm_folder, datastore=datastore)
+            return task
+
+        print "Creating VM {}...".format(vm_name)
+        vm = run_task(service_instance, start, 'VM creation', host=host, datastore=datastore_obj, idempotent=False)
+        run.record('create', vm=vm, datastore=datastore)
+        return vm
+
+    # Interrupted while the VM was created: wait for the task, or take the VM
+    # of that name in the folder once vCenter forgot it, create again when it failed
+    def adopt_vm(results):
+        watch = journal.resume_task(service_instance, submitted['task'], 'VM creation')
+        if watch is None:
+            vm = content.searchIndex.FindChild(submitted['folder'], vm_name)
+            if not isinstance(vm, vim.VirtualMachine):
+                vm = None
+        else:
+            vm = watch.result if watch.succeeded else None
+        if vm is None:
+            return create(results)
+        print "VM {} created by an interrupted run, resuming".format(vm_name)
+        run.record('create', vm=vm, datastore=submitted['datastore'])
+        return vm
 
 
     # Create VMDK file
@@ -166,55 +227,97 @@ def create_vm(name, service_instance, vm_folder, resource_pool,
     disk_spec.capacityKb = capacity_kb
 
     # VMDK Creation 
-    print "Creating VMDK {}...".format(disk_path)
-    task2 = disk_manager.CreateVirtualDisk(disk_path, dc, disk_spec)
-    tasks.wait_for_tasks(service_instance, [task2])
+    def create_disk(results):
+        def start():
+            task = disk_manager.CreateVirtualDisk(disk_path, dc, disk_spec)
+            # Recorded before waiting, a rerun waits for this task or adopts the VMDK
+            run.record('disk_submitted', task=task._moId, path=disk_path)
+            return task
+
+        print "Creating VMDK {}...".format(disk_path)
+        run_task(service_instance, start, 'VMDK creation', host=host, datastore=datastore_obj, idempotent=False)
+        run.record('disk', path=disk_path)
+
+    # Interrupted while the VMDK was created: wait for the task, or check the
+    # VMDK is there once vCenter forgot it, create it again when it failed
+    def adopt_disk(results):
+        disk_submitted = run.get('disk_submitted')
+        watch = journal.resume_task(service_instance, disk_submitted['task'], 'VMDK creation')
+        if watch is None:
+            try:
+                disk_manager.QueryVirtualDiskUuid(disk_submitted['path'], dc)
+                done = True
+            except vim.fault.FileNotFound:
+                done = False
+        else:
+            done = watch.succeeded
+        if not done:
+            return create_disk(results)
+        print "VMDK {} created by an interrupted run, resuming".format(disk_submitted['path'])
+        run.record('disk', path=disk_submitted['path'])
 
 
     # Connect VMDK  to the VM
-
-    # Get the newly created VM
-    vmxfile = datastore_path + '/' + vm_name + '.vmx'
-    search = content.searchIndex
-    vm = search.FindByDatastorePath(dc, vmxfile)
-
-    # Get controller SCSI  
-    controller = None
-    devices = vm.config.hardware.device
-    for device in devices:
-        if 'SCSI' in device.deviceInfo.label:
-            controller = device
-
-    # Define the disk
-    disk = vim.vm.device.VirtualDisk()
-    disk.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo()
-    disk.backing.diskMode = 'persistent'
-    disk.backing.thinProvisioned = False
-    #disk.backing.eagerlyScrub = True
-    disk.backing.eagerlyScrub = False
-    disk.backing.fileName = disk_filename
-
-    disk.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-    disk.connectable.startConnected = True
-    disk.connectable.allowGuestControl = False
-    disk.connectable.connected = True
-
-    disk.key = -100
-    disk.controllerKey = controller.key # id of scsi controller
-    disk.unitNumber = len(controller.device) # number of SCSI device
+    def attach(results):
+        vm = results['create_task']
+
+        # Get controller SCSI  
+        controller = None
+        devices = vm.config.hardware.device
+        for device in devices:
+            if 'SCSI' in device.deviceInfo.label:
+                controller = device
+
+        # Define the disk
+        disk = vim.vm.device.VirtualDisk()
+        disk.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo()
+        disk.backing.diskMode = 'persistent'
+        disk.backing.thinProvisioned = False
+        #disk.backing.eagerlyScrub = True
+        disk.backing.eagerlyScrub = False
+        disk.backing.fileName = disk_filename
+
+        disk.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+        disk.connectable.startConnected = True
+        disk.connectable.allowGuestControl = False
+        disk.connectable.connected = True
+
+        disk.key = -100
+        disk.controllerKey = controller.key # id of scsi controller
+        disk.unitNumber = len(controller.device) # number of SCSI device
     
     
-    # Create disk's spec
-    device_spec = vim.vm.device.VirtualDiskSpec()
-    device_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
-    device_spec.device = disk
-
-    spec = vim.vm.ConfigSpec()
-    spec.deviceChange = [device_spec]
-
-    # Reconfigure VM 
-    task3 = vm.ReconfigVM_Task(spec)
-    tasks.wait_for_tasks(service_instance, [task3])
+        # Create disk's spec
+        device_spec = vim.vm.device.VirtualDiskSpec()
+        device_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
+        device_spec.device = disk
+
+        spec = vim.vm.ConfigSpec()
+        spec.deviceChange = [device_spec]
+
+        # Reconfigure VM 
+        run_task(service_instance, lambda: vm.ReconfigVM_Task(spec), 'VM reconfigure', host=host,
+                 datastore=datastore_obj, idempotent=False)
+        return vm
+
+    if created is not None:
+        print "VM {} already created by an interrupted run, resuming".format(vm_name)
+        stages = [('create_task', lambda results: created['vm'], [])]
+    elif submitted is not None:
+        stages = [('create_task', adopt_vm, [])]
+    else:
+        stages = [('create_task', create, [])]
+    if run.get('disk') is None:
+        # A MakeDirectory of its own would race the CreateVM_Task making the directory
+        stages.append(('create_disk', adopt_disk if run.get('disk_submitted') is not None else create_disk,
+                       ['create_task']))
+    stages.append(('reconfigure', attach, [name for name, _, _ in stages]))
+
+    # Wall time of the stages, whose own spans overlap
+    tracing.phase('pipeline')
+    vm = run_stages(stages)['reconfigure']
+    run.finish()
+    return vm
     
 
     
@@ -227,25 +330,60 @@ def main():
     args = get_args()
 
 
-    service_instance = connect.SmartConnect(host=args.host,
-                                            user=args.user,
-                                            pwd=args.password,
-                                            port=int(args.port))
+    service_instance = session.connect(host=args.host,
+                                       user=args.user,
+                                       pwd=args.password,
+                                       port=int(args.port))
     if not service_instance:
         print("Could not connect to the specified host using specified "
               "username and password")
         return -1
 
-    atexit.register(connect.Disconnect, service_instance)
+    # Session is cached for next runs, so no logout at exit
+
+    try:
+        provision(service_instance, args.name, args.memory, args.sockets, args.cores, args.vlan,
+                  datastore=args.datastore, cluster=args.cluster, placement=args.placement)
+    except (NoCandidate, ValueError, journal.SettingsChanged) as error:
+        print(error)
+        return -1
 
+
+def provision(service_instance, name, memory, sockets, cores, vlan, datastore=None, cluster=None,
+              placement=False):
+    """Create a VM in the first datacenter, on a datastore or placed on a cluster.
+
+    :param cluster: Name of the cluster or standalone host to place the VM on, first one by default
+    :param placement: Choose host and datastore from the cluster load instead of datastore
+    :return: The new vim.VirtualMachine
+    """
     content = service_instance.RetrieveContent()
     datacenter = content.rootFolder.childEntity[0]
     vmfolder = datacenter.vmFolder
     hosts = datacenter.hostFolder.childEntity
     resource_pool = hosts[0].resourcePool
-
-
-    create_vm(args.name, service_instance, vmfolder, resource_pool, args.datastore, args.memory, args.sockets, args.cores, args.vlan)
+    host = None
+
+    if placement:
+        # Least loaded host and datastore of the cluster, from one retrieval.
+        # A standalone host is a ComputeResource placed the same way
+        if cluster:
+            cluster_obj = Inventory(service_instance).get(vim.ComputeResource, cluster)
+        else:
+            cluster_obj = next((obj for obj in hosts if isinstance(obj, vim.ComputeResource)), None)
+        if cluster_obj is None:
+            sys.exit("Cluster %s not found" % (cluster or "of datacenter %s" % datacenter.name))
+        placer = Placement(service_instance, cluster_obj)
+        # 1 GB disk and the swap file
+        host_name, datastore = placer.place(1 * GB + int(memory) * MB, int(sockets) * int(cores), int(memory))
+        print "Placing VM on {} / {}".format(host_name, datastore)
+        host = placer.hosts[host_name]['obj']
+        resource_pool = cluster_obj.resourcePool
+    elif not datastore:
+        raise ValueError("--datastore is required without --placement")
+
+    return create_vm(name, service_instance, vmfolder, resource_pool, datastore, memory, sockets, cores, vlan,
+                     host=host)
 
 
 
@@ -12,22 +12,39 @@ pyvmomi==5.5.0
 wsgiref==0.1.2
 """
 
+if __name__ == "__main__":
+    # Thin client of the warm agent when one listens (agent.py)
+    import agent
+    agent.delegate(__file__)
+
 import requests
-from pyVim.connect import SmartConnect, Disconnect
+import session
 from pyVmomi import vim, vmodl
-import atexit
 import os
 import sys
 from pprint import pprint, pformat
 import argparse
 import getpass
 from copy import deepcopy
-from tools import tasks
+from taskwait import get_waiter
+from throttle import get_scheduler
+from inventory import retrieve_objects
+import time
+import Queue
+import mirror
+import tracing
 
 # Disable SSL certificats check
 requests.packages.urllib3.disable_warnings()
 
+# Max number of VMs between power off and destroy end at once
+MAX_INFLIGHT = 20
+
+# Seconds between two looks at tasks waiting for a retry or for room in their windows
+WAKE_UP = 0.5
+
 
+@tracing.traced('destroy_vm')
 def destroy_vm(**kwargs):
 
     deploy_settings = dict()
@@ -42,31 +59,171 @@ def destroy_vm(**kwargs):
 
     # Connection to vcenter
     try:
-        si = SmartConnect(host=deploy_settings["vserver"], user=deploy_settings["username"], pwd=deploy_settings["password"], port=int(deploy_settings["port"]))
+        si = session.connect(host=deploy_settings["vserver"], user=deploy_settings["username"], pwd=deploy_settings["password"], port=int(deploy_settings["port"]))
     except IOError, e:
         sys.exit("Unable to connect to vsphere server. Error message: %s" % e)
     
-    # Loop on vm name
-    for key, vm_name in enumerate(kwargs['vmname']):
-    	# Get VM object
-    	vm = si.content.searchIndex.FindByDnsName(None, vm_name.lower(), True)
+    content = si.RetrieveContent()
+
+    # Resolve every VM first, then get their power state in one call
+    tracing.phase('resolve')
+    targets = list()
+    seen = set()
+    for vm_name in kwargs['vmname']:
+        # A name given twice is destroyed once, in the order given
+        if vm_name.lower() in seen:
+            continue
+        seen.add(vm_name.lower())
+        targets.append(dict(name=vm_name.lower(), vm=None, status='pending', error=None,
+                            start=None, poweroff=None, destroy=None))
+
+    # DNS names known to the local mirror are checked in one call,
+    # the others are searched in vCenter one by one
+    local = mirror.open_for(si)
+    if local is not None:
+        by_dns_name = dict()
+        for vm, row in local.find_vms(si, [t['name'] for t in targets]):
+            by_dns_name.setdefault(row['dns_name'], []).append(vm)
+        found = dict()
+        for target in targets:
+            vms = by_dns_name.get(target['name'], [])
+            if len(vms) == 1:
+                found[vms[0]] = target['name']
+        stale = local.verify(si, found, 'guest.hostName')
+        for target in targets:
+            vms = by_dns_name.get(target['name'], [])
+            if len(vms) == 1 and vms[0] not in stale:
+                target['vm'] = vms[0]
+
+    for target in targets:
+        if target['vm'] is None:
+            target['vm'] = content.searchIndex.FindByDnsName(None, target['name'], True)
+        if target['vm'] is None:
+            target['status'] = 'failed'
+            target['error'] = 'VM not found'
+
+    # Two names of one VM (DNS aliases, mirror and vCenter answers) destroy it once
+    by_moid = dict()
+    for target in list(targets):
+        if target['vm'] is None:
+            continue
+        first = by_moid.setdefault(target['vm']._moId, target)
+        if first is not target:
+            print "{0} is the same VM as {1}, destroyed once".format(target['name'], first['name'])
+            targets.remove(target)
+
+    tracing.phase('power_state')
+    vms = [t['vm'] for t in targets if t['vm'] is not None]
+    states = retrieve_objects(content, vms, ['runtime.powerState', 'runtime.host', 'datastore'])
+
+    tracing.phase('tasks')
+    waiter = get_waiter(si)
+    scheduler = get_scheduler(si)
+    done = Queue.Queue()
+    pending = [t for t in targets if t['vm'] is not None]
+    # [not before, target, phase] of tasks started once their throttle.py windows have room
+    waiting = []
+    by_task = dict()
+    inflight = [0]
+    max_inflight = kwargs.get('max_inflight') or MAX_INFLIGHT
+
+    def queue(target, phase):
+        target['attempt'] = 0
+        target['phase_start'] = time.time()
+        waiting.append([0, target, phase])
+
+    def start_waiting():
+        # Start power off or destroy tasks the windows allow, watch them and record them
+        now = time.time()
+        for entry in list(waiting):
+            not_before, target, phase = entry
+            if not_before > now or not scheduler.acquire(target['keys'], block=False):
+                continue
+            waiting.remove(entry)
+            target['attempt'] += 1
+            try:
+                if phase == 'poweroff':
+                    print "Attempting to power off {0}".format(target['name'])
+                    task = target['vm'].PowerOffVM_Task()
+                else:
+                    task = target['vm'].Destroy_Task()
+            except vmodl.MethodFault as error:
+                ended(target, phase, error)
+                continue
+            except BaseException as error:
+                # The scheduler is shared with the other runs of this process
+                scheduler.release(target['keys'], target['attempt'], error=error)
+                raise
+            by_task[task._moId] = (target, phase)
+            waiter.watch([task], done_callback=done.put)
+
+    def ended(target, phase, error, queue_seconds=None):
+        delay = scheduler.release(target['keys'], target['attempt'], queue_seconds, error)
+        if error is not None and delay is not None:
+            print "{0} of {1}: {2}, retry in {3:.1f}s".format(phase, target['name'],
+                                                              error.msg or error.__class__.__name__, delay)
+            waiting.append([time.time() + delay, target, phase])
+            return
+        target[phase] = time.time() - target['phase_start']
+        if error is not None:
+            target['status'] = 'failed'
+            target['error'] = getattr(error, 'msg', None) or str(error)
+        elif phase == 'poweroff':
+            # Chain the destroy on its own power off completion
+            queue(target, 'destroy')
+            return
+        else:
+            target['status'] = 'ok'
+            print "VM {0} is destroyed".format(target['name'])
+        inflight[0] -= 1
+
+    def start_next():
+        # Keep at most max_inflight VMs between power off and destroy end
+        while pending and inflight[0] < max_inflight:
+            target = pending.pop(0)
+            target['start'] = time.time()
+            props = states.get(target['vm'], dict())
+            target['keys'] = scheduler.keys(props.get('runtime.host'), (props.get('datastore') or [None])[0])
+            inflight[0] += 1
+            queue(target, 'poweroff' if props.get('runtime.powerState') == 'poweredOn' else 'destroy')
+        start_waiting()
 
-		
-    	print("vm found: {0}".format(vm.name))
-    	power_state = vm.runtime.powerState
-    	print "The current powerState is: "  + power_state
-
-	    # If vm is up
-    	if power_state == 'poweredOn':
-			print("Attempting to power off {0}".format(vm.name))
-			task = vm.PowerOffVM_Task()
-			tasks.wait_for_tasks(si, [task])
-			print("VM is {0}".format(vm.runtime.powerState))
-
-		# Lauching destruction
-    	task2 = vm.Destroy_Task()
-    	#task.wait_for_tasks(si, [task2])
-    	print "VM " + vm_name +  " is destroyed" 
+    try:
+        start_next()
+        while inflight[0]:
+            try:
+                # Wake up for retries and for windows freed by other threads
+                watch = done.get(timeout=WAKE_UP if waiting else None)
+            except Queue.Empty:
+                watch = None
+            if watch is not None:
+                target, phase = by_task.pop(watch.key)
+                ended(target, phase, None if watch.succeeded else watch.error, watch.queue_seconds)
+            start_next()
+    except BaseException as error:
+        # Tasks still running hold slots no ended() will give back
+        for target, phase in by_task.values():
+            scheduler.release(target['keys'], target['attempt'], error=error)
+        raise
+
+    # Per VM report with timings
+    failed = [t for t in targets if t['status'] != 'ok']
+    print "%-40s %-8s %9s %9s %9s  %s" % ('NAME', 'STATUS', 'POWEROFF', 'DESTROY', 'TOTAL', 'ERROR')
+    for t in targets:
+        total = None
+        if t['start'] is not None:
+            total = (t['poweroff'] or 0) + (t['destroy'] or 0)
+        print "%-40s %-8s %9s %9s %9s  %s" % (t['name'], t['status'], _seconds(t['poweroff']),
+                                              _seconds(t['destroy']), _seconds(total), t['error'] or '')
+    print "%d destroyed, %d failed" % (len(targets) - len(failed), len(failed))
+
+    return len(failed) == 0
+
+
+def _seconds(value):
+    if value is None:
+        return '-'
+    return '%.1f' % value
 
 
 """
@@ -86,7 +243,9 @@ if __name__ == "__main__":
     parser.add_argument('--password', type=str, help='Username password', required=True)
     parser.add_argument('--port', type=int, help='port for vCenter', default=443)
     parser.add_argument('--datacenter', type=str, help='Datacenter in Vcenter', default='MYDC')
+    parser.add_argument('--max-inflight', type=int, help='Max number of VMs being powered off or destroyed at once', default=MAX_INFLIGHT)
     
     # Parse arguments and hand off to main()
     args = parser.parse_args()
-    destroy_vm(**vars(args))
\ No newline at end of file
+    if not destroy_vm(**vars(args)):
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Export a report of every VM to CSV or JSON lines, streamed.
+
+`export.py --output vms.csv` writes one row per VM: name, DNS name, IP,
+power state, CPUs, memory, disks, portgroups, datastores and number of
+snapshots. VMs are read with RetrievePropertiesEx / ContinueRetrievePropertiesEx
+pages of --page-size VMs and only the property paths of the report, and
+each row is written as soon as its page is read: the export holds one
+page in memory whatever the number of VMs, and makes one round trip per
+page (plus one for the portgroup and datastore names).
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+
+from pyVmomi import vim, vmodl
+
+import session
+import tracing
+from inventory import retrieve_properties, PAGE_SIZE
+
+# Property paths read on each VM
+PROPERTIES = ['name', 'config.template', 'guest.hostName', 'guest.ipAddress', 'runtime.powerState',
+              'config.hardware.numCPU', 'config.hardware.memoryMB', 'summary.config.numVirtualDisks',
+              'summary.storage.committed', 'network', 'datastore', 'snapshot.rootSnapshotList']
+
+# Columns of the report, in CSV order
+FIELDS = ['name', 'dns_name', 'ip', 'power_state', 'cpus', 'memory_mb', 'disks', 'disk_gb', 'portgroups',
+          'datastores', 'snapshots', 'moref']
+
+
+def _count_snapshots(trees):
+    return sum(1 + _count_snapshots(tree.childSnapshotList) for tree in trees or [])
+
+
+def _names(content, vimtype, root):
+    # moId -> name of every object of a type, small next to the VMs
+    return dict((obj_content.obj._moId, obj_content.propSet[0].val)
+                for obj_content in retrieve_properties(content, [vimtype], ['name'], root=root))
+
+
+def vm_records(si, root=None, page_size=PAGE_SIZE, templates=False):
+    """Yield a dict of the FIELDS of each VM under root (rootFolder by default), page by page.
+
+    :param templates: Also yield templates
+    """
+    content = si.RetrieveContent()
+    networks = _names(content, vim.Network, root)
+    datastores = _names(content, vim.Datastore, root)
+    for obj_content in retrieve_properties(content, [vim.VirtualMachine], PROPERTIES, page_size, root):
+        props = dict((p.name, p.val) for p in obj_content.propSet)
+        if props.get('config.template') and not templates:
+            continue
+        committed = props.get('summary.storage.committed')
+        yield dict(name=props.get('name'), dns_name=props.get('guest.hostName'), ip=props.get('guest.ipAddress'),
+                   power_state=props.get('runtime.powerState'), cpus=props.get('config.hardware.numCPU'),
+                   memory_mb=props.get('config.hardware.memoryMB'),
+                   disks=props.get('summary.config.numVirtualDisks'),
+                   disk_gb=round(committed / 1024.0 ** 3, 1) if committed is not None else None,
+                   portgroups=[networks.get(n._moId, n._moId) for n in props.get('network') or []],
+                   datastores=[datastores.get(d._moId, d._moId) for d in props.get('datastore') or []],
+                   snapshots=_count_snapshots(props.get('snapshot.rootSnapshotList')),
+                   moref=obj_content.obj._moId)
+
+
+def write_csv(records, out):
+    """Write records as CSV rows, lists joined by spaces. Return the number of rows."""
+    writer = csv.DictWriter(out, FIELDS)
+    writer.writeheader()
+    count = 0
+    for record in records:
+        row = dict()
+        for field in FIELDS:
+            value = record[field]
+            if isinstance(value, list):
+                value = ' '.join(value)
+            row[field] = value.encode('utf-8') if isinstance(value, unicode) else value
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def write_jsonl(records, out):
+    """Write records as JSON lines. Return the number of lines."""
+    count = 0
+    for record in records:
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+        count += 1
+    return count
+
+
+WRITERS = dict(csv=write_csv, jsonl=write_jsonl)
+
+
+@tracing.traced('export')
+def main(**kwargs):
+    try:
+        si = session.connect(host=kwargs['vserver'], user=kwargs['username'], pwd=kwargs['password'], port=int(kwargs['port']))
+    except IOError, e:
+        sys.exit("Unable to connect to vsphere server. Error message: %s" % e)
+
+    root = None
+    if kwargs['datacenter']:
+        root = [dc for dc in si.RetrieveContent().rootFolder.childEntity
+                if isinstance(dc, vim.Datacenter) and dc.name == kwargs['datacenter']]
+        if not root:
+            sys.exit("Datacenter %s not found" % kwargs['datacenter'])
+        root = root[0]
+
+    output_format = kwargs['format'] or ('jsonl' if kwargs['output'].endswith(('.jsonl', '.json')) else 'csv')
+    out = sys.stdout if kwargs['output'] == '-' else open(kwargs['output'], 'wb')
+    start = time.time()
+    try:
+        count = WRITERS[output_format](vm_records(si, root, kwargs['page_size'], kwargs['templates']), out)
+    except vmodl.MethodFault, e:
+        sys.exit("Export failed: %s" % (getattr(e, 'msg', None) or e))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if out is not sys.stdout:
+        print "%d VMs written to %s in %.1fs" % (count, kwargs['output'], time.time() - start)
+
+
+"""
+ Main program
+"""
+if __name__ == "__main__":
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser(description='Export a report of every VM to CSV or JSON lines')
+    parser.add_argument('--vserver', type=str, help='fqdn or ip addr for the vcenter', required=True)
+    parser.add_argument('--username', type=str, help='Username to use for login into vcenter', required=True)
+    parser.add_argument('--password', type=str, help='Username password', required=True)
+    parser.add_argument('--port', type=int, help='port for vCenter', default=443)
+    parser.add_argument('--output', type=str, help='File written, - for stdout', default='-')
+    parser.add_argument('--format', type=str, help='Output format, from the file extension by default (csv)', choices=sorted(WRITERS))
+    parser.add_argument('--datacenter', type=str, help='Only VMs of this datacenter')
+    parser.add_argument('--templates', help='Also export templates', action='store_true')
+    parser.add_argument('--page-size', type=int, help='VMs read by each call', default=PAGE_SIZE)
+
+    # Parse arguments and hand off to main()
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Guest operations over a fleet of VMs.
+
+Upload files, run a program and fetch files back on many VMs at once.
+Transfers are streamed over one pooled requests.Session, VMs are handled
+concurrently under a cap and the exit code of the program is collected
+for each VM.
+
+Program output is not returned by guest operations, redirect it to a file
+in the guest and --fetch that file.
+"""
+
+if __name__ == "__main__":
+    # Thin client of the warm agent when one listens (agent.py)
+    import agent
+    agent.delegate(__file__)
+
+import argparse
+import fnmatch
+import os
+import sys
+import threading
+
+import requests
+from pyVmomi import vim
+
+import mirror
+import session
+from bulk import run_parallel, print_summary, DEFAULT_PARALLEL
+from inventory import Inventory
+from readiness import wait_for_process
+
+# Disable SSL certificats check
+requests.packages.urllib3.disable_warnings()
+
+# Bytes read at once when streaming a file from the guest
+CHUNK_SIZE = 64 * 1024
+
+_http = None
+_http_lock = threading.Lock()
+
+
+def http_session(pool_size=DEFAULT_PARALLEL):
+    """Return the requests.Session shared by every guest file transfer."""
+    global _http
+    with _http_lock:
+        if _http is None:
+            _http = requests.Session()
+            _http.verify = False
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _http.mount('https://', adapter)
+            _http.mount('http://', adapter)
+        return _http
+
+
+def upload_file(si, vm, creds, local_path, guest_path, overwrite=True):
+    """Stream a local file to the guest, raise an IOError on failure."""
+    size = os.path.getsize(local_path)
+    file_manager = si.content.guestOperationsManager.fileManager
+    url = file_manager.InitiateFileTransferToGuest(vm, creds, guest_path,
+                                                   vim.vm.guest.FileManager.FileAttributes(),
+                                                   size, overwrite)
+    with open(local_path, 'rb') as local_file:
+        # A file object is sent by blocks, never read fully in memory
+        resp = http_session().put(url, data=local_file, headers={'Content-Length': str(size)})
+    resp.raise_for_status()
+
+
+def download_file(si, vm, creds, guest_path, local_path):
+    """Stream a guest file to a local path, return its size."""
+    file_manager = si.content.guestOperationsManager.fileManager
+    info = file_manager.InitiateFileTransferFromGuest(vm, creds, guest_path)
+    resp = http_session().get(info.url, stream=True)
+    resp.raise_for_status()
+    with open(local_path, 'wb') as local_file:
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            local_file.write(chunk)
+    return info.size
+
+
+def run_program(si, vm, creds, command, timeout=None):
+    """Start a command line in the guest and return its exit code, None when the guest went away.
+
+    The first word is the program path, the rest is handed to it as is, quotes included.
+    """
+    args = command.strip().split(None, 1)
+    spec = vim.vm.guest.ProcessManager.ProgramSpec(programPath=args[0],
+                                                   arguments=args[1] if len(args) > 1 else '')
+    pid = si.content.guestOperationsManager.processManager.StartProgramInGuest(vm=vm, auth=creds, spec=spec)
+    if timeout is None:
+        return wait_for_process(si, vm, creds, pid)
+    return wait_for_process(si, vm, creds, pid, timeout=timeout)
+
+
+def run_on_vm(si, vm, creds, uploads=None, command=None, fetches=None, output_dir='.', timeout=None):
+    """Upload files, run a command and fetch files on one VM.
+
+    :param uploads: List of (local path, guest path)
+    :param command: Command line to run in the guest, None to run nothing
+    :param fetches: List of guest paths fetched to output_dir/<vm name>/
+    :return: dict exit_code (None when nothing ran or its end was not seen), fetched (list of local paths)
+    """
+    result = dict(exit_code=None, fetched=[])
+
+    for local_path, guest_path in uploads or []:
+        upload_file(si, vm, creds, local_path, guest_path)
+
+    if command:
+        result['exit_code'] = run_program(si, vm, creds, command, timeout)
+
+    if fetches:
+        vm_dir = os.path.join(output_dir, vm.name)
+        if not os.path.isdir(vm_dir):
+            os.makedirs(vm_dir)
+        for guest_path in fetches:
+            local_path = os.path.join(vm_dir, os.path.basename(guest_path))
+            download_file(si, vm, creds, guest_path, local_path)
+            result['fetched'].append(local_path)
+
+    return result
+
+
+def select_vms(inventory, names=None, pattern=None):
+    """Resolve VM names and/or a glob pattern on VM names, return (name, vm) list."""
+    vms = inventory.get_all(vim.VirtualMachine)
+    selected = dict()
+    for name in names or []:
+        if name not in vms and inventory.mirror is not None:
+            # Not in the local mirror yet, look in vCenter
+            inventory.drop_mirror()
+            vms = inventory.get_all(vim.VirtualMachine)
+        if name not in vms:
+            sys.exit("VM not found: %s" % name)
+        selected[name] = vms[name]
+    if pattern:
+        for name, vm in vms.items():
+            if fnmatch.fnmatch(name, pattern):
+                selected[name] = vm
+    return sorted(selected.items())
+
+
+def _pair(value):
+    if ':' not in value:
+        raise argparse.ArgumentTypeError("expected local:guest, got %s" % value)
+    return tuple(value.split(':', 1))
+
+
+def main(**kwargs):
+    try:
+        si = session.connect(host=kwargs['vserver'], user=kwargs['username'], pwd=kwargs['password'], port=int(kwargs['port']))
+    except IOError, e:
+        sys.exit("Unable to connect to vsphere server. Error message: %s" % e)
+
+    inventory = Inventory(si, mirror=mirror.open_for(si))
+    targets = select_vms(inventory, kwargs['vmname'], kwargs['match'])
+    if not inventory.verify([(vm, name) for name, vm in targets]):
+        # Local mirror out of date, select again from vCenter
+        targets = select_vms(inventory, kwargs['vmname'], kwargs['match'])
+    if not targets:
+        sys.exit("No VM selected")
+
+    http_session(kwargs['parallel'])
+    creds = vim.vm.guest.NamePasswordAuthentication(username=kwargs['guest_user'],
+                                                    password=kwargs['guest_password'])
+
+    def worker(target):
+        result = run_on_vm(si, target[1], creds, kwargs['upload'], kwargs['run'], kwargs['fetch'],
+                           kwargs['output_dir'], kwargs['timeout'])
+        if kwargs['run'] and result['exit_code'] is None:
+            raise RuntimeError("exit code unknown, the guest went away")
+        if result['exit_code']:
+            raise RuntimeError("exit code %s" % result['exit_code'])
+        return result
+
+    print "Running on {} VMs, {} at a time...".format(len(targets), kwargs['parallel'])
+    results = run_parallel(targets, worker, parallel=kwargs['parallel'])
+    print_summary(results, lambda target: target[0])
+
+    if [r for r in results if r['status'] != 'ok']:
+        sys.exit(1)
+
+
+"""
+ Main program
+"""
+if __name__ == "__main__":
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser(description='Run guest operations on many VMs')
+    parser.add_argument('--vserver', type=str, help='fqdn or ip addr for the vcenter', required=True)
+    parser.add_argument('--username', type=str, help='Username to use for login into vcenter', required=True)
+    parser.add_argument('--password', type=str, help='Username password', required=True)
+    parser.add_argument('--port', type=int, help='port for vCenter', default=443)
+    parser.add_argument('--vmname', type=str, help='Names of VMs, separated by a space', nargs='+', default=[])
+    parser.add_argument('--match', type=str, help='Glob pattern on VM names, e.g. "web*"')
+    parser.add_argument('--guest-user', type=str, help='Guest user', default='root')
+    parser.add_argument('--guest-password', type=str, help='Guest user password', required=True)
+    parser.add_argument('--upload', type=_pair, help='local:guest file to upload, can be repeated', action='append', default=[])
+    parser.add_argument('--run', type=str, help='Command line to run in the guest')
+    parser.add_argument('--fetch', type=str, help='Guest file to fetch, can be repeated', action='append', default=[])
+    parser.add_argument('--output-dir', type=str, help='Where fetched files are stored, one dir per VM', default='.')
+    parser.add_argument('--timeout', type=int, help='Max seconds to wait for the command to exit')
+    parser.add_argument('--parallel', type=int, help='Max number of VMs handled at once', default=DEFAULT_PARALLEL)
+
+    # Parse arguments and hand off to main()
+    args = parser.parse_args()
+    if not args.vmname and not args.match:
+        parser.error('--vmname or --match is required')
+    main(**vars(args))
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+Stream vCenter events and task history to JSON lines, for audit and stats.
+
+`history.py --output history.jsonl` reads the events and the ended tasks
+of a vCenter (or of one --datacenter, of some --user accounts, of VMs
+given by --vmname / --match) through an EventHistoryCollector and a
+TaskHistoryCollector, oldest first, one page of --page-size records at a
+time. Each page is appended to the output as soon as it is read, so
+memory stays the same whatever the length of the history.
+
+A checkpoint (OUTPUT.checkpoint by default) is moved to the last record
+written after each page: the next run with the same filters appends what
+happened since, without duplicates. Tasks come with the seconds they
+waited in the vCenter queue and ran; --stats prints count, mean and max
+of both per type of task.
+"""
+
+import argparse
+import datetime
+import fnmatch
+import json
+import os
+import sys
+import time
+
+from pyVmomi import vim, vmodl
+from pyVmomi.Iso8601 import ParseISO8601, TZManager
+
+import session
+
+# Records read by each call, vCenter returns at most 1000
+PAGE_SIZE = 500
+
+# Tasks are read once ended, by completion time
+TASK_STATES = ['success', 'error']
+
+
+def parse_time(value):
+    """datetime of an ISO 8601 date/time (UTC when no zone) or of an age: 30m, 12h, 7d."""
+    units = dict(m=60, h=3600, d=86400)
+    if value[-1:] in units and value[:-1].isdigit():
+        return datetime.datetime.now(TZManager.GetTZInfo()) - datetime.timedelta(
+            seconds=int(value[:-1]) * units[value[-1]])
+    parsed = ParseISO8601(value)
+    if parsed is None:
+        raise argparse.ArgumentTypeError("%s is neither an ISO 8601 time nor an age like 7d" % value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=TZManager.GetTZInfo())
+    return parsed
+
+
+def _iso(value):
+    return value.isoformat() if value is not None else None
+
+
+def _seconds(start, end):
+    if start is None or end is None:
+        return None
+    return round((end - start).total_seconds(), 3)
+
+
+def _argument(argument, attribute):
+    # (name, moId) of an event argument (vm, host, datacenter, ...)
+    if argument is None:
+        return None, None
+    obj = getattr(argument, attribute, None)
+    return argument.name, obj._moId if obj is not None else None
+
+
+def event_record(event):
+    vm, vm_moref = _argument(event.vm, 'vm')
+    host, _ = _argument(event.host, 'host')
+    info = getattr(event, 'info', None)
+    return dict(kind='event', key=event.key, chain=event.chainId, type=event._wsdlName,
+                time=_iso(event.createdTime), user=event.userName, vm=vm, vm_moref=vm_moref, host=host,
+                datacenter=_argument(event.datacenter, 'datacenter')[0], task=info.key if info else None,
+                message=event.fullFormattedMessage)
+
+
+def task_record(info):
+    error = None
+    if info.error is not None:
+        error = getattr(info.error, 'msg', None) or info.error.__class__.__name__
+    return dict(kind='task', key=info.key, type=info.descriptionId, entity=info.entityName,
+                entity_moref=info.entity._moId if info.entity is not None else None, state=info.state,
+                user=getattr(info.reason, 'userName', None), queued=_iso(info.queueTime),
+                started=_iso(info.startTime), completed=_iso(info.completeTime),
+                queue_seconds=_seconds(info.queueTime, info.startTime),
+                run_seconds=_seconds(info.startTime, info.completeTime), error=error)
+
+
+class Stream(object):
+    """Events or tasks read from one history collector.
+
+    :param kind: event or task
+    :param checkpoint: dict time, keys of the last run, records up to it are skipped
+    """
+
+    def __init__(self, si, kind, entity, users, begin, end, event_types=None, checkpoint=None):
+        self.si = si
+        self.kind = kind
+        self.checkpoint = checkpoint or dict(time=None, keys=[])
+        self.last = None
+        if self.checkpoint['time'] is not None:
+            # The checkpoint time itself is read again, its records seen are skipped by key
+            self.last = ParseISO8601(self.checkpoint['time'])
+            begin = self.last if begin is None or self.last > begin else begin
+        self.entity = entity
+        self.users = users
+        self.begin = begin
+        self.end = end
+        self.event_types = event_types
+
+    def _collector(self):
+        content = self.si.RetrieveContent()
+        recursion = 'self' if isinstance(self.entity, vim.VirtualMachine) else 'all'
+        if self.kind == 'event':
+            spec = vim.event.EventFilterSpec(
+                entity=vim.event.EventFilterSpec.ByEntity(entity=self.entity, recursion=recursion),
+                eventTypeId=self.event_types or None)
+            if self.begin is not None or self.end is not None:
+                spec.time = vim.event.EventFilterSpec.ByTime(beginTime=self.begin, endTime=self.end)
+            if self.users:
+                spec.userName = vim.event.EventFilterSpec.ByUsername(systemUser=False, userList=self.users)
+            collector = content.eventManager.CreateCollectorForEvents(spec)
+            return collector, collector.ReadNextEvents
+        spec = vim.TaskFilterSpec(entity=vim.TaskFilterSpec.ByEntity(entity=self.entity, recursion=recursion),
+                                  state=TASK_STATES)
+        if self.begin is not None or self.end is not None:
+            spec.time = vim.TaskFilterSpec.ByTime(timeType='completedTime', beginTime=self.begin, endTime=self.end)
+        if self.users:
+            spec.userName = vim.TaskFilterSpec.ByUsername(systemUser=False, userList=self.users)
+        collector = content.taskManager.CreateCollectorForTasks(spec)
+        return collector, collector.ReadNextTasks
+
+    def pages(self, page_size=PAGE_SIZE):
+        """Yield lists of records not seen by the last run, oldest first, one page read at a time.
+
+        self.checkpoint follows the records yielded.
+        """
+        collector, read_next = self._collector()
+        try:
+            collector.RewindCollector()
+            while True:
+                page = read_next(page_size)
+                if not page:
+                    return
+                records = []
+                for item in page:
+                    stamp = item.createdTime if self.kind == 'event' else item.completeTime
+                    if stamp == self.last and item.key in self.checkpoint['keys']:
+                        continue
+                    records.append(event_record(item) if self.kind == 'event' else task_record(item))
+                    if self.last is None or stamp > self.last:
+                        self.last = stamp
+                        self.checkpoint = dict(time=_iso(stamp), keys=[item.key])
+                    elif stamp == self.last:
+                        self.checkpoint['keys'].append(item.key)
+                yield records
+        finally:
+            collector.DestroyCollector()
+
+
+class TaskStats(object):
+    """Count, errors, mean and max queue / run seconds per type of task, in constant memory per type."""
+
+    def __init__(self):
+        self.types = dict()
+
+    def add(self, record):
+        stats = self.types.setdefault(record['type'], dict(count=0, errors=0, queue=[0, 0.0, 0.0],
+                                                           run=[0, 0.0, 0.0]))
+        stats['count'] += 1
+        if record['state'] == 'error':
+            stats['errors'] += 1
+        for name in ('queue', 'run'):
+            value = record[name + '_seconds']
+            if value is not None:
+                stats[name][0] += 1
+                stats[name][1] += value
+                stats[name][2] = max(stats[name][2], value)
+
+    def show(self):
+        print "%-40s %7s %6s %10s %10s %10s %10s" % ('TASK', 'COUNT', 'ERRORS', 'QUEUE AVG', 'QUEUE MAX',
+                                                     'RUN AVG', 'RUN MAX')
+        for name, stats in sorted(self.types.items()):
+            averages = [stats[k][1] / stats[k][0] if stats[k][0] else 0.0 for k in ('queue', 'run')]
+            print "%-40s %7d %6d %10.1f %10.1f %10.1f %10.1f" % (name, stats['count'], stats['errors'],
+                                                                 averages[0], stats['queue'][2],
+                                                                 averages[1], stats['run'][2])
+
+
+def _load_checkpoint(path, filters):
+    if not os.path.exists(path):
+        return dict(filters=filters, streams=dict())
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint['filters'] != filters:
+        sys.exit("%s was made with other filters, use another --output or --checkpoint" % path)
+    return checkpoint
+
+
+def _save_checkpoint(path, checkpoint):
+    # Renamed over the old one, a crash leaves either of them
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+
+def _wanted(record, names, match):
+    # VMs are filtered here, their history stays after they are destroyed
+    if not names and not match:
+        return True
+    name = (record['vm'] if record['kind'] == 'event' else record['entity']) or ''
+    return name.lower() in names or (match is not None and fnmatch.fnmatch(name.lower(), match.lower()))
+
+
+def export(si, output, checkpoint_path, kinds=('event', 'task'), datacenter=None, users=None, begin=None,
+           end=None, event_types=None, names=None, match=None, page_size=PAGE_SIZE, stats=None):
+    """Append events and ended tasks to a JSON lines file, from the checkpoint on.
+
+    Records of a page are written (and synced) before the checkpoint moves past them,
+    a crash at worst writes the last page again.
+
+    :param stats: TaskStats fed with the tasks written
+    :return: dict kind -> number of records written
+    """
+    content = si.RetrieveContent()
+    entity = content.rootFolder
+    if datacenter:
+        entity = [dc for dc in content.rootFolder.childEntity
+                  if isinstance(dc, vim.Datacenter) and dc.name == datacenter]
+        if not entity:
+            sys.exit("Datacenter %s not found" % datacenter)
+        entity = entity[0]
+    names = set(name.lower() for name in names or [])
+    filters = dict(datacenter=datacenter, users=sorted(users or []), event_types=sorted(event_types or []),
+                   names=sorted(names), match=match)
+    checkpoint = _load_checkpoint(checkpoint_path, filters)
+
+    written = dict()
+    with open(output, 'a') as out:
+        for kind in kinds:
+            written[kind] = 0
+            stream = Stream(si, kind, entity, users, begin, end, event_types if kind == 'event' else None,
+                            checkpoint['streams'].get(kind))
+            for records in stream.pages(page_size):
+                for record in records:
+                    if not _wanted(record, names, match):
+                        continue
+                    out.write(json.dumps(record, sort_keys=True) + '\n')
+                    written[kind] += 1
+                    if stats is not None and kind == 'task':
+                        stats.add(record)
+                out.flush()
+                os.fsync(out.fileno())
+                checkpoint['streams'][kind] = stream.checkpoint
+                _save_checkpoint(checkpoint_path, checkpoint)
+    return written
+
+
+def main(**kwargs):
+    try:
+        si = session.connect(host=kwargs['vserver'], user=kwargs['username'], pwd=kwargs['password'], port=int(kwargs['port']))
+    except IOError, e:
+        sys.exit("Unable to connect to vsphere server. Error message: %s" % e)
+
+    stats = TaskStats() if kwargs['stats'] else None
+    start = time.time()
+    try:
+        written = export(si, kwargs['output'], kwargs['checkpoint'] or kwargs['output'] + '.checkpoint',
+                         kinds=[kind.rstrip('s') for kind in kwargs['kind']], datacenter=kwargs['datacenter'],
+                         users=kwargs['user'], begin=kwargs['since'], end=kwargs['until'],
+                         event_types=kwargs['event_type'], names=kwargs['vmname'], match=kwargs['match'],
+                         page_size=kwargs['page_size'], stats=stats)
+    except vmodl.MethodFault, e:
+        sys.exit("History export failed: %s" % (getattr(e, 'msg', None) or e))
+    print "%s written to %s in %.1fs" % (', '.join('%d %ss' % (n, kind) for kind, n in sorted(written.items())),
+                                         kwargs['output'], time.time() - start)
+    if stats is not None:
+        stats.show()
+
+
+"""
+ Main program
+"""
+if __name__ == "__main__":
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser(description='Append vCenter events and task history to a JSON lines file')
+    parser.add_argument('--vserver', type=str, help='fqdn or ip addr for the vcenter', required=True)
+    parser.add_argument('--username', type=str, help='Username to use for login into vcenter', required=True)
+    parser.add_argument('--password', type=str, help='Username password', required=True)
+    parser.add_argument('--port', type=int, help='port for vCenter', default=443)
+    parser.add_argument('--output', type=str, help='JSON lines file records are appended to', required=True)
+    parser.add_argument('--checkpoint', type=str, help='Checkpoint file, OUTPUT.checkpoint by default')
+    parser.add_argument('--kind', type=str, help='What to read', nargs='+', choices=['events', 'tasks'], default=['events', 'tasks'])
+    parser.add_argument('--datacenter', type=str, help='Only history of this datacenter')
+    parser.add_argument('--user', type=str, help='Only actions of these vCenter users, separated by a space', nargs='+')
+    parser.add_argument('--vmname', type=str, help='Only history of these VMs, separated by a space', nargs='+', default=[])
+    parser.add_argument('--match', type=str, help='Only history of VMs whose name match this glob, e.g. "web*"')
+    parser.add_argument('--since', type=parse_time, help='Start time, ISO 8601 (UTC by default) or age like 7d, 12h')
+    parser.add_argument('--until', type=parse_time, help='End time, ISO 8601 or age')
+    parser.add_argument('--event-type', type=str, help='Only events of these types, e.g. VmClonedEvent VmRemovedEvent', nargs='+')
+    parser.add_argument('--page-size', type=int, help='Records read by each call', default=PAGE_SIZE)
+    parser.add_argument('--stats', help='Print queue and run seconds per type of task', action='store_true')
+
+    # Parse arguments and hand off to main()
+    args = parser.parse_args()
+    main(**vars(args))
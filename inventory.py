@@ -0,0 +1,310 @@
+"""
+Indexed name -> managed object lookup for vCenter inventory.
+
+Names of every object of the requested types are fetched in one paged
+PropertyCollector pass over a short lived ContainerView, then served from
+an in-process index until they expire or are invalidated.
+"""
+
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+
+# Seconds an index stays valid before it is fetched again
+DEFAULT_TTL = 300
+
+# Number of objects returned by each RetrievePropertiesEx page
+PAGE_SIZE = 1000
+
+
+def retrieve_properties(content, vimtypes, path_set, page_size=PAGE_SIZE, root=None, recursive=True):
+    """Retrieve properties of every object of the given types.
+
+    A ContainerView is created under root (rootFolder by default) and
+    destroyed once every page has been read.
+
+    :param content: ServiceContent of the connection
+    :param vimtypes: List of managed object types to collect
+    :param path_set: List of property paths to collect on each object
+    :param page_size: Max number of objects returned by each call
+    :param root: Folder/Datacenter to start from
+    :param recursive: Also objects of the subfolders, only direct children of root otherwise
+    :return: Generator of ObjectContent
+    """
+    if root is None:
+        root = content.rootFolder
+
+    view = content.viewManager.CreateContainerView(root, vimtypes, recursive)
+    try:
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view, skip=True, selectSet=[traversal])
+        prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=t, pathSet=list(path_set))
+                      for t in vimtypes]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[obj_spec], propSet=prop_specs)
+        options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+
+        collector = content.propertyCollector
+        result = collector.RetrievePropertiesEx([filter_spec], options)
+        while result is not None:
+            for obj_content in result.objects:
+                yield obj_content
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+    finally:
+        view.DestroyView()
+
+
+def retrieve_objects(content, objects, path_set, page_size=PAGE_SIZE):
+    """Retrieve properties of a known list of objects in one paged pass.
+
+    :param content: ServiceContent of the connection
+    :param objects: List of managed objects, path_set must exist on each of their types
+    :param path_set: List of property paths to collect on each object
+    :return: dict object -> dict property path -> value
+    """
+    if not objects:
+        return dict()
+
+    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=o) for o in objects]
+    types = list(set(type(o) for o in objects))
+    prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=t, pathSet=list(path_set))
+                  for t in types]
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=obj_specs, propSet=prop_specs)
+    return _collect(content, filter_spec, page_size)
+
+
+def retrieve_related(content, obj, related, path_sets, page_size=PAGE_SIZE):
+    """Retrieve properties of the objects another object refers to, in one paged pass.
+
+    e.g. hosts and datastores of a cluster:
+    retrieve_related(content, cluster, ['host', 'datastore'],
+                     {vim.HostSystem: ['name'], vim.Datastore: ['name']})
+
+    :param content: ServiceContent of the connection
+    :param obj: Managed object holding the references
+    :param related: List of properties of obj holding managed objects
+    :param path_sets: dict managed object type -> property paths to collect
+    :return: dict object -> dict property path -> value
+    """
+    selects = [vmodl.query.PropertyCollector.TraversalSpec(name=path, path=path, skip=False, type=type(obj))
+               for path in related]
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=True, selectSet=selects)
+    prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=t, pathSet=list(paths))
+                  for t, paths in path_sets.items()]
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[obj_spec], propSet=prop_specs)
+    return _collect(content, filter_spec, page_size)
+
+
+def find_vm_folder(content, path, datacenter=None):
+    """Find a VM folder by its path under the vm folder of a datacenter, or by name.
+
+    'prod/web' is looked up from the vm folder down, a bare name must match
+    a single VM folder. Folders of other datacenters are skipped when one is given.
+
+    :param content: ServiceContent of the connection
+    :param datacenter: vim.Datacenter to look in, every datacenter by default
+    :return: vim.Folder, None when nothing matches
+    :raise ValueError: When the path or name matches several folders
+    """
+    parts = [part for part in path.split('/') if part]
+    if len(parts) > 1:
+        if datacenter is not None:
+            roots = [datacenter.vmFolder]
+        else:
+            roots = [_prop(obj_content, 'vmFolder')
+                     for obj_content in retrieve_properties(content, [vim.Datacenter], ['vmFolder'])]
+        found = []
+        for folder in roots:
+            for part in parts:
+                folder = content.searchIndex.FindChild(folder, part)
+                if not isinstance(folder, vim.Folder):
+                    break
+            else:
+                found.append(folder)
+    else:
+        root = datacenter.vmFolder if datacenter is not None else None
+        found = [obj_content.obj for obj_content in retrieve_properties(content, [vim.Folder], ['name', 'childType'],
+                                                                         root=root)
+                 if _prop(obj_content, 'name') == path and 'VirtualMachine' in (_prop(obj_content, 'childType') or [])]
+    if len(found) > 1:
+        raise ValueError("Folder %s is ambiguous, %d folders match: give its path from the vm folder "
+                         "and/or its datacenter" % (path, len(found)))
+    return found[0] if found else None
+
+
+def _prop(obj_content, name):
+    for prop in obj_content.propSet:
+        if prop.name == name:
+            return prop.val
+    return None
+
+
+def _collect(content, filter_spec, page_size):
+    result = dict()
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    collector = content.propertyCollector
+    page = collector.RetrievePropertiesEx([filter_spec], options)
+    while page is not None:
+        for obj_content in page.objects:
+            result[obj_content.obj] = dict((p.name, p.val) for p in obj_content.propSet)
+        if not page.token:
+            break
+        page = collector.ContinueRetrievePropertiesEx(page.token)
+    return result
+
+
+def _types(vimtype):
+    # get_obj() historically took a list of types, accept both forms
+    if isinstance(vimtype, (list, tuple)):
+        return list(vimtype)
+    return [vimtype]
+
+
+class Inventory(object):
+    """In-process index of vCenter objects by name.
+
+    :param si: ServiceInstance connection
+    :param ttl: Seconds before an index is considered stale, None to never expire
+    :param page_size: Max number of objects returned by each RetrievePropertiesEx call
+    :param mirror: mirror.Mirror to read names from instead of vCenter, see verify()
+    """
+
+    def __init__(self, si, ttl=DEFAULT_TTL, page_size=PAGE_SIZE, mirror=None):
+        self.si = si
+        self.content = si.RetrieveContent()
+        self.ttl = ttl
+        self.page_size = page_size
+        self.mirror = mirror
+        self._index = dict()
+        self._lock = threading.Lock()
+
+    def _fresh(self, vimtype):
+        entry = self._index.get(vimtype)
+        if entry is None:
+            return False
+        if self.ttl is None:
+            return True
+        return time.time() - entry[0] < self.ttl
+
+    def prefetch(self, vimtypes):
+        """Fetch name indexes of several types in a single PropertyCollector pass.
+
+        Types already indexed and not expired are skipped.
+        """
+        with self._lock:
+            missing = [t for t in _types(vimtypes) if not self._fresh(t)]
+            if not missing:
+                return
+
+            names = dict((t, dict()) for t in missing)
+            if self.mirror is not None:
+                # Local read, objects handed out are checked by verify()
+                for t in missing:
+                    names[t] = self.mirror.names(self.si, t)
+                obj_contents = []
+            else:
+                obj_contents = retrieve_properties(self.content, missing, ['name'], self.page_size)
+            for obj_content in obj_contents:
+                name = None
+                for prop in obj_content.propSet:
+                    if prop.name == 'name':
+                        name = prop.val
+                if name is None:
+                    continue
+                for t in missing:
+                    if isinstance(obj_content.obj, t):
+                        # Keep the first match, like get_obj() did
+                        names[t].setdefault(name, obj_content.obj)
+
+            now = time.time()
+            for t in missing:
+                self._index[t] = (now, names[t])
+
+    def get_all(self, vimtype):
+        """Return a dict name -> object for the given type(s)."""
+        types = _types(vimtype)
+        while True:
+            self.prefetch(types)
+            with self._lock:
+                indexes = [self._index.get(t) for t in types]
+                # Dropped by invalidate() since prefetch(), fetched again
+                if None in indexes:
+                    continue
+                result = dict()
+                for _, names in reversed(indexes):
+                    result.update(names)
+                return result
+
+    def get(self, vimtype, name):
+        """Get the vsphere object associated with a given text name.
+
+        Drop-in replacement of get_obj(content, vimtype, name), returns None
+        when nothing matches.
+        """
+        types = _types(vimtype)
+        while True:
+            self.prefetch(types)
+            with self._lock:
+                indexes = [self._index.get(t) for t in types]
+                # Dropped by invalidate() since prefetch(), fetched again
+                if None in indexes:
+                    continue
+                for _, names in indexes:
+                    obj = names.get(name)
+                    if obj is not None:
+                        return obj
+                return None
+
+    def verify(self, found):
+        """Check objects read from the mirror against vCenter, in one call.
+
+        Call it before changing anything. When an object is missing, gone
+        or renamed, the mirror is dropped and next lookups go to vCenter.
+
+        :param found: List of (object returned by get(), name asked)
+        :return: True when every object is still there under the same name
+        """
+        mirror = self.mirror
+        if mirror is None:
+            return True
+        if None not in [obj for obj, _ in found] and not mirror.verify(self.si, dict(found)):
+            return True
+        self.drop_mirror()
+        return False
+
+    def drop_mirror(self):
+        """Forget what was read from the mirror, next lookups go to vCenter."""
+        with self._lock:
+            if self.mirror is not None:
+                self.mirror = None
+                self._index.clear()
+
+    def add(self, vimtype, name, obj):
+        """Record an object created by the script so it can be looked up without a refresh."""
+        with self._lock:
+            for t in _types(vimtype):
+                if t in self._index:
+                    self._index[t][1][name] = obj
+
+    def invalidate(self, vimtype=None, name=None):
+        """Drop cached entries.
+
+        With no argument the whole index is dropped, with only a type its
+        index is dropped, with a type and a name only that entry is removed.
+        """
+        with self._lock:
+            if vimtype is None:
+                self._index.clear()
+                return
+            for t in _types(vimtype):
+                if name is None:
+                    self._index.pop(t, None)
+                elif t in self._index:
+                    self._index[t][1].pop(name, None)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+Crash safe journal of the provisioning steps of each VM.
+
+clone() and create_vm() record each step once done (clone task, guest
+customization, VM creation, VMDK, ...) with the morefs it produced, in
+one SQLite file committed after every step. When the script is rerun
+for a VM whose last run did not finish, the steps recorded are skipped
+and their results reused, e.g. the VM of an interrupted clone. The steps
+of a VM are forgotten once its workflow ends, or as soon as one of their
+objects is gone from vCenter.
+
+A task is recorded as soon as it is submitted (clone, VM and VMDK
+creation): a rerun waits for it, or looks for what it made once vCenter
+forgot it (resume_task()).
+
+A rerun with settings changing the VM (template, CPUs, disks, VLANs, ...)
+does not resume: `journal.py --forget <name>` once the VM is destroyed.
+`journal.py --list` shows unfinished workflows.
+
+VSPHERE_JOURNAL=0 disables the journal, VSPHERE_JOURNAL_FILE overrides
+its path.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from pyVmomi import vim, vmodl, VmomiSupport
+
+import session
+from inventory import retrieve_objects
+from taskwait import get_waiter
+
+JOURNAL_FILE = os.environ.get('VSPHERE_JOURNAL_FILE',
+                              os.path.join(os.path.expanduser('~'), '.vsphere-api', 'journal.db'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    workflow TEXT NOT NULL,
+    vcenter TEXT NOT NULL,
+    name TEXT NOT NULL,
+    settings TEXT,
+    started REAL,
+    PRIMARY KEY (workflow, vcenter, name)
+);
+CREATE TABLE IF NOT EXISTS steps (
+    workflow TEXT NOT NULL,
+    vcenter TEXT NOT NULL,
+    name TEXT NOT NULL,
+    step TEXT NOT NULL,
+    result TEXT,
+    finished REAL,
+    PRIMARY KEY (workflow, vcenter, name, step)
+);
+"""
+
+_journal = []
+_journal_lock = threading.Lock()
+
+
+def enabled():
+    return os.environ.get('VSPHERE_JOURNAL', '1') not in ('0', 'no', 'false')
+
+
+class SettingsChanged(Exception):
+    """Raised when a VM has an unfinished run made with other settings."""
+
+
+def _encode(value):
+    # Managed objects are stored as {"moref": "<type>:<moId>"}
+    if isinstance(value, VmomiSupport.ManagedObject):
+        return dict(moref='%s:%s' % (value._wsdlName, value._moId))
+    if isinstance(value, dict):
+        return dict((k, _encode(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(si, value, found):
+    # found collects the managed objects decoded
+    if isinstance(value, dict):
+        if value.keys() == ['moref']:
+            wsdl_name, moid = value['moref'].split(':', 1)
+            obj = VmomiSupport.GetWsdlType('urn:vim25', wsdl_name)(moid, si._stub)
+            found.append(obj)
+            return obj
+        return dict((k, _decode(si, v, found)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_decode(si, v, found) for v in value]
+    return value
+
+
+def _fingerprint(settings):
+    return json.dumps(_encode(settings), sort_keys=True)
+
+
+class Journal(object):
+    """SQLite file of the steps done, shared by the threads of a process.
+
+    :param path: SQLite file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # Several scripts may write at once
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def runs(self):
+        """Unfinished runs, with the names of their steps done."""
+        with self.lock:
+            runs = [dict(row) for row in self.db.execute('SELECT * FROM runs ORDER BY started')]
+            for run in runs:
+                run['steps'] = [row['step'] for row in self.db.execute(
+                    'SELECT step FROM steps WHERE workflow = ? AND vcenter = ? AND name = ? ORDER BY finished',
+                    (run['workflow'], run['vcenter'], run['name']))]
+        return runs
+
+    def steps(self, workflow, vcenter, name):
+        with self.lock:
+            run = self.db.execute('SELECT settings FROM runs WHERE workflow = ? AND vcenter = ? AND name = ?',
+                                  (workflow, vcenter, name)).fetchone()
+            rows = self.db.execute('SELECT step, result FROM steps WHERE workflow = ? AND vcenter = ? AND name = ?',
+                                   (workflow, vcenter, name)).fetchall()
+        return (run['settings'] if run else None), dict((row['step'], json.loads(row['result'])) for row in rows)
+
+    def record(self, workflow, vcenter, name, settings, step, result):
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR IGNORE INTO runs (workflow, vcenter, name, settings, started) '
+                                'VALUES (?, ?, ?, ?, ?)', (workflow, vcenter, name, settings, time.time()))
+                self.db.execute('INSERT OR REPLACE INTO steps (workflow, vcenter, name, step, result, finished) '
+                                'VALUES (?, ?, ?, ?, ?, ?)',
+                                (workflow, vcenter, name, step, json.dumps(result), time.time()))
+
+    def forget(self, workflow, vcenter, name):
+        """Drop the steps of a run, return the number of runs dropped."""
+        where = 'name = ?'
+        params = [name]
+        for column, value in (('workflow', workflow), ('vcenter', vcenter)):
+            if value is not None:
+                where += ' AND %s = ?' % column
+                params.append(value)
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM steps WHERE ' + where, params)
+                return self.db.execute('DELETE FROM runs WHERE ' + where, params).rowcount
+
+
+def open_journal():
+    """Journal of the process, None when disabled."""
+    if not enabled():
+        return None
+    with _journal_lock:
+        if not _journal:
+            directory = os.path.dirname(JOURNAL_FILE)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+            _journal.append(Journal(JOURNAL_FILE))
+        return _journal[0]
+
+
+class Run(object):
+    """Steps of one workflow on one VM, recorded as they are done.
+
+    Does nothing when the journal is disabled.
+    """
+
+    def __init__(self, journal, si, workflow, vcenter, name, settings):
+        self.journal = journal
+        self.si = si
+        self.workflow = workflow
+        self.vcenter = vcenter
+        self.name = name
+        self.settings = settings
+        self.done = dict()
+
+    def get(self, step):
+        """Result of a step done by this run or an interrupted one, None when not done."""
+        return self.done.get(step)
+
+    def record(self, step, **result):
+        """Record a step as done, managed objects in result are stored as morefs."""
+        self.done[step] = result
+        if self.journal is not None:
+            self.journal.record(self.workflow, self.vcenter, self.name, self.settings, step, _encode(result))
+
+    def finish(self):
+        """Forget the steps once the workflow is complete."""
+        self.done = dict()
+        if self.journal is not None:
+            self.journal.forget(self.workflow, self.vcenter, self.name)
+
+
+def begin(si, workflow, name, settings):
+    """Start or resume the run of a workflow on a VM.
+
+    :param settings: dict of the settings the VM is made from, a run made with others is not resumed
+    :return: Run, with the steps of an interrupted run when their objects are all still there
+    :raise SettingsChanged: when an unfinished run of the VM was made with other settings
+    """
+    journal = open_journal()
+    endpoint = session.endpoint(si)
+    if journal is None or endpoint is None:
+        return Run(None, si, workflow, None, name, None)
+
+    vcenter = '%s:%s' % endpoint
+    fingerprint = _fingerprint(settings)
+    run = Run(journal, si, workflow, vcenter, name, fingerprint)
+    recorded, steps = journal.steps(workflow, vcenter, name)
+    if recorded is None:
+        return run
+    if recorded != fingerprint:
+        raise SettingsChanged("%s has an unfinished %s made with other settings, destroy it and run "
+                              "journal.py --forget %s" % (name, workflow, name))
+
+    found = []
+    steps = dict((step, _decode(si, result, found)) for step, result in steps.items())
+    try:
+        values = retrieve_objects(si.RetrieveContent(), found, ['name'])
+        gone = [obj._moId for obj in found if obj not in values]
+    except vmodl.fault.ManagedObjectNotFound, e:
+        gone = [e.obj._moId]
+    if gone:
+        print "%s of %s is gone, %s starts over" % (', '.join(gone), name, workflow)
+        journal.forget(workflow, vcenter, name)
+        return run
+    run.done = steps
+    return run
+
+
+def resume_task(si, moid, action_name='job'):
+    """Wait for a task submitted by an interrupted run, recorded by its moId.
+
+    :return: Ended TaskWatch, None once vCenter forgot the task
+    """
+    task = vim.Task(moid, si._stub)
+    try:
+        known = task in retrieve_objects(si.RetrieveContent(), [task], ['info.state'])
+    except vmodl.fault.ManagedObjectNotFound:
+        known = False
+    if not known:
+        return None
+    print "Waiting for the %s left by an interrupted run" % action_name
+    watch = get_waiter(si).watch([task])[0]
+    watch.wait()
+    if not watch.succeeded:
+        print '%s did not complete successfully: %s' % (action_name, watch.error)
+    return watch
+
+
+def main(**kwargs):
+    journal = open_journal()
+    if journal is None:
+        print "Journal disabled (VSPHERE_JOURNAL)"
+        return
+    if kwargs['forget']:
+        for name in kwargs['forget']:
+            print "%s: %d unfinished runs forgotten" % (name, journal.forget(kwargs['workflow'], kwargs['vcenter'], name))
+        return
+    print "%-40s %-10s %-25s %-19s  %s" % ('NAME', 'WORKFLOW', 'VCENTER', 'STARTED', 'STEPS DONE')
+    for run in journal.runs():
+        print "%-40s %-10s %-25s %-19s  %s" % (run['name'], run['workflow'], run['vcenter'],
+                                               time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['started'])),
+                                               ', '.join(run['steps']))
+
+
+"""
+ Main program
+"""
+if __name__ == "__main__":
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser(description='Show or forget unfinished provisioning runs')
+    parser.add_argument('--list', help='List unfinished runs (default)', action='store_true')
+    parser.add_argument('--forget', type=str, help='Names of VMs whose unfinished runs are dropped, separated by a space', nargs='+')
+    parser.add_argument('--workflow', type=str, help='Only forget runs of this workflow', choices=['clone', 'create_vm'])
+    parser.add_argument('--vcenter', type=str, help='Only forget runs on this vcenter (host:port)')
+
+    # Parse arguments and hand off to main()
+    args = parser.parse_args()
+    main(**vars(args))
@@ -1,38 +1,242 @@
+if __name__ == "__main__":
+    # Thin client of the warm agent when one listens (agent.py)
+    import agent
+    agent.delegate(__file__)
+
 import requests
-from pyVim.connect import SmartConnect, Disconnect
+import session
 from pyVmomi import vim, vmodl
-import atexit
 import sys
 import time
 import argparse
-import getpass
+from throttle import run_task
+from snapshots import SnapshotIndex
+from snapshots import RetentionPolicy
+from inventory import Inventory, find_vm_folder, retrieve_objects, retrieve_properties
+from bulk import run_parallel, print_summary, DEFAULT_PARALLEL
+import fnmatch
+import mirror
+import tracing
 
 # Disable SSL certificats check
 requests.packages.urllib3.disable_warnings()
 
-def WaitTask(task, actionName='job', hideResult=False):
-    #print 'Waiting for %s to complete.' % actionName
-    
-    while task.info.state == vim.TaskInfo.State.running:
-       time.sleep(2)
-    
-    if task.info.state == vim.TaskInfo.State.success:
-       if task.info.result is not None and not hideResult:
-          out = '%s completed successfully, result: %s' % (actionName, task.info.result)
-       else:
-          out = '%s completed successfully.' % actionName
+@tracing.traced('snapshot_create')
+def create_snapshots(si, vm, names, datastore=None):
+    date = time.strftime("%d/%m/%Y-%H:%M:%S")
+    description ="Snapshot from api %s" %date
+    for name in names:
+        print 'Create snapshot %s from api %s'%(name,date)
+        result = run_task(si, lambda: vm.CreateSnapshot(name, description, True, False), 'VM snapshot in progress',
+                          datastore=datastore, idempotent=False)
+
+
+@tracing.traced('snapshot_delete')
+def delete_snapshots(si, vm, names, recursive, datastore=None):
+    # Whole snapshot tree in one fetch, every branch is searched
+    tracing.phase('fetch')
+    index = SnapshotIndex.fetch(si, vm)
+    to_delete = list()
+    for name in names:
+        found = index.find(name)
+        if not found:
+            print "Snapshot %s not found" % name
+        to_delete.extend(found)
+
+    # Removals ordered and merged for the fewest consolidations
+    tracing.phase('remove')
+    return index.remove(si, to_delete, recursive, datastore)
+
+
+@tracing.traced('snapshot_list')
+def list_snapshots(si, vm):
+    index = SnapshotIndex.fetch(si, vm)
+    if len(index):
+        for snap in index.walk():
+            if snap.depth == 0:
+                print "snapshot : %s" % snap.name
+            else:
+                print "snapshot : %s > %s" % ("==" * snap.depth, snap.name)
+
     else:
-       out = '%s did not complete successfully: %s' % (actionName, task.info.error)
-       print out
-       raise task.info.error # should be a Fault... check XXX
-    
-    # may not always be applicable, but can't hurt.
-    return task.info.result
+        print "No snapshot."
+
+
+def _match(candidates, wanted, pattern):
+    # (object, properties) -> targets, names matched, notes by name. A name
+    # selects the VM of that name, else the VM of that DNS name; a name
+    # selecting several VMs is ambiguous and selects none
+    by_name, by_dns, targets = dict(), dict(), dict()
+    for obj, props in candidates:
+        name = props.get('name', '')
+        datastores = props.get('datastore') or []
+        target = dict(name=name, vm=obj, datastore=datastores[0]._moId if datastores else None)
+        if name.lower() in wanted:
+            by_name.setdefault(name.lower(), []).append(target)
+        dns_name = (props.get('guest.hostName') or '').lower()
+        if dns_name in wanted:
+            by_dns.setdefault(dns_name, []).append(target)
+        if pattern and fnmatch.fnmatch(name, pattern):
+            targets[obj._moId] = target
+
+    found = set()
+    notes = dict()
+    for wanted_name in wanted:
+        matches = by_name.get(wanted_name) or by_dns.get(wanted_name) or []
+        if len(matches) > 1:
+            notes[wanted_name] = "%s is ambiguous, it selects %s: none is taken" % (
+                wanted_name, ', '.join(sorted(target['name'] for target in matches)))
+            continue
+        if not matches:
+            continue
+        others = [target['name'] for target in by_dns.get(wanted_name, []) if target['vm'] != matches[0]['vm']]
+        if by_name.get(wanted_name) and others:
+            notes[wanted_name] = "%s is also the DNS name of %s, VM %s is taken" % (
+                wanted_name, ', '.join(sorted(others)), matches[0]['name'])
+        found.add(wanted_name)
+        targets[matches[0]['vm']._moId] = matches[0]
+    return targets.values(), found, notes
+
+
+"""
+ Resolve VMs by VM name or DNS name, and/or glob pattern on VM name,
+ from the local mirror when fresh (candidates are read back from vCenter
+ in one call), else with one bulk property retrieval over the whole inventory
+ Return the targets and the names not resolved (not found or ambiguous)
+"""
+@tracing.traced('resolve_vms')
+def resolve_vms(si, names, pattern=None):
+    wanted = set(name.lower() for name in names)
+    paths = ['name', 'guest.hostName', 'datastore']
+    content = si.RetrieveContent()
+    vms, found, notes = None, set(), dict()
+
+    local = mirror.open_for(si)
+    if local is not None:
+        candidates = [vm for vm, _ in local.find_vms(si, wanted, pattern)]
+        try:
+            vms, found, notes = _match(retrieve_objects(content, candidates, paths).items(), wanted, pattern)
+        except vmodl.fault.ManagedObjectNotFound:
+            vms = None
+        if vms is not None and wanted - found:
+            # Not found locally: maybe new or renamed, search vCenter
+            # (ambiguous too, the mirror may miss a VM of that name)
+            vms = None
+
+    if vms is None:
+        vms, found, notes = _match(((obj_content.obj, dict((p.name, p.val) for p in obj_content.propSet))
+                                    for obj_content in retrieve_properties(content, [vim.VirtualMachine], paths)),
+                                   wanted, pattern)
+
+    for name, note in sorted(notes.items()):
+        print note
+    unresolved = sorted(wanted - found)
+    for name in unresolved:
+        if name not in notes:
+            print "VM %s not found" % name
+    return sorted(vms, key=lambda v: v['name']), unresolved
+
+
+"""
+ Run the action on many VMs concurrently, capped per datastore
+"""
+@tracing.traced('fleet')
+def fleet(si, deploy_settings, recursive):
+    # Names not resolved make the run fail, the VMs found are still handled
+    targets, unresolved = resolve_vms(si, deploy_settings['vmname'], deploy_settings['match'])
+    if not targets:
+        sys.exit("No VM selected")
+
+    action = deploy_settings['action']
+    if action == 'list':
+        for target in targets:
+            print "vm : %s" % target['name']
+            list_snapshots(si, target['vm'])
+        return not unresolved
+
+    def worker(target):
+        if action == 'create':
+            return create_snapshots(si, target['vm'], deploy_settings['snapshot'], target['datastore'])
+        elif action == 'delete':
+            return delete_snapshots(si, target['vm'], deploy_settings['snapshot'], recursive, target['datastore'])
+        raise ValueError("No action %s" % action)
+
+    print "%s snapshot on %d VMs, %d at a time..." % (action.capitalize(), len(targets), deploy_settings['parallel'])
+    results = run_parallel(targets, worker, parallel=deploy_settings['parallel'],
+                           limits=[(lambda target: target['datastore'], deploy_settings['per_datastore'])])
+    print_summary(results, lambda target: target['name'])
+    if unresolved:
+        print "%d names not resolved: %s" % (len(unresolved), ' '.join(unresolved))
+
+    return not unresolved and not [r for r in results if r['status'] != 'ok']
+
+
+"""
+ Prune snapshots of every VM under a datacenter or folder following a
+ retention policy, from one paged retrieval of all snapshot trees
+"""
+@tracing.traced('prune')
+def prune(si, deploy_settings):
+    policy = RetentionPolicy(deploy_settings['max_age'], deploy_settings['keep'], deploy_settings['pattern'])
+
+    content = si.RetrieveContent()
+    inventory = Inventory(si)
+    root = None
+    datacenter = None
+    if deploy_settings['datacenter']:
+        datacenter = inventory.get(vim.Datacenter, deploy_settings['datacenter'])
+        if datacenter is None:
+            sys.exit("Datacenter %s not found" % deploy_settings['datacenter'])
+        root = datacenter.vmFolder
+    if deploy_settings['folder']:
+        # By path, or by a name no other VM folder has: never the wrong folder's VMs
+        try:
+            root = find_vm_folder(content, deploy_settings['folder'], datacenter)
+        except ValueError, e:
+            sys.exit(str(e))
+        if root is None:
+            sys.exit("Folder %s not found" % deploy_settings['folder'])
+
+    tracing.phase('retrieve')
+    plans = list()
+    for obj_content in retrieve_properties(content, [vim.VirtualMachine], ['name', 'datastore', 'snapshot'], root=root):
+        props = dict((p.name, p.val) for p in obj_content.propSet)
+        info = props.get('snapshot')
+        if info is None:
+            continue
+        index = SnapshotIndex(obj_content.obj, info.rootSnapshotList, info.currentSnapshot)
+        selected = policy.select(index)
+        if selected:
+            datastores = props.get('datastore') or []
+            plans.append(dict(name=props['name'], index=index, snapshots=selected,
+                              datastore=datastores[0]._moId if datastores else None))
+    plans.sort(key=lambda plan: plan['name'])
+
+    # Show the plan
+    for plan in plans:
+        print "vm : %s" % plan['name']
+        for snap in plan['snapshots']:
+            print "    remove %s (%s)" % (snap.name, snap.created.strftime("%d/%m/%Y-%H:%M:%S"))
+    print "%d snapshots to remove on %d VMs" % (sum(len(p['snapshots']) for p in plans), len(plans))
+
+    if deploy_settings['dry_run'] or not plans:
+        return True
+
+    tracing.phase('remove')
+
+    def worker(plan):
+        return plan['index'].remove(si, plan['snapshots'], datastore=plan['datastore'])
+
+    results = run_parallel(plans, worker, parallel=deploy_settings['parallel'],
+                           limits=[(lambda plan: plan['datastore'], deploy_settings['per_datastore'])])
+    print_summary(results, lambda plan: plan['name'])
+
+    return not [r for r in results if r['status'] != 'ok']
 
 
 def main(**kwargs):
     deploy_settings = dict()
-    deploy_settings["vmname"] = kwargs['vmname'].lower()
+    deploy_settings["vmname"] = [name.lower() for name in kwargs['vmname']]
     deploy_settings['vserver'] = kwargs['vserver']
     deploy_settings['username'] = kwargs['username']
     deploy_settings['password'] = kwargs['password']
@@ -40,23 +244,26 @@ def main(**kwargs):
     deploy_settings['action'] = kwargs['action']
     deploy_settings['snapshot'] = kwargs['snapshot']
     deploy_settings['recursive'] = kwargs['recursive']
+    deploy_settings['match'] = kwargs.get('match')
+    deploy_settings['parallel'] = kwargs.get('parallel') or DEFAULT_PARALLEL
+    deploy_settings['per_datastore'] = kwargs.get('per_datastore')
+    deploy_settings['datacenter'] = kwargs.get('datacenter')
+    deploy_settings['folder'] = kwargs.get('folder')
+    deploy_settings['max_age'] = kwargs.get('max_age')
+    deploy_settings['keep'] = kwargs.get('keep')
+    deploy_settings['pattern'] = kwargs.get('pattern')
+    deploy_settings['dry_run'] = kwargs.get('dry_run')
     
 
 
 
     # connect to vCenter server
     try:
-        si = SmartConnect(host=deploy_settings["vserver"], user=deploy_settings["username"], pwd=deploy_settings["password"], port=int(deploy_settings["port"]))
+        si = session.connect(host=deploy_settings["vserver"], user=deploy_settings["username"], pwd=deploy_settings["password"], port=int(deploy_settings["port"]))
     except IOError, e:
         sys.exit("Unable to connect to vsphere server. Error message: %s" % e)
         
-    # add a clean up routine
-    atexit.register(Disconnect, si)
-    
-    # Get VM object.
-    content = si.RetrieveContent()
-    vm = si.content.searchIndex.FindByDnsName(None, deploy_settings["vmname"], True)
-    
+    # Session is cached for next runs, so no logout at exit
 
     # Set recursive flag
     if deploy_settings['recursive'] == 'yes':
@@ -64,64 +271,33 @@ def main(**kwargs):
     else:
         recursive = False
 
-    if deploy_settings['action'] == 'create':
+    if deploy_settings['action'] == 'prune':
+        return prune(si, deploy_settings)
 
-        date = time.strftime("%d/%m/%Y-%H:%M:%S")
-        description ="Snapshot from api %s" %date
-        print 'Create snapshot %s from api %s'%(deploy_settings['snapshot'],date)
-        task = vm.CreateSnapshot(deploy_settings['snapshot'], description, True, False)
-        result = WaitTask(task, 'VM snapshot in progress')
+    # Several VMs or a pattern: fleet mode
+    if len(deploy_settings['vmname']) != 1 or deploy_settings['match']:
+        return fleet(si, deploy_settings, recursive)
+    
+    # Get VM object.
+    content = si.RetrieveContent()
+    vm = mirror.find_vm_by_dns_name(si, deploy_settings["vmname"][0])
+    if vm is None:
+        sys.exit("VM %s not found" % deploy_settings["vmname"][0])
 
-    elif deploy_settings['action'] == 'delete':
-        rootSnapshot = vm.snapshot.rootSnapshotList[0]
-        if rootSnapshot.name ==  deploy_settings['snapshot'] :
-                print "Delete %s"%deploy_settings['snapshot'] 
-                task = rootSnapshot.snapshot.RemoveSnapshot_Task(recursive)
-                result = WaitTask(task, 'Deleting snapshot')
-        
-        # Getting throught the snapshot tree
-        
-        for i in range(0, len(rootSnapshot.childSnapshotList)):
-            child = rootSnapshot.childSnapshotList[i]
-            if child.name ==  deploy_settings['snapshot'] :
-                print "Delete %s"%deploy_settings['snapshot']
-                task = child.snapshot.RemoveSnapshot_Task(recursive)
-                result = WaitTask(task, 'Deleting snapshot')
-            
-            while len(child.childSnapshotList) > 0:
-                child = child.childSnapshotList[0]
-                if child.name ==  deploy_settings['snapshot'] :
-                    print "Delete %s"%deploy_settings['snapshot'] 
-                    print type(child.snapshot)
-                    snapshot = child.snapshot
-                    print snapshot
-                    task = snapshot.RemoveSnapshot_Task(recursive)
-                    result = WaitTask(task, 'Deleting snapshot')
-                
+    if deploy_settings['action'] == 'create':
+        create_snapshots(si, vm, deploy_settings['snapshot'])
 
+    elif deploy_settings['action'] == 'delete':
+        delete_snapshots(si, vm, deploy_settings['snapshot'], recursive)
 
     elif deploy_settings['action'] == 'list':
-        
-        if vm.snapshot is not None:
-            rootSnapshot = vm.snapshot.rootSnapshotList[0]
-            print "snapshot : %s"%(rootSnapshot.name)
-        
-            # Getting throught the snapshot tree
-            indent = "=="
-            for i in range(0, len(rootSnapshot.childSnapshotList)):
-                child = rootSnapshot.childSnapshotList[i]
-                print "snapshot : %s > %s" %(indent,child.name)
-                indent = indent + "=="
-                while len(child.childSnapshotList) > 0:
-                    child = child.childSnapshotList[0]
-                    print "snapshot : %s > %s" %(indent,child.name)
-                    indent = indent + "=="
-
-        else:
-            print "No snapshot."
+        list_snapshots(si, vm)
+
     else:
         print "No action"
 
+    return True
+
 
 
 
@@ -137,12 +313,27 @@ if __name__ == "__main__":
     parser.add_argument('--username', type=str, help='Username to use for login into vcenter', required=True)
     parser.add_argument('--password', type=str, help='Username password', required=True)
     parser.add_argument('--port', type=int, help='port for vCenter', default=443)
-    parser.add_argument('--vmname', type=str, help='Name of VM', required=True)
-    parser.add_argument('--action', type=str, help='Action to do : [create|delete|list]', default='create')
-    parser.add_argument('--snapshot', type=str, help='Name of snapshot', default='mysnapshot')
+    parser.add_argument('--vmname', type=str, help='Names of VMs, separated by a space', nargs='+', default=[])
+    parser.add_argument('--match', type=str, help='Glob pattern on VM names, e.g. "web*"')
+    parser.add_argument('--action', type=str, help='Action to do : [create|delete|list|prune]', default='create')
+    parser.add_argument('--snapshot', type=str, help='Name of snapshots, separated by a space', nargs='+', default=['mysnapshot'])
     parser.add_argument('--recursive', type=str, help='[yes|no] Recursive delete', default='no')
+    parser.add_argument('--parallel', type=int, help='Max number of VMs handled at once with several VMs', default=DEFAULT_PARALLEL)
+    parser.add_argument('--datacenter', type=str, help='Datacenter to prune')
+    parser.add_argument('--folder', type=str, help='VM folder to prune, a path from the vm folder (prod/web) or a name matching one folder')
+    parser.add_argument('--max-age', type=int, help='Prune snapshots older than this number of days')
+    parser.add_argument('--keep', type=int, help='Prune all but the newest snapshots, per VM')
+    parser.add_argument('--pattern', type=str, help='Only prune snapshots whose name or description match this glob, e.g. "Snapshot from api*"')
+    parser.add_argument('--dry-run', help='Only show what prune would remove', action='store_true')
+    parser.add_argument('--per-datastore', type=int, help='Max number of snapshot tasks at once on one datastore, 0 for no limit', default=2)
 
     
     # Parse arguments and hand off to main()
     args = parser.parse_args()
-    main(**vars(args))
\ No newline at end of file
+    if args.action == 'prune':
+        if args.max_age is None and args.keep is None:
+            parser.error('prune needs --max-age and/or --keep')
+    elif not args.vmname and not args.match:
+        parser.error('--vmname or --match is required')
+    if not main(**vars(args)):
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""
+Local SQLite mirror of the vCenter inventory.
+
+`mirror.py --vserver ... ` keeps one SQLite file per vCenter current: a
+full pass when it starts, then only the changes, following the version
+tokens of WaitForUpdatesEx on a private PropertyCollector. It records
+name and moref of every object, plus DNS name, IP, vmx path, power state
+and a snapshot summary of VMs.
+
+Scripts open the mirror only when the sync is running (updated within
+MAX_AGE seconds) and resolve names locally; objects found there are
+checked against vCenter in one call before anything is changed.
+
+VSPHERE_MIRROR=0 disables the mirror for the scripts, VSPHERE_MIRROR_DIR
+overrides where the files are kept and VSPHERE_MIRROR_MAX_AGE how old a
+mirror can be (e.g. with --once from cron).
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from pyVmomi import vim, vmodl, VmomiSupport
+
+import session
+from inventory import retrieve_objects, PAGE_SIZE
+
+MIRROR_DIR = os.environ.get('VSPHERE_MIRROR_DIR',
+                            os.path.join(os.path.expanduser('~'), '.vsphere-api', 'mirror'))
+
+# Seconds WaitForUpdatesEx waits for changes, the mirror is marked synced at least this often
+WAIT_SECONDS = 30
+
+# Seconds after its last sync a mirror is not used anymore
+MAX_AGE = int(os.environ.get('VSPHERE_MIRROR_MAX_AGE', 120))
+
+# Properties mirrored for each type, subtypes included (DVS portgroups are Networks)
+PROPERTIES = [
+    (vim.VirtualMachine, ['name', 'guest.hostName', 'guest.ipAddress', 'config.files.vmPathName',
+                          'runtime.powerState', 'config.template', 'snapshot']),
+    (vim.Datacenter, ['name']),
+    (vim.ClusterComputeResource, ['name']),
+    (vim.HostSystem, ['name']),
+    (vim.Datastore, ['name']),
+    (vim.Network, ['name']),
+    (vim.ResourcePool, ['name']),
+    (vim.Folder, ['name']),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    moref TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    name TEXT,
+    dns_name TEXT,
+    ip TEXT,
+    vmx TEXT,
+    power_state TEXT,
+    template INTEGER,
+    snapshots INTEGER,
+    current_snapshot TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_name ON objects (type, name);
+CREATE INDEX IF NOT EXISTS objects_dns_name ON objects (dns_name);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Max number of SQL parameters in one query
+CHUNK = 500
+
+_mirrors = dict()
+_mirrors_lock = threading.Lock()
+
+
+def enabled():
+    return os.environ.get('VSPHERE_MIRROR', '1') not in ('0', 'no', 'false')
+
+
+def mirror_path(host, port=443):
+    key = hashlib.sha1('%s:%s' % (host, int(port))).hexdigest()
+    return os.path.join(MIRROR_DIR, key + '.db')
+
+
+def _columns(name, val):
+    # Mirrored property -> columns of the objects table
+    if name == 'name':
+        return dict(name=val)
+    if name == 'guest.hostName':
+        return dict(dns_name=val.lower() if val else None)
+    if name == 'guest.ipAddress':
+        return dict(ip=val)
+    if name == 'config.files.vmPathName':
+        return dict(vmx=val)
+    if name == 'runtime.powerState':
+        return dict(power_state=val)
+    if name == 'config.template':
+        return dict(template=1 if val else 0)
+    if name == 'snapshot':
+        count, trees = 0, list(val.rootSnapshotList or []) if val else []
+        current = None
+        while trees:
+            tree = trees.pop()
+            count += 1
+            trees.extend(tree.childSnapshotList or [])
+            if val.currentSnapshot is not None and tree.snapshot._moId == val.currentSnapshot._moId:
+                current = tree.name
+        return dict(snapshots=count, current_snapshot=current)
+    return dict()
+
+
+class Mirror(object):
+    """SQLite inventory mirror of one vCenter, shared by the threads of a process.
+
+    :param path: SQLite file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # Readers are not blocked by the sync writing
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self._types = dict()
+
+    def state(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else None
+
+    def set_state(self, **values):
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                                [(k, str(v)) for k, v in values.items()])
+
+    def age(self):
+        """Seconds since the last sync, None when no full pass completed."""
+        if self.state('ready') != '1':
+            return None
+        return time.time() - float(self.state('synced_at') or 0)
+
+    # Sync side
+
+    def apply(self, filter_set, seen=None):
+        """Write the object updates of a WaitForUpdatesEx result.
+
+        :param seen: Set the morefs entered or modified are added to
+        :return: Number of objects changed
+        """
+        changed = 0
+        with self.lock, self.db:
+            for filter_update in filter_set:
+                for obj_update in filter_update.objectSet:
+                    moref = obj_update.obj._moId
+                    if obj_update.kind == 'leave':
+                        self.db.execute('DELETE FROM objects WHERE moref = ?', (moref,))
+                        changed += 1
+                        continue
+                    if seen is not None:
+                        seen.add(moref)
+                    columns = dict()
+                    for change in obj_update.changeSet or []:
+                        val = change.val if change.op in ('add', 'assign') else None
+                        columns.update(_columns(change.name, val))
+                    self.db.execute('INSERT OR IGNORE INTO objects (moref, type) VALUES (?, ?)',
+                                    (moref, obj_update.obj._wsdlName))
+                    if columns:
+                        names = sorted(columns)
+                        self.db.execute('UPDATE objects SET %s WHERE moref = ?' %
+                                        ', '.join('%s = ?' % c for c in names),
+                                        [columns[c] for c in names] + [moref])
+                    changed += 1
+        return changed
+
+    def keep_only(self, morefs):
+        """Delete objects not seen during a full pass."""
+        with self.lock, self.db:
+            known = [row['moref'] for row in self.db.execute('SELECT moref FROM objects')]
+            gone = [(m,) for m in known if m not in morefs]
+            self.db.executemany('DELETE FROM objects WHERE moref = ?', gone)
+        return len(gone)
+
+    # Script side
+
+    def _object(self, si, row):
+        wsdl_name = row['type']
+        if wsdl_name not in self._types:
+            self._types[wsdl_name] = VmomiSupport.GetWsdlType('urn:vim25', wsdl_name)
+        return self._types[wsdl_name](row['moref'], si._stub)
+
+    def _wsdl_names(self, vimtype):
+        # Stored type names of vimtype and its subtypes
+        with self.lock:
+            stored = [row['type'] for row in self.db.execute('SELECT DISTINCT type FROM objects')]
+        return [name for name in stored
+                if issubclass(VmomiSupport.GetWsdlType('urn:vim25', name), vimtype)]
+
+    def names(self, si, vimtype):
+        """Return a dict name -> object of a type, without any round trip."""
+        result = dict()
+        wsdl_names = self._wsdl_names(vimtype)
+        if not wsdl_names:
+            return result
+        with self.lock:
+            rows = self.db.execute('SELECT moref, type, name FROM objects WHERE type IN (%s) ORDER BY moref' %
+                                   ','.join('?' * len(wsdl_names)), wsdl_names).fetchall()
+        for row in rows:
+            if row['name'] is not None:
+                result.setdefault(row['name'], self._object(si, row))
+        return result
+
+    def find_vms(self, si, names=None, pattern=None):
+        """Return (object, row) of VMs whose DNS name or name is in names, or name matches pattern."""
+        names = [n.lower() for n in names or []]
+        rows = []
+        with self.lock:
+            for start in range(0, len(names), CHUNK):
+                chunk = names[start:start + CHUNK]
+                marks = ','.join('?' * len(chunk))
+                rows.extend(self.db.execute(
+                    "SELECT * FROM objects WHERE type = 'VirtualMachine' AND "
+                    "(dns_name IN (%s) OR lower(name) IN (%s))" % (marks, marks), chunk + chunk))
+            if pattern:
+                rows.extend(self.db.execute(
+                    "SELECT * FROM objects WHERE type = 'VirtualMachine' AND name GLOB ?", (pattern,)))
+        unique = dict((row['moref'], row) for row in rows)
+        return [(self._object(si, row), dict(row)) for _, row in sorted(unique.items())]
+
+    def verify(self, si, expected, path='name'):
+        """Check objects resolved locally against vCenter in one call.
+
+        :param expected: dict object -> expected value of path (compared without case)
+        :return: Set of objects gone or whose value changed, removed from the mirror
+        """
+        objects = list(expected)
+        stale = set()
+        while objects:
+            try:
+                values = retrieve_objects(si.RetrieveContent(), objects, [path], PAGE_SIZE)
+            except vmodl.fault.ManagedObjectNotFound, e:
+                # One object is gone, check the others again without it
+                gone = [o for o in objects if o._moId == e.obj._moId]
+                if not gone:
+                    raise
+                stale.update(gone)
+                objects = [o for o in objects if o._moId != e.obj._moId]
+                continue
+            for obj in objects:
+                value = values.get(obj, dict()).get(path)
+                if (value or '').lower() != (expected[obj] or '').lower():
+                    stale.add(obj)
+            break
+
+        if stale:
+            with self.lock, self.db:
+                self.db.executemany('DELETE FROM objects WHERE moref = ?', [(o._moId,) for o in stale])
+        return stale
+
+
+def open_for(si, max_age=None):
+    """Return the mirror of the vCenter of a session when enabled and fresh, else None."""
+    if not enabled():
+        return None
+    endpoint = session.endpoint(si)
+    if endpoint is None:
+        return None
+    path = mirror_path(*endpoint)
+    if not os.path.exists(path):
+        return None
+    with _mirrors_lock:
+        if path not in _mirrors:
+            _mirrors[path] = Mirror(path)
+        local = _mirrors[path]
+    age = local.age()
+    if age is None or age > (max_age or MAX_AGE):
+        return None
+    return local
+
+
+def find_vm_by_dns_name(si, dns_name):
+    """FindByDnsName answered by the mirror when fresh, checked in one call."""
+    local = open_for(si)
+    if local is not None:
+        found = [obj for obj, row in local.find_vms(si, [dns_name]) if row['dns_name'] == dns_name.lower()]
+        if len(found) == 1 and not local.verify(si, {found[0]: dns_name}, 'guest.hostName'):
+            return found[0]
+    return si.content.searchIndex.FindByDnsName(None, dns_name, True)
+
+
+def sync(si, local, once=False, wait=WAIT_SECONDS):
+    """Fill the mirror with a full pass, then apply changes as they come.
+
+    :param once: Return after the full pass
+    :param wait: Max seconds of each WaitForUpdatesEx call
+    """
+    content = si.RetrieveContent()
+    view = content.viewManager.CreateContainerView(content.rootFolder, [t for t, _ in PROPERTIES], True)
+    collector = content.propertyCollector.CreatePropertyCollector()
+    try:
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+        prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=t, pathSet=paths)
+                      for t, paths in PROPERTIES]
+        collector.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[obj_spec], propSet=prop_specs), partialUpdates=False)
+
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=wait, maxObjectUpdates=PAGE_SIZE)
+        version = ''
+        seen = set()
+        full_pass = True
+        local.set_state(ready=0)
+        while True:
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is not None:
+                changed = local.apply(update.filterSet, seen if full_pass else None)
+                version = update.version
+                if update.truncated:
+                    continue
+                if not full_pass:
+                    print "%s %d objects changed (version %s)" % (time.strftime('%H:%M:%S'), changed, version)
+            if full_pass:
+                # Drop objects deleted while no sync was running
+                gone = local.keep_only(seen)
+                print "Full pass: %d objects, %d removed (version %s)" % (len(seen), gone, version)
+                full_pass = False
+                local.set_state(ready=1)
+            local.set_state(synced_at=time.time(), version=version)
+            if once:
+                return
+    finally:
+        collector.DestroyPropertyCollector()
+        view.DestroyView()
+
+
+def main(**kwargs):
+    try:
+        si = session.connect(host=kwargs['vserver'], user=kwargs['username'], pwd=kwargs['password'], port=int(kwargs['port']))
+    except IOError, e:
+        sys.exit("Unable to connect to vsphere server. Error message: %s" % e)
+
+    if not os.path.isdir(MIRROR_DIR):
+        os.makedirs(MIRROR_DIR, 0700)
+    local = Mirror(mirror_path(kwargs['vserver'], kwargs['port']))
+    print "Mirror of %s in %s" % (kwargs['vserver'], local.path)
+    sync(si, local, once=kwargs['once'], wait=kwargs['wait'])
+
+
+"""
+ Main program
+"""
+if __name__ == "__main__":
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser(description='Keep a local SQLite mirror of the vCenter inventory')
+    parser.add_argument('--vserver', type=str, help='fqdn or ip addr for the vcenter', required=True)
+    parser.add_argument('--username', type=str, help='Username to use for login into vcenter', required=True)
+    parser.add_argument('--password', type=str, help='Username password', required=True)
+    parser.add_argument('--port', type=int, help='port for vCenter', default=443)
+    parser.add_argument('--once', help='Exit after the full pass instead of following changes', action='store_true')
+    parser.add_argument('--wait', type=int, help='Max seconds each wait for changes lasts', default=WAIT_SECONDS)
+
+    # Parse arguments and hand off to main()
+    args = parser.parse_args()
+    try:
+        main(**vars(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,179 @@
+"""
+Load aware placement of new VMs on a cluster.
+
+Free space, capacity and provisioned space of the cluster datastores and
+CPU / memory usage of its hosts are fetched in one bulk property
+retrieval. Each VM goes to the least loaded host and the datastore left
+with the most free space among those mounted on that host, and what is handed out is tracked (with a small
+handicap per VM placed), so a batch of VMs is spread instead of piling up
+on the best candidate of the start.
+"""
+
+import fnmatch
+
+from pyVmomi import vim
+
+from inventory import retrieve_related
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+# Datastores are not filled below this ratio of free space
+MIN_FREE_RATIO = 0.10
+
+# Max provisioned / capacity ratio of a datastore (thin provisioning overcommit)
+MAX_PROVISIONED_RATIO = 1.5
+
+# Max CPU or memory usage ratio of a host
+MAX_HOST_USAGE = 0.90
+
+# Share of a physical core a new vCPU is expected to use
+VCPU_LOAD = 0.25
+
+# Score handicap per VM already placed on a candidate in the batch, so
+# candidates with close loads share the batch (and its provisioning I/O)
+SPREAD_WEIGHT = 0.02
+
+HOST_PROPERTIES = ['name', 'runtime.connectionState', 'runtime.inMaintenanceMode',
+                   'summary.hardware.cpuMhz', 'summary.hardware.numCpuCores',
+                   'summary.hardware.memorySize', 'summary.quickStats.overallCpuUsage',
+                   'summary.quickStats.overallMemoryUsage', 'datastore']
+
+DATASTORE_PROPERTIES = ['name', 'summary.accessible', 'summary.maintenanceMode', 'summary.capacity',
+                        'summary.freeSpace', 'summary.uncommitted']
+
+
+class NoCandidate(Exception):
+    """Raised when no host or datastore of the cluster can take a VM."""
+
+
+class Placement(object):
+    """Choose hosts and datastores of a cluster for new VMs.
+
+    :param si: ServiceInstance
+    :param cluster: vim.ClusterComputeResource, or the vim.ComputeResource of a standalone host
+    :param datastore_pattern: Glob on the names of datastores to use, all by default
+    """
+
+    def __init__(self, si, cluster, datastore_pattern=None, min_free_ratio=MIN_FREE_RATIO,
+                 max_provisioned_ratio=MAX_PROVISIONED_RATIO, max_host_usage=MAX_HOST_USAGE):
+        self.si = si
+        self.cluster = cluster
+        self.datastore_pattern = datastore_pattern
+        self.min_free_ratio = min_free_ratio
+        self.max_provisioned_ratio = max_provisioned_ratio
+        self.max_host_usage = max_host_usage
+        self.refresh()
+
+    def refresh(self):
+        """Fetch hosts and datastores load again and forget assignments."""
+        objects = retrieve_related(self.si.RetrieveContent(), self.cluster, ['host', 'datastore'],
+                                   {vim.HostSystem: HOST_PROPERTIES, vim.Datastore: DATASTORE_PROPERTIES})
+        self.hosts = dict()
+        self.datastores = dict()
+        for obj, props in objects.items():
+            if isinstance(obj, vim.HostSystem):
+                usable = (props.get('runtime.connectionState') == 'connected' and
+                          not props.get('runtime.inMaintenanceMode'))
+                self.hosts[props['name']] = dict(
+                    obj=obj, name=props['name'], usable=usable,
+                    cpu_capacity=(props.get('summary.hardware.cpuMhz') or 0) *
+                                 (props.get('summary.hardware.numCpuCores') or 0),
+                    cpu_used=props.get('summary.quickStats.overallCpuUsage') or 0,
+                    mem_capacity=(props.get('summary.hardware.memorySize') or 0) / MB,
+                    mem_used=props.get('summary.quickStats.overallMemoryUsage') or 0,
+                    core_mhz=props.get('summary.hardware.cpuMhz') or 0,
+                    mounted=props.get('datastore') or [], assigned_cpu=0, assigned_mem=0, vms=0)
+            else:
+                name = props['name']
+                usable = (props.get('summary.accessible', False) and
+                          props.get('summary.maintenanceMode', 'normal') == 'normal' and
+                          (not self.datastore_pattern or fnmatch.fnmatch(name, self.datastore_pattern)))
+                self.datastores[name] = dict(
+                    obj=obj, name=name, usable=usable,
+                    capacity=props.get('summary.capacity') or 0,
+                    free=props.get('summary.freeSpace') or 0,
+                    uncommitted=props.get('summary.uncommitted') or 0,
+                    assigned=0, vms=0)
+        # Names of the datastores mounted on each host
+        names = dict((d['obj']._moId, name) for name, d in self.datastores.items())
+        for host in self.hosts.values():
+            host['datastores'] = set(names[d._moId] for d in host.pop('mounted') if d._moId in names)
+
+    def host_load(self, host, cpus=0, mem_mb=0):
+        """Usage ratio (CPU or memory, the highest) of a host once given a VM."""
+        if not host['cpu_capacity'] or not host['mem_capacity']:
+            return None
+        cpu = host['cpu_used'] + host['assigned_cpu'] + cpus * VCPU_LOAD * host['core_mhz']
+        mem = host['mem_used'] + host['assigned_mem'] + mem_mb
+        return max(float(cpu) / host['cpu_capacity'], float(mem) / host['mem_capacity'])
+
+    def datastore_free(self, datastore, size=0):
+        """Free space ratio of a datastore once given size bytes, None when over limits."""
+        if not datastore['capacity']:
+            return None
+        free = datastore['free'] - datastore['assigned'] - size
+        provisioned = datastore['capacity'] - free + datastore['uncommitted']
+        if (free < self.min_free_ratio * datastore['capacity'] or
+                provisioned > self.max_provisioned_ratio * datastore['capacity']):
+            return None
+        return float(free) / datastore['capacity']
+
+    def place(self, size, cpus=1, mem_mb=1024, host=None, datastore=None):
+        """Choose host and datastore of one VM and account for it.
+
+        :param size: Bytes the VM takes on its datastore
+        :param host: Host name to keep instead of choosing one
+        :param datastore: Datastore name to keep instead of choosing one
+        :return: (host name, datastore name)
+        """
+        frees = [(self.datastore_free(d, size), d['vms'], name) for name, d in self.datastores.items() if d['usable']]
+        frees = dict((name, free - vms * SPREAD_WEIGHT) for free, vms, name in frees if free is not None)
+        if host is None:
+            # Only hosts mounting the kept datastore, or one that can take the VM
+            loads = [(self.host_load(h, cpus, mem_mb), h['vms'], name) for name, h in self.hosts.items()
+                     if h['usable'] and (datastore in h['datastores'] if datastore is not None
+                                         else h['datastores'].intersection(frees))]
+            loads = sorted((load + vms * SPREAD_WEIGHT, name) for load, vms, name in loads
+                           if load is not None and load <= self.max_host_usage)
+            if not loads:
+                raise NoCandidate("No host of %s %s can take %d vCPU / %d MB" % (
+                    self.cluster.name, "mounting %s" % datastore if datastore is not None else "with a datastore left",
+                    cpus, mem_mb))
+            host = loads[0][1]
+        if datastore is None:
+            if host in self.hosts:
+                frees = dict((name, free) for name, free in frees.items() if name in self.hosts[host]['datastores'])
+            if not frees:
+                raise NoCandidate("No datastore of %s mounted on %s can take %.1f GB" % (
+                    self.cluster.name, host, float(size) / GB))
+            datastore = max((free, name) for name, free in frees.items())[1]
+        elif host in self.hosts and datastore not in self.hosts[host]['datastores']:
+            raise NoCandidate("Datastore %s is not mounted on %s" % (datastore, host))
+
+        if host in self.hosts:
+            chosen = self.hosts[host]
+            chosen['assigned_cpu'] += cpus * VCPU_LOAD * chosen['core_mhz']
+            chosen['assigned_mem'] += mem_mb
+            chosen['vms'] += 1
+        if datastore in self.datastores:
+            self.datastores[datastore]['assigned'] += size
+            self.datastores[datastore]['vms'] += 1
+        return host, datastore
+
+    def print_summary(self):
+        """Print load of every candidate with what was assigned to it."""
+        print "%-30s %6s %6s %4s" % ('HOST', 'CPU%', 'MEM%', 'VMS')
+        for name, host in sorted(self.hosts.items()):
+            if host['usable'] and host['cpu_capacity'] and host['mem_capacity']:
+                print "%-30s %6.1f %6.1f %4d" % (
+                    name, 100.0 * (host['cpu_used'] + host['assigned_cpu']) / host['cpu_capacity'],
+                    100.0 * (host['mem_used'] + host['assigned_mem']) / host['mem_capacity'], host['vms'])
+        print "%-30s %9s %6s %4s" % ('DATASTORE', 'FREE(GB)', 'PROV%', 'VMS')
+        for name, datastore in sorted(self.datastores.items()):
+            if datastore['usable'] and datastore['capacity']:
+                free = datastore['free'] - datastore['assigned']
+                print "%-30s %9.1f %6.1f %4d" % (
+                    name, float(free) / GB,
+                    100.0 * (datastore['capacity'] - free + datastore['uncommitted']) / datastore['capacity'],
+                    datastore['vms'])
@@ -0,0 +1,159 @@
+"""
+Readiness probes for guest operations.
+
+wait_for_guest() follows guest.toolsRunningStatus/guest.guestOperationsReady
+through PropertyCollector updates instead of sleeping a fixed time,
+wait_for_customization() follows the customization events of a VM the
+same way, and wait_for_process() follows a program started in the guest
+until it exits and returns its real exit code.
+"""
+
+import time
+
+from pyVmomi import vim, vmodl
+
+# Seconds to wait for VMware tools after power on
+GUEST_TIMEOUT = 600
+
+# Seconds to wait for a guest program to exit
+PROCESS_TIMEOUT = 1800
+
+# Seconds to wait for a customization spec to be applied (includes a guest reboot)
+CUSTOMIZATION_TIMEOUT = 1200
+
+CUSTOMIZATION_EVENTS = ['CustomizationSucceeded', 'CustomizationFailed',
+                        'CustomizationLinuxIdentityFailed', 'CustomizationNetworkSetupFailed',
+                        'CustomizationSysprepFailed', 'CustomizationUnknownFailure']
+
+
+class GuestTimeout(Exception):
+    """Raised when the guest does not reach the expected state in time."""
+
+
+class CustomizationFailed(Exception):
+    """Raised when the guest reports its customization failed."""
+
+
+def _guest_ready(state):
+    return (state.get('guest.toolsRunningStatus') == 'guestToolsRunning' and
+            state.get('guest.guestOperationsReady') is True)
+
+
+def wait_for_guest(si, vm, timeout=GUEST_TIMEOUT):
+    """Block until VMware tools run and guest operations are ready.
+
+    :param si: ServiceInstance connection
+    :param vm: vim.VirtualMachine
+    :param timeout: Max seconds to wait
+    :return: Seconds waited
+    """
+    start = time.time()
+    collector = si.content.propertyCollector.CreatePropertyCollector()
+    try:
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=vm)
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.VirtualMachine, pathSet=['guest.toolsRunningStatus', 'guest.guestOperationsReady'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+        collector.CreateFilter(filter_spec, True)
+
+        state = dict()
+        version = ''
+        while True:
+            remaining = int(start + timeout - time.time())
+            if remaining <= 0:
+                raise GuestTimeout("Guest operations of %s not ready after %ss (%s)" % (vm.name, timeout, state))
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=remaining)
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
+            version = update.version
+            for filter_update in update.filterSet:
+                for obj_update in filter_update.objectSet:
+                    for change in obj_update.changeSet:
+                        state[change.name] = change.val
+            if _guest_ready(state):
+                return time.time() - start
+    finally:
+        collector.DestroyPropertyCollector()
+
+
+def wait_for_customization(si, vm, timeout=CUSTOMIZATION_TIMEOUT):
+    """Block until the customization spec given at clone time is applied.
+
+    The latest page of an event collector restricted to the customization
+    events of the VM is watched through PropertyCollector updates.
+
+    :param si: ServiceInstance connection
+    :param vm: vim.VirtualMachine
+    :param timeout: Max seconds to wait
+    :return: Seconds waited
+    """
+    start = time.time()
+    event_filter = vim.event.EventFilterSpec(
+        entity=vim.event.EventFilterSpec.ByEntity(entity=vm, recursion='self'),
+        eventTypeId=CUSTOMIZATION_EVENTS)
+    events = si.content.eventManager.CreateCollectorForEvents(event_filter)
+    collector = si.content.propertyCollector.CreatePropertyCollector()
+    try:
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=events)
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.event.EventHistoryCollector, pathSet=['latestPage'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+        collector.CreateFilter(filter_spec, True)
+
+        version = ''
+        while True:
+            remaining = int(start + timeout - time.time())
+            if remaining <= 0:
+                raise GuestTimeout("Customization of %s not done after %ss" % (vm.name, timeout))
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=remaining)
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
+            version = update.version
+            for filter_update in update.filterSet:
+                for obj_update in filter_update.objectSet:
+                    for change in obj_update.changeSet:
+                        for event in change.val or []:
+                            if isinstance(event, vim.event.CustomizationSucceeded):
+                                return time.time() - start
+                            if isinstance(event, vim.event.CustomizationFailed):
+                                raise CustomizationFailed("Customization of %s failed: %s" % (
+                                    vm.name, event.fullFormattedMessage or event.__class__.__name__))
+    finally:
+        collector.DestroyPropertyCollector()
+        events.DestroyCollector()
+
+
+def wait_for_process(si, vm, creds, pid, timeout=PROCESS_TIMEOUT, interval=1.0, max_interval=10.0):
+    """Wait for a guest program to exit and return its exit code.
+
+    Guest processes have no property to watch, so ListProcessesInGuest is
+    polled with a growing interval. None is returned if guest operations
+    go away or the process is no longer listed before the exit is seen,
+    i.e. the program rebooted the guest.
+
+    :param si: ServiceInstance connection
+    :param vm: vim.VirtualMachine
+    :param creds: vim.vm.guest.GuestAuthentication
+    :param pid: pid returned by StartProgramInGuest
+    """
+    process_manager = si.content.guestOperationsManager.processManager
+    deadline = time.time() + timeout
+    while True:
+        try:
+            processes = process_manager.ListProcessesInGuest(vm=vm, auth=creds, pids=[pid])
+        except (vim.fault.GuestOperationsUnavailable, vim.fault.InvalidState,
+                vim.fault.ToolsUnavailable):
+            return None
+
+        # Not listed any more: the guest rebooted and its process table is new
+        if not processes:
+            return None
+        if processes[0].endTime is not None:
+            return processes[0].exitCode
+
+        if time.time() > deadline:
+            raise GuestTimeout("Process %s still running in %s after %ss" % (pid, vm.name, timeout))
+        time.sleep(interval)
+        interval = min(interval * 1.5, max_interval)
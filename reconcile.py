@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""
+Reconcile the VMs of a folder with a manifest of desired VMs.
+
+The manifest is the one of `create_clone.py --manifest` (hostname, template,
+cpus, mem, vlans, disks, ...) with an optional `snapshots` list per VM. The
+actual state of every VM of the folder (of its subfolders too with
+--recursive) is fetched in one paged retrieval and only what differs is
+planned:
+
+ - create: clone the VMs missing from the folder
+ - reconfigure: hot add CPUs / memory and add the missing disks, in one task
+ - snapshot: take the snapshots missing from the tree
+ - destroy: with --prune, VMs of the folder not in the manifest, once
+   confirmed (or --yes)
+
+Steps run concurrently, each once the steps it depends on succeeded: a
+VM is created or reconfigured before it is snapshotted. Destroys come
+first in the plan, so they start first and free capacity for the clones.
+Drift that cannot be fixed online (fewer CPUs, less memory, bigger disks)
+is only reported.
+"""
+
+if __name__ == "__main__":
+    # Thin client of the warm agent when one listens (agent.py), not when
+    # destroys are confirmed on this terminal
+    import sys
+    import agent
+    if '--prune' not in sys.argv or '--yes' in sys.argv or '--dry-run' in sys.argv:
+        agent.delegate(__file__)
+
+import argparse
+import sys
+
+import requests
+from pyVmomi import vim
+
+import session
+import tracing
+from bulk import run_graph, print_summary, DEFAULT_PARALLEL
+from create_clone import build_deploy_settings, load_manifest, disks_device_change, place_vms, clone, BOOTSTRAP_FILE
+from inventory import Inventory, find_vm_folder, retrieve_objects, retrieve_properties
+from manage_snapshot import create_snapshots
+from snapshots import SnapshotIndex
+from throttle import run_task
+
+# Disable SSL certificats check
+requests.packages.urllib3.disable_warnings()
+
+PROPERTIES = ['name', 'config.template', 'config.hardware.numCPU', 'config.hardware.memoryMB',
+              'config.hardware.device', 'config.cpuHotAddEnabled', 'config.memoryHotAddEnabled',
+              'runtime.powerState', 'snapshot', 'datastore']
+
+
+def desired_state(kwargs):
+    """Return deploy settings of every VM of the manifest, in manifest order."""
+    desired = list()
+    names = set()
+    for entry in load_manifest(kwargs['manifest']):
+        vm_args = dict(kwargs)
+        vm_args.update(entry)
+        settings = build_deploy_settings(**vm_args)
+        snapshots = entry.get('snapshots') or []
+        settings['snapshots'] = snapshots if isinstance(snapshots, list) else str(snapshots).split()
+        # Host and datastore set in the manifest are not placed
+        settings['pinned'] = set(key for key in ('host', 'datastore') if entry.get(key))
+        if settings['new_vm_name'] in names:
+            sys.exit("VM %s is twice in the manifest" % settings['new_vm_name'])
+        names.add(settings['new_vm_name'])
+        desired.append(settings)
+    return desired
+
+
+def actual_state(si, root, recursive=True):
+    """Return properties of every VM (templates excluded) under root, by lower case name.
+
+    :param recursive: Also VMs of the subfolders of root
+    """
+    actual = dict()
+    for obj_content in retrieve_properties(si.RetrieveContent(), [vim.VirtualMachine], PROPERTIES,
+                                           root=root, recursive=recursive):
+        props = dict((p.name, p.val) for p in obj_content.propSet)
+        if props.get('config.template'):
+            continue
+        props['vm'] = obj_content.obj
+        actual[props['name'].lower()] = props
+    return actual
+
+
+def _disks(devices):
+    return [d for d in devices or [] if isinstance(d, vim.vm.device.VirtualDisk)]
+
+
+def template_disks(si, inventory, desired):
+    """Return the number of disks of each template of the manifest, in one call."""
+    templates = dict()
+    for settings in desired:
+        template_vm = inventory.get(vim.VirtualMachine, settings['template_name'])
+        if template_vm is not None:
+            templates[template_vm] = settings['template_name']
+    devices = retrieve_objects(si.RetrieveContent(), list(templates), ['config.hardware.device'])
+    return dict((name, len(_disks(devices.get(obj, dict()).get('config.hardware.device'))))
+                for obj, name in templates.items())
+
+
+def reconfigure_spec(settings, props, template_disk_count):
+    """Return (ConfigSpec or None, changes, notes) bringing a VM to its settings."""
+    spec = vim.vm.ConfigSpec()
+    changes = list()
+    notes = list()
+    online = props.get('runtime.powerState') == 'poweredOn'
+
+    for label, wanted, actual, hot_add, field in (
+            ('cpus', settings['cpus'], props.get('config.hardware.numCPU'),
+             props.get('config.cpuHotAddEnabled'), 'numCPUs'),
+            ('mem', settings['mem'], props.get('config.hardware.memoryMB'),
+             props.get('config.memoryHotAddEnabled'), 'memoryMB')):
+        if wanted == actual:
+            continue
+        if online and wanted < actual:
+            notes.append("%s %s -> %s needs a power off" % (label, actual, wanted))
+        elif online and not hot_add:
+            notes.append("%s %s -> %s needs a power off (hot add disabled)" % (label, actual, wanted))
+        else:
+            setattr(spec, field, wanted)
+            changes.append("%s %s -> %s" % (label, actual, wanted))
+
+    # Additional disks are the ones after the template disks, in order
+    devices = props.get('config.hardware.device') or []
+    wanted = [int(size) for size in settings['disks'] if int(size) > 0]
+    if template_disk_count is None:
+        notes.append("template %s not found, disks not checked" % settings['template_name'])
+    else:
+        extra = _disks(devices)[template_disk_count:]
+        for position, (disk, size) in enumerate(zip(extra, wanted)):
+            if disk.capacityInKB < size * 1024 * 1024:
+                notes.append("disk %d is %d GB, %d GB wanted" % (position + 1, disk.capacityInKB / 1024 / 1024, size))
+        if len(extra) > len(wanted):
+            notes.append("%d disks not in the manifest" % (len(extra) - len(wanted)))
+        missing = wanted[len(extra):]
+        if missing:
+            spec.deviceChange = disks_device_change(devices, missing)
+            changes.append("+disks %s GB" % ' '.join(str(size) for size in missing))
+
+    return (spec if changes else None), changes, notes
+
+
+def plan(desired, actual, disk_counts, prune=False):
+    """Compute the steps bringing actual to desired.
+
+    :return: (steps, notes, matching VM names), each step requires steps before it
+    """
+    steps = list()
+    notes = list()
+    matching = list()
+    wanted = set(settings['new_vm_name'] for settings in desired)
+
+    for name, props in sorted(actual.items()):
+        if name in wanted:
+            continue
+        if prune:
+            datastores = props.get('datastore') or []
+            steps.append(dict(name=name, action='destroy', detail=props.get('runtime.powerState'),
+                              vm=props['vm'], power_state=props.get('runtime.powerState'),
+                              datastore=datastores[0]._moId if datastores else None, requires=[]))
+        else:
+            notes.append((name, "not in the manifest"))
+
+    for settings in desired:
+        name = settings['new_vm_name']
+        props = actual.get(name)
+        last = None
+        datastore = None
+        if props is None:
+            steps.append(dict(name=name, action='create', settings=settings, datastore=None, requires=[],
+                              detail="%s %d cpus %d MB" % (settings['template_name'], settings['cpus'],
+                                                           settings['mem'])))
+            last = len(steps) - 1
+            existing = set()
+        else:
+            datastores = props.get('datastore') or []
+            datastore = datastores[0]._moId if datastores else None
+            spec, changes, vm_notes = reconfigure_spec(settings, props, disk_counts.get(settings['template_name']))
+            notes.extend((name, note) for note in vm_notes)
+            if spec is not None:
+                steps.append(dict(name=name, action='reconfigure', spec=spec, datastore=datastore,
+                                  detail=', '.join(changes), requires=[]))
+                last = len(steps) - 1
+            info = props.get('snapshot')
+            index = SnapshotIndex(props['vm'], info.rootSnapshotList if info else None)
+            existing = set(snap.name for snap in index.walk())
+
+        missing = [snapshot for snapshot in settings['snapshots'] if snapshot not in existing]
+        if missing:
+            steps.append(dict(name=name, action='snapshot', snapshots=missing,
+                              datastore=datastore,
+                              detail=' '.join(missing), requires=[last] if last is not None else []))
+        elif last is None:
+            matching.append(name)
+    return steps, notes, matching
+
+
+def print_plan(steps, notes):
+    print "%-40s %-12s %s" % ('NAME', 'ACTION', 'DETAIL')
+    for step in steps:
+        print "%-40s %-12s %s" % (step['name'], step['action'], step['detail'] or '')
+    for name, note in notes:
+        print "%-40s %-12s %s" % (name, 'drift', note)
+
+
+def main(**kwargs):
+    desired = desired_state(kwargs)
+    try:
+        si = session.connect(host=kwargs['vserver'], user=kwargs['username'], pwd=kwargs['password'], port=int(kwargs['port']))
+    except IOError, e:
+        sys.exit("Unable to connect to vsphere server. Error message: %s" % e)
+
+    tracing.phase('inventory')
+    inventory = Inventory(si)
+    # A folder is only its own VMs unless --recursive, a datacenter all of them
+    recursive = True
+    if kwargs['folder']:
+        # By path or by a name no other VM folder has, --prune destroys what is not in the manifest
+        try:
+            root = find_vm_folder(si.RetrieveContent(), kwargs['folder'])
+        except ValueError, e:
+            sys.exit(str(e))
+        if root is None:
+            sys.exit("Folder %s not found" % kwargs['folder'])
+        recursive = kwargs['recursive']
+    else:
+        datacenter = inventory.get(vim.Datacenter, kwargs['datacenter'])
+        if datacenter is None:
+            sys.exit("Datacenter %s not found" % kwargs['datacenter'])
+        root = datacenter.vmFolder
+
+    tracing.phase('plan')
+    actual = actual_state(si, root, recursive)
+    steps, notes, matching = plan(desired, actual, template_disks(si, inventory, desired), kwargs['prune'])
+    print_plan(steps, notes)
+    print "%d VMs need no change, %d steps planned" % (len(matching), len(steps))
+    if kwargs['dry_run'] or not steps:
+        return 0
+
+    # Destroys only run once confirmed, on the plan printed above
+    destroys = [step['name'] for step in steps if step['action'] == 'destroy']
+    if destroys and not kwargs['yes']:
+        if not sys.stdin.isatty():
+            sys.exit("%d VMs would be destroyed, rerun with --yes to confirm" % len(destroys))
+        answer = raw_input("Destroy %d VMs (%s)? [y/N] " % (len(destroys), ', '.join(destroys)))
+        if answer.strip().lower() not in ('y', 'yes'):
+            print "Nothing done"
+            return 1
+
+    # Spread new VMs over the cluster before any clone starts
+    creates = [step for step in steps if step['action'] == 'create']
+    placed = [step['settings'] for step in creates if step['settings']['placement']]
+    if placed:
+        place_vms(si, inventory, placed, [settings['pinned'] for settings in placed])
+    for step in steps:
+        if step['action'] == 'create':
+            datastore = inventory.get(vim.Datastore, step['settings']['datastore'])
+            step['datastore'] = datastore._moId if datastore is not None else step['settings']['datastore']
+        elif step['requires']:
+            step['datastore'] = steps[step['requires'][0]]['datastore']
+
+    vms = dict((name, props['vm']) for name, props in actual.items())
+
+    def worker(step):
+        if step['action'] == 'destroy':
+            if step['power_state'] == 'poweredOn':
+                run_task(si, step['vm'].PowerOff, 'Power off of %s' % step['name'], datastore=step['datastore'])
+            run_task(si, step['vm'].Destroy_Task, 'Destroy of %s' % step['name'], datastore=step['datastore'])
+        elif step['action'] == 'create':
+            settings = step['settings']
+            report = dict()
+            # Made in the folder reconciled, where the next plan looks for it
+            exit_code = clone(settings, list(settings['vlans']), si=si, inventory=inventory, report=report,
+                              folder=root)
+            if exit_code:
+                raise RuntimeError("bootstrap exit code %s" % exit_code)
+            vms[step['name']] = report['vm']
+        elif step['action'] == 'reconfigure':
+            # A disk added twice is a second disk
+            run_task(si, lambda: vms[step['name']].ReconfigVM_Task(spec=step['spec']),
+                     'Reconfigure of %s' % step['name'], datastore=step['datastore'],
+                     idempotent=not step['spec'].deviceChange)
+        elif step['action'] == 'snapshot':
+            create_snapshots(si, vms[step['name']], step['snapshots'], step['datastore'])
+
+    tracing.phase('apply')
+    print "Running {} steps, {} at a time...".format(len(steps), kwargs['parallel'])
+    results = run_graph(steps, worker, lambda step: step['requires'], parallel=kwargs['parallel'],
+                        limits=[(lambda step: step.get('datastore'), kwargs['per_datastore'])])
+    print_summary(results, lambda step: '%s %s' % (step['name'], step['action']))
+    return 1 if [r for r in results if r['status'] != 'ok'] else 0
+
+
+"""
+ Main program
+"""
+if __name__ == "__main__":
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser(description='Bring the VMs of a folder to the state described by a manifest')
+    parser.add_argument('--manifest', type=str, help='YAML/JSON file of desired VMs (create_clone.py manifest, plus snapshots)', required=True)
+    parser.add_argument('--vserver', type=str, help='fqdn or ip addr for the vcenter', required=True)
+    parser.add_argument('--username', type=str, help='Username to use for login into vcenter', required=True)
+    parser.add_argument('--password', type=str, help='Username password', required=True)
+    parser.add_argument('--port', type=int, help='port for vCenter', default=443)
+    parser.add_argument('--datacenter', type=str, help='Datacenter in Vcenter', default='MyDC')
+    parser.add_argument('--folder', type=str, help='VM folder reconciled, a path from the vm folder (prod/web) or a name matching one folder, whole datacenter by default')
+    parser.add_argument('--recursive', help='Also reconcile the VMs of the subfolders of --folder', action='store_true')
+    parser.add_argument('--prune', help='Destroy VMs of the folder not in the manifest (needs --folder)', action='store_true')
+    parser.add_argument('--yes', help='Destroy without asking for confirmation', action='store_true')
+    parser.add_argument('--dry-run', help='Print the plan without applying it', action='store_true')
+    parser.add_argument('--parallel', type=int, help='Max number of steps running at once', default=DEFAULT_PARALLEL)
+    parser.add_argument('--per-datastore', type=int, help='Max number of steps running at once on one datastore, 0 for no limit', default=4)
+    # Defaults of manifest entries, as in create_clone.py
+    parser.add_argument('--template', type=str, help='VMware template to clone', default='Centos7-x86')
+    parser.add_argument('--cpus', type=int, help='Number of CPUs', default=1)
+    parser.add_argument('--mem', type=int, help='Memory in GB', default=1)
+    parser.add_argument('--domain', type=str, help='domain name', default='prod.dmd')
+    parser.add_argument('--cluster', type=str, help='Cluster in Vcenter', default='prod')
+    parser.add_argument('--datastore', type=str, help='Datastore for new VMs', default='svc1_esx_poc-55')
+    parser.add_argument('--dns', type=str, help='Dns servers for new VMs, separated by a space', nargs='+', default=['192.168.139.1'])
+    parser.add_argument('--disks', type=str, help='Size in GB for additional disks, separated by a space', nargs='+', default=['0'])
+    parser.add_argument('--bootstrap-file', type=str, help='Bootstrap script uploaded into new VMs (default %s)' % BOOTSTRAP_FILE)
+    parser.add_argument('--placement', help='Choose host and datastore of new VMs from the cluster load', action='store_true')
+
+    # Parse arguments and hand off to main()
+    args = parser.parse_args()
+    if args.prune and not args.folder:
+        parser.error('--prune needs --folder')
+    sys.exit(main(hostname=None, vlans=None, **vars(args)))
@@ -0,0 +1,172 @@
+"""
+Shared vCenter connection layer.
+
+connect() hands out one ServiceInstance per (host, port, user) inside a
+process, over a stub keeping a pool of HTTPS connections. The session
+cookie is cached on disk (owner only) so the next invocation reuses the
+logged-in session instead of logging in again; an expired cookie falls
+back to a normal login.
+
+Set VSPHERE_SESSION_CACHE=0 to disable the disk cache, the session is
+then logged out at exit. VSPHERE_SESSION_DIR overrides the cache dir.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from pyVim.connect import SmartStubAdapter
+from pyVmomi import vim, vmodl
+
+import tracing
+
+# Number of HTTPS connections kept open to one vCenter
+POOL_SIZE = 10
+
+SESSION_DIR = os.environ.get('VSPHERE_SESSION_DIR',
+                             os.path.join(os.path.expanduser('~'), '.vsphere-api', 'sessions'))
+
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+
+def cache_enabled():
+    return os.environ.get('VSPHERE_SESSION_CACHE', '1') not in ('0', 'no', 'false')
+
+
+def _secret(pwd):
+    # Sessions are only handed to callers giving the password they were made with
+    return hashlib.sha256(pwd or '').hexdigest()
+
+
+def _cache_file(host, port, user, secret):
+    key = hashlib.sha1('%s:%s:%s:%s' % (host, port, user, secret)).hexdigest()
+    return os.path.join(SESSION_DIR, key)
+
+
+def _load_cookie(host, port, user, secret):
+    try:
+        with open(_cache_file(host, port, user, secret), 'r') as cache:
+            return json.load(cache).get('cookie')
+    except (IOError, ValueError):
+        return None
+
+
+def _save_cookie(host, port, user, secret, cookie):
+    if not os.path.isdir(SESSION_DIR):
+        os.makedirs(SESSION_DIR, 0700)
+    path = _cache_file(host, port, user, secret)
+    # A temp file of this writer only, created owner only (0600) before the
+    # cookie is written in it, then renamed over the cache at once
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=SESSION_DIR)
+    try:
+        with os.fdopen(fd, 'w') as cache:
+            json.dump(dict(host=host, port=port, user=user, cookie=cookie), cache)
+        os.rename(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _drop_cookie(host, port, user, secret):
+    try:
+        os.remove(_cache_file(host, port, user, secret))
+    except OSError:
+        pass
+
+
+def _valid(si):
+    try:
+        return si.content.sessionManager.currentSession is not None
+    except (vmodl.MethodFault, IOError):
+        return False
+
+
+def connect(host, user, pwd, port=443, pool_size=POOL_SIZE):
+    """Return a logged-in ServiceInstance, reusing a cached session when possible.
+
+    :param host: fqdn or ip addr of the vCenter
+    :param user: Username to use for login
+    :param pwd: Password, a cached session is only reused with the one it was made with
+    :param port: vCenter port
+    :param pool_size: Number of HTTPS connections pooled for this vCenter
+    """
+    port = int(port)
+    key = (host, port, user, _secret(pwd))
+    with _sessions_lock:
+        si = _sessions.get(key)
+        if si is not None:
+            return si
+
+        stub = tracing.instrument(SmartStubAdapter(host=host, port=port, poolSize=pool_size))
+        si = vim.ServiceInstance('ServiceInstance', stub)
+
+        cookie = _load_cookie(*key) if cache_enabled() else None
+        if cookie is not None:
+            stub.cookie = cookie
+            if not _valid(si):
+                stub.cookie = ""
+                _drop_cookie(*key)
+                cookie = None
+
+        if cookie is None:
+            si.content.sessionManager.Login(user, pwd, None)
+            if cache_enabled():
+                _save_cookie(*(key + (stub.cookie,)))
+            else:
+                atexit.register(logout, si)
+
+        _sessions[key] = si
+        return si
+
+
+def register(host, user, si, port=443, pwd=None):
+    """Hand an existing ServiceInstance to connect(), e.g. a simulated one, for callers giving pwd."""
+    tracing.instrument(si._stub)
+    with _sessions_lock:
+        _sessions[(host, int(port), user, _secret(pwd))] = si
+
+
+def endpoint(si):
+    """Return (host, port) of a session made by connect() or register(), else None."""
+    with _sessions_lock:
+        for (host, port, user, secret), cached in _sessions.items():
+            if cached is si:
+                return host, port
+    return None
+
+
+def after_fork():
+    """Give a forked process its own connection pools, keeping the sessions.
+
+    Pooled connections stay with the parent process, the child opens new
+    ones with the same session cookie instead of logging in again.
+    """
+    global _sessions_lock
+    _sessions_lock = threading.Lock()
+    for si in _sessions.values():
+        stub = si._stub
+        if hasattr(stub, 'pool'):
+            stub.lock = threading.Lock()
+            stub.pool = []
+        # VSPHERE_TRACE may be set for the child only
+        tracing.instrument(stub)
+
+
+def logout(si):
+    """Log out a session and forget it, in process and on disk."""
+    with _sessions_lock:
+        for key, cached in _sessions.items():
+            if cached is si:
+                del _sessions[key]
+                _drop_cookie(*key)
+    try:
+        si.content.sessionManager.Logout()
+    except (vmodl.MethodFault, IOError):
+        pass
@@ -0,0 +1,200 @@
+"""
+In-memory index of the snapshot tree of a VM.
+
+The whole snapshot.rootSnapshotList tree comes back from one property
+fetch as plain data objects, so walking it, finding snapshots by name,
+id or creation time and planning removals costs no more round trips.
+"""
+
+import datetime
+import fnmatch
+import sys
+
+from pyVmomi import vmodl
+
+from inventory import retrieve_objects
+from throttle import run_task
+
+
+class Snapshot(object):
+    """One node of the snapshot tree."""
+
+    def __init__(self, tree, parent=None):
+        self.name = tree.name
+        self.id = tree.id
+        self.description = tree.description
+        self.created = tree.createTime
+        self.state = tree.state
+        self.snapshot = tree.snapshot
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.children = []
+
+    def descendants(self):
+        for child in self.children:
+            yield child
+            for snap in child.descendants():
+                yield snap
+
+    def __repr__(self):
+        return '<Snapshot %s id=%s>' % (self.name, self.id)
+
+
+def _age(created, now=None):
+    # createTime is timezone aware, compare it to "now" in the same zone
+    if now is None:
+        now = datetime.datetime.now(created.tzinfo)
+    return now - created
+
+
+class RetentionPolicy(object):
+    """Select snapshots to prune on one VM.
+
+    Only snapshots whose name or description match pattern (all when no
+    pattern) are considered; those older than max_age days, or beyond the
+    keep newest ones, are selected.
+
+    :param max_age: Max age in days, None for no age limit
+    :param keep: Max number of matching snapshots kept per VM, None for no limit
+    :param pattern: Glob pattern on snapshot name or description
+    """
+
+    def __init__(self, max_age=None, keep=None, pattern=None):
+        self.max_age = max_age
+        self.keep = keep
+        self.pattern = pattern
+
+    def matches(self, snap):
+        if not self.pattern:
+            return True
+        return (fnmatch.fnmatch(snap.name, self.pattern) or
+                fnmatch.fnmatch(snap.description or '', self.pattern))
+
+    def select(self, index, now=None):
+        """Return the snapshots of a SnapshotIndex to remove, oldest first."""
+        candidates = [s for s in index.by_creation() if self.matches(s)]
+        selected = list()
+        for position, snap in enumerate(candidates):
+            too_many = self.keep is not None and position < len(candidates) - self.keep
+            too_old = (self.max_age is not None and
+                       _age(snap.created, now) > datetime.timedelta(days=self.max_age))
+            if too_many or too_old:
+                selected.append(snap)
+        return selected
+
+
+class SnapshotIndex(object):
+    """Snapshot tree of one VM indexed by name, id and snapshot moref.
+
+    :param vm: vim.VirtualMachine
+    :param root_list: snapshot.rootSnapshotList of the VM (may be None)
+    :param current: snapshot.currentSnapshot of the VM (may be None)
+    """
+
+    def __init__(self, vm, root_list, current=None):
+        self.vm = vm
+        self.roots = []
+        self.by_name = dict()
+        self.by_id = dict()
+        self.by_moref = dict()
+        for tree in root_list or []:
+            self.roots.append(self._add(tree, None))
+        self.current = self.by_moref.get(current._moId) if current is not None else None
+
+    def _add(self, tree, parent):
+        snap = Snapshot(tree, parent)
+        self.by_name.setdefault(snap.name, []).append(snap)
+        self.by_id[snap.id] = snap
+        self.by_moref[snap.snapshot._moId] = snap
+        for child in tree.childSnapshotList or []:
+            snap.children.append(self._add(child, snap))
+        return snap
+
+    @classmethod
+    def fetch(cls, si, vm):
+        """Build the index of a VM from one property retrieval."""
+        info = retrieve_objects(si.RetrieveContent(), [vm], ['snapshot']).get(vm, dict()).get('snapshot')
+        if info is None:
+            return cls(vm, None)
+        return cls(vm, info.rootSnapshotList, info.currentSnapshot)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def walk(self):
+        """Yield every snapshot, depth first, each parent before its children."""
+        for root in self.roots:
+            yield root
+            for snap in root.descendants():
+                yield snap
+
+    def find(self, name):
+        """Return every snapshot with this name."""
+        return list(self.by_name.get(name, []))
+
+    def by_creation(self):
+        """Return every snapshot, oldest first."""
+        return sorted(self.walk(), key=lambda s: s.created)
+
+    def removal_plan(self, snapshots, recursive=False):
+        """Order removals of a set of snapshots for the fewest consolidations.
+
+        A snapshot whose whole subtree is removed becomes one recursive
+        removal, snapshots covered by it are dropped, and removals run
+        deepest first.
+
+        :return: List of (Snapshot, remove_children)
+        """
+        selected = dict((s.id, s) for s in snapshots)
+        recursive_ids = set()
+        plan = []
+        # Parents first, so a recursive removal is known before its subtree
+        for snap in sorted(selected.values(), key=lambda s: s.depth):
+            ancestor = snap.parent
+            while ancestor is not None and ancestor.id not in recursive_ids:
+                ancestor = ancestor.parent
+            if ancestor is not None:
+                # Already removed with one of its ancestors
+                continue
+            remove_children = recursive or bool(snap.children) and all(
+                d.id in selected for d in snap.descendants())
+            if remove_children:
+                recursive_ids.add(snap.id)
+            plan.append((snap, remove_children))
+
+        plan.sort(key=lambda step: -step[0].depth)
+        return plan
+
+    def remove(self, si, snapshots, recursive=False, datastore=None):
+        """Remove snapshots following removal_plan().
+
+        When several removals are needed, disks are consolidated only once
+        after the last one, or after the last one done when a removal fails
+        (its fault is raised then).
+
+        :param datastore: Datastore (or moId) of the VM, for the task windows of throttle.py
+
+        :return: List of (Snapshot, remove_children) removed
+        """
+        plan = self.removal_plan(snapshots, recursive)
+        consolidate = len(plan) == 1
+        removed = 0
+        error = None
+        try:
+            for snap, remove_children in plan:
+                print "Delete %s" % snap.name
+                run_task(si, lambda: snap.snapshot.RemoveSnapshot_Task(remove_children, consolidate=consolidate),
+                         'Deleting snapshot', datastore=datastore)
+                removed += 1
+        except Exception:
+            error = sys.exc_info()
+        # Disks of the removals done are left to consolidate even when a later one failed
+        if len(plan) > 1 and removed:
+            try:
+                run_task(si, self.vm.ConsolidateVMDisks_Task, 'Consolidating disks', datastore=datastore)
+            except vmodl.MethodFault:
+                if error is None:
+                    raise
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return plan
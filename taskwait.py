@@ -0,0 +1,319 @@
+"""
+Event driven wait on vSphere tasks.
+
+Tasks are watched through a private PropertyCollector filter on
+info.state/info.progress/info.error/info.result. A single background
+thread long-polls WaitForUpdatesEx for every task of a connection, so
+waiting on hundreds of tasks costs one pending call instead of one
+polling loop per task, and each task is reported as soon as it ends.
+After a failed WaitForUpdatesEx, the tasks are watched again from a new
+collector after a backoff; they only fail once RETRIES are spent or the
+session is gone.
+"""
+
+import atexit
+import threading
+import time
+import Queue
+
+from pyVmomi import vim, vmodl
+
+# Seconds WaitForUpdatesEx is allowed to block before returning empty
+MAX_WAIT = 60
+
+# Retries of WaitForUpdatesEx after an error before the watched tasks fail,
+# seconds before the first one and at most between two
+RETRIES = 5
+BACKOFF = 1.0
+MAX_BACKOFF = 30.0
+
+TASK_PROPERTIES = ['info.state', 'info.progress', 'info.error', 'info.result', 'info.queueTime', 'info.startTime']
+
+_waiters = dict()
+_waiters_lock = threading.Lock()
+
+
+class TaskWatch(object):
+    """State of one watched task, updated by the waiter thread."""
+
+    def __init__(self, task, progress_callback=None, done_callback=None):
+        self.task = task
+        self.key = task._moId
+        self.state = None
+        self.progress = None
+        self.error = None
+        self.result = None
+        self.queue_time = None
+        self.start_time = None
+        self.progress_callback = progress_callback
+        self.done_callback = done_callback
+        self.event = threading.Event()
+
+    @property
+    def done(self):
+        return self.event.is_set()
+
+    @property
+    def succeeded(self):
+        return self.state == vim.TaskInfo.State.success
+
+    @property
+    def queue_seconds(self):
+        """Seconds the task waited in the vCenter queue, None if it never started."""
+        if self.queue_time is None or self.start_time is None:
+            return None
+        delta = self.start_time - self.queue_time
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+    def wait(self, timeout=None):
+        """Block until the task ends, return True if it did within timeout."""
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+    def get(self, timeout=None):
+        """Wait for the task and return its result, raise its fault on error."""
+        if not self.wait(timeout):
+            raise RuntimeError("Timeout waiting for task %s" % self.key)
+        if not self.succeeded:
+            raise self.error
+        return self.result
+
+
+class TaskWaiter(object):
+    """Dispatch task updates of one connection to their TaskWatch.
+
+    :param si: ServiceInstance connection
+    :param max_wait: Seconds each WaitForUpdatesEx call may block
+    """
+
+    def __init__(self, si, max_wait=MAX_WAIT):
+        self.content = si.RetrieveContent()
+        self.collector = self.content.propertyCollector.CreatePropertyCollector()
+        self.max_wait = max_wait
+        self._version = ''
+        self._watches = dict()
+        self._filters = dict()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='taskwait')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def watch(self, tasks, progress_callback=None, done_callback=None):
+        """Start watching tasks, return one TaskWatch per task.
+
+        All tasks given in one call share a single PropertyCollector filter,
+        destroyed once every one of them has ended.
+
+        :param tasks: List of vim.Task
+        :param progress_callback: Called as progress_callback(task, percent)
+        :param done_callback: Called as done_callback(watch) from the waiter thread
+        """
+        watches = [TaskWatch(t, progress_callback, done_callback) for t in tasks]
+        if not watches:
+            return watches
+
+        with self._cond:
+            pc_filter = self.collector.CreateFilter(_filter_spec(tasks), True)
+            keys = set()
+            for w in watches:
+                self._watches[w.key] = w
+                keys.add(w.key)
+            self._filters[pc_filter] = keys
+            self._cond.notify()
+        return watches
+
+    def wait(self, tasks, progress_callback=None, raise_on_error=True):
+        """Wait for every task and return their results in order.
+
+        The fault of the first failed task is raised once all tasks ended,
+        unless raise_on_error is False.
+        """
+        watches = self.watch(tasks, progress_callback)
+        for w in watches:
+            w.wait()
+        if raise_on_error:
+            for w in watches:
+                if not w.succeeded:
+                    raise w.error
+        return [w.result for w in watches]
+
+    def as_completed(self, tasks, progress_callback=None):
+        """Yield TaskWatch objects in the order their tasks end."""
+        done = Queue.Queue()
+        watches = self.watch(tasks, progress_callback, done_callback=done.put)
+        for _ in watches:
+            yield done.get()
+
+    def close(self):
+        """Stop the waiter thread and destroy the private collector."""
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._cond.notify()
+        try:
+            self.collector.CancelWaitForUpdates()
+        except Exception:
+            pass
+        self._thread.join(5)
+        try:
+            self.collector.DestroyPropertyCollector()
+        except Exception:
+            pass
+
+    def _run(self):
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.max_wait)
+        failures = 0
+        while True:
+            with self._cond:
+                while not self._filters and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            try:
+                if failures:
+                    self._rebuild()
+                update = self.collector.WaitForUpdatesEx(self._version, options)
+            except vmodl.fault.RequestCanceled:
+                continue
+            except Exception, e:
+                if self._stopped:
+                    return
+                failures += 1
+                # A session gone (logout, expiry) does not come back, a network
+                # error or a vCenter restart may
+                if isinstance(e, vim.fault.NotAuthenticated) or failures > RETRIES:
+                    self._fail_all(e)
+                    failures = 0
+                    continue
+                with self._cond:
+                    if not self._stopped:
+                        self._cond.wait(min(MAX_BACKOFF, BACKOFF * 2 ** (failures - 1)))
+                continue
+            failures = 0
+            if update is None:
+                continue
+            self._version = update.version
+            self._dispatch(update)
+
+    def _dispatch(self, update):
+        finished = []
+        for filter_update in update.filterSet:
+            for obj_update in filter_update.objectSet:
+                w = self._watches.get(obj_update.obj._moId)
+                if w is None:
+                    continue
+                for change in obj_update.changeSet:
+                    if change.name == 'info.state':
+                        w.state = change.val
+                    elif change.name == 'info.progress':
+                        w.progress = change.val
+                        if w.progress_callback is not None and change.val is not None:
+                            w.progress_callback(w.task, change.val)
+                    elif change.name == 'info.error':
+                        w.error = change.val
+                    elif change.name == 'info.result':
+                        w.result = change.val
+                    elif change.name == 'info.queueTime':
+                        w.queue_time = change.val
+                    elif change.name == 'info.startTime':
+                        w.start_time = change.val
+                if w.state in (vim.TaskInfo.State.success, vim.TaskInfo.State.error):
+                    finished.append(w)
+
+        for w in finished:
+            self._finish(w)
+
+    def _finish(self, w):
+        with self._cond:
+            self._watches.pop(w.key, None)
+            for pc_filter, keys in self._filters.items():
+                if w.key in keys:
+                    keys.discard(w.key)
+                    if not keys:
+                        del self._filters[pc_filter]
+                        try:
+                            pc_filter.DestroyPropertyFilter()
+                        except vmodl.MethodFault:
+                            pass
+        w.event.set()
+        if w.done_callback is not None:
+            w.done_callback(w)
+
+    def _rebuild(self):
+        # The collector may be gone with the error: pending tasks are watched
+        # again from a new one, whose first update has their current info.state
+        collector = self.content.propertyCollector.CreatePropertyCollector()
+        with self._cond:
+            try:
+                filters = dict()
+                for keys in self._filters.values():
+                    watches = [self._watches[key] for key in keys if key in self._watches]
+                    if watches:
+                        pc_filter = collector.CreateFilter(_filter_spec([w.task for w in watches]), True)
+                        filters[pc_filter] = set(w.key for w in watches)
+            except Exception:
+                try:
+                    collector.DestroyPropertyCollector()
+                except Exception:
+                    pass
+                raise
+            old, self.collector, self._filters, self._version = self.collector, collector, filters, ''
+        try:
+            old.DestroyPropertyCollector()
+        except Exception:
+            pass
+
+    def _fail_all(self, error):
+        # The collector is unusable, report the error on every pending task
+        with self._cond:
+            watches = self._watches.values()
+        for w in watches:
+            w.state = vim.TaskInfo.State.error
+            w.error = error
+            self._finish(w)
+
+
+def _filter_spec(tasks):
+    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=t) for t in tasks]
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.Task, pathSet=TASK_PROPERTIES, all=False)
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=[prop_spec])
+
+
+def get_waiter(si):
+    """Return the TaskWaiter shared by every caller of this connection."""
+    key = id(si._stub)
+    with _waiters_lock:
+        waiter = _waiters.get(key)
+        if waiter is None:
+            waiter = TaskWaiter(si)
+            _waiters[key] = waiter
+        return waiter
+
+
+def wait_for_tasks(si, tasks, progress_callback=None):
+    """Wait for a list of tasks, drop-in replacement of tools.tasks.wait_for_tasks."""
+    return get_waiter(si).wait(tasks, progress_callback)
+
+
+def wait_task(si, task, action_name='job', progress_callback=None):
+    """Wait for one task, print the error and raise its fault if it failed.
+
+    :return: task.info.result
+    """
+    w = get_waiter(si).watch([task], progress_callback)[0]
+    w.wait()
+    if not w.succeeded:
+        print '%s did not complete successfully: %s' % (action_name, w.error)
+        raise w.error
+    return w.result
+
+
+@atexit.register
+def _close_waiters():
+    with _waiters_lock:
+        for waiter in _waiters.values():
+            waiter.close()
+        _waiters.clear()
@@ -0,0 +1,250 @@
+"""
+Adaptive concurrency and backoff for vCenter task submission.
+
+A task started through the TaskScheduler of a connection holds a slot in
+the window of its vCenter and of the host and datastore it works on until
+it ends. Windows follow AIMD, like TCP: a window in use grows by one slot
+per window of tasks ending without waiting in the vCenter queue, and is
+halved when a task waited longer than QUEUE_TARGET before starting or
+failed with a throttling fault. Tasks failing with a retryable fault are
+started again after a jittered exponential backoff, the caller only sees
+the fault once RETRIES are spent. A task that may have done its work
+despite its fault (UNSURE_FAULTS) is only started again when the caller
+says it is idempotent.
+
+run_task() starts and waits for one task, acquire() / release() let an
+event driven caller (destroy_vm.py) start tasks itself.
+"""
+
+import random
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+
+import session
+from taskwait import get_waiter
+
+# Initial and max window size of each kind of key
+WINDOWS = dict(vcenter=(16, 128), host=(4, 32), datastore=(4, 32))
+
+MIN_WINDOW = 1
+
+# Ratio of a window kept on a decrease
+DECREASE = 0.5
+
+# Seconds a task may wait in the vCenter queue before its windows shrink,
+# also the min time between two decreases of a window
+QUEUE_TARGET = 2.0
+
+# Retries of a task failing with a retryable fault
+RETRIES = 5
+
+# Seconds before the first retry and at most between two, jitter apart
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+# vCenter or host overloaded: retry and shrink the windows. Faults pyVmomi
+# has no type for (TooManyTasks) are matched by name or message
+THROTTLE_FAULTS = ('TooManyConcurrentNativeClones', 'TooManyTasks', 'HostCommunication', 'HostNotConnected',
+                   'Timedout')
+
+# Throttling faults after which the task may still have run on the host:
+# retried only for idempotent tasks, never for a Clone or a CreateVM
+UNSURE_FAULTS = ('HostCommunication', 'Timedout')
+
+# Object busy with another task: retry only
+BUSY_FAULTS = ('TaskInProgress', 'ConcurrentAccess')
+
+_schedulers = dict()
+_schedulers_lock = threading.Lock()
+
+
+def _faults(names):
+    faults = (getattr(vim.fault, name, None) or getattr(vmodl.fault, name, None) for name in names)
+    return tuple(fault for fault in faults if fault is not None)
+
+
+def _matches(error, names):
+    """True when error is one of the faults names, by type, name or message."""
+    if error is None:
+        return False
+    if isinstance(error, _faults(names)) or error.__class__.__name__ in names:
+        return True
+    # Unknown to this pyVmomi, e.g. 'Too many tasks' or 'vim.fault.TooManyTasks.summary'
+    untyped = [name.lower() for name in names if not _faults([name])]
+    texts = [getattr(error, 'msg', None) or ''] + [getattr(m, 'key', None) or ''
+                                                   for m in getattr(error, 'faultMessage', None) or []]
+    texts = [text.replace(' ', '').lower() for text in texts]
+    return any(name in text for name in untyped for text in texts)
+
+
+class Window(object):
+    """AIMD window of tasks running at once for one key."""
+
+    def __init__(self, size, maximum):
+        self.size = float(size)
+        self.maximum = maximum
+        self.inflight = 0
+        self.decreased = 0
+
+    def room(self):
+        return self.inflight < int(self.size)
+
+    def increase(self):
+        # An idle window says nothing about the load, only grow one in use
+        if self.inflight + 1 >= int(self.size):
+            self.size = min(self.maximum, self.size + 1.0 / self.size)
+
+    def decrease(self, now):
+        # Tasks in flight together see the same overload, shrink once for them
+        if now - self.decreased >= QUEUE_TARGET:
+            self.size = max(MIN_WINDOW, self.size * DECREASE)
+            self.decreased = now
+
+
+class TaskScheduler(object):
+    """Windows and retries of the tasks of one vCenter.
+
+    :param si: ServiceInstance connection
+    :param windows: dict kind of key -> (initial size, max size)
+    :param retries: Retries of a task failing with a retryable fault
+    """
+
+    def __init__(self, si, windows=WINDOWS, retries=RETRIES):
+        self.si = si
+        self.limits = windows
+        self.retries = retries
+        self.windows = dict()
+        self.retried = 0
+        self._cond = threading.Condition()
+
+    def keys(self, host=None, datastore=None):
+        """Window keys of a task on a host and/or datastore (objects or moIds)."""
+        keys = [('vcenter', None)]
+        for kind, value in (('host', host), ('datastore', datastore)):
+            if value is not None:
+                keys.append((kind, getattr(value, '_moId', value)))
+        return keys
+
+    def _window(self, key):
+        window = self.windows.get(key)
+        if window is None:
+            window = Window(*self.limits[key[0]])
+            self.windows[key] = window
+        return window
+
+    def acquire(self, keys, block=True):
+        """Take a slot in every window of keys.
+
+        :return: False when not blocking and a window is full
+        """
+        with self._cond:
+            while True:
+                windows = [self._window(key) for key in keys]
+                if all(w.room() for w in windows):
+                    for w in windows:
+                        w.inflight += 1
+                    return True
+                if not block:
+                    return False
+                self._cond.wait()
+
+    def release(self, keys, attempt=1, queue_seconds=None, error=None, idempotent=True):
+        """Give back the slots of an ended task and adjust its windows.
+
+        :param attempt: Number of times the task was started
+        :param queue_seconds: Seconds the task waited in the vCenter queue
+        :param error: Fault of the task, None when it succeeded
+        :param idempotent: False when the task must not run twice, e.g. a Clone
+        :return: Seconds to wait before starting it again, None when it must not be retried
+        """
+        now = time.time()
+        throttled = _matches(error, THROTTLE_FAULTS)
+        retryable = throttled or _matches(error, BUSY_FAULTS)
+        if not idempotent and _matches(error, UNSURE_FAULTS):
+            retryable = False
+        with self._cond:
+            windows = [self._window(key) for key in keys]
+            for w in windows:
+                w.inflight -= 1
+            if throttled or (queue_seconds or 0) > QUEUE_TARGET:
+                for w in windows:
+                    w.decrease(now)
+            elif error is None:
+                for w in windows:
+                    w.increase()
+            if retryable and attempt <= self.retries:
+                self.retried += 1
+            self._cond.notify_all()
+        if not retryable or attempt > self.retries:
+            return None
+        return min(MAX_BACKOFF, BACKOFF * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+    def run(self, start, action_name='job', host=None, datastore=None, idempotent=True):
+        """Start a task with start() once its windows allow it, wait for it, retry it.
+
+        :param start: Callable starting the task and returning the vim.Task
+        :param idempotent: False when the task must not run twice, e.g. a Clone
+        :return: task.info.result
+        """
+        keys = self.keys(host, datastore)
+        waiter = get_waiter(self.si)
+        attempt = 0
+        while True:
+            attempt += 1
+            self.acquire(keys)
+            watch = None
+            try:
+                watch = waiter.watch([start()])[0]
+                watch.wait()
+                error = None if watch.succeeded else watch.error
+            except vmodl.MethodFault, e:
+                # Refused before any task was created
+                error = e
+            except BaseException, e:
+                self.release(keys, attempt, error=e)
+                raise
+            delay = self.release(keys, attempt, watch and watch.queue_seconds, error, idempotent)
+            if error is None:
+                return watch.result
+            if delay is None:
+                raise error
+            print '%s: %s, retry in %.1fs' % (action_name, getattr(error, 'msg', None) or error.__class__.__name__,
+                                               delay)
+            time.sleep(delay)
+
+    def sizes(self):
+        """dict key -> current window size."""
+        with self._cond:
+            return dict((key, w.size) for key, w in self.windows.items())
+
+
+def get_scheduler(si):
+    """Return the TaskScheduler shared by every caller of this vCenter."""
+    key = session.endpoint(si) or id(si._stub)
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            scheduler = TaskScheduler(si)
+            _schedulers[key] = scheduler
+        # Tasks are watched over the latest session of the vCenter
+        scheduler.si = si
+        return scheduler
+
+
+def run_task(si, start, action_name='job', host=None, datastore=None, idempotent=True):
+    """Run a task through the scheduler of its vCenter, wait_task() with retries.
+
+    Prints the error and raises the fault of the task once retries are spent.
+
+    :param start: Callable starting the task, e.g. lambda: vm.PowerOff()
+    :param idempotent: False when the task must not run twice: a timed out
+        Clone, CreateVM or CreateSnapshot is reported, not started again
+    :return: task.info.result
+    """
+    try:
+        return get_scheduler(si).run(start, action_name, host, datastore, idempotent)
+    except vmodl.MethodFault, e:
+        print '%s did not complete successfully: %s' % (action_name, e)
+        raise
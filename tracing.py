@@ -0,0 +1,261 @@
+"""
+SOAP round trip and phase timing instrumentation.
+
+instrument() wraps a pyVmomi stub so every SOAP call is counted and timed
+by managed object type and method, including the property reads pyVmomi
+makes behind attribute access (vm.runtime.powerState, pg.config, ...),
+reported as kind "property". Workflows are cut into named spans with
+traced() and phase(); the SOAP calls made inside a span are added to it.
+
+Enabled with VSPHERE_TRACE=json or VSPHERE_TRACE=prometheus, the summary
+is written at exit to VSPHERE_TRACE_FILE (stderr by default). When not
+enabled, stubs are left untouched and spans cost next to nothing.
+"""
+
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+FORMATS = ('json', 'prometheus')
+
+# Span instances kept for the JSON trace, aggregates are always complete
+MAX_EVENTS = 10000
+
+
+def trace_format():
+    value = os.environ.get('VSPHERE_TRACE', '').lower()
+    if value == 'prom':
+        value = 'prometheus'
+    return value if value in FORMATS else None
+
+
+class Tracer(object):
+    """Collect SOAP call and span statistics of the process."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # (kind, type, method) -> [count, seconds, max seconds]
+        self.calls = dict()
+        # span name -> [count, seconds, soap calls, soap seconds]
+        self.spans = dict()
+        self.events = []
+        self.local = threading.local()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def record_call(self, kind, mo_type, method, seconds):
+        with self.lock:
+            stats = self.calls.setdefault((kind, mo_type, method), [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+        # Spans are inclusive, a call counts in every open span of the thread
+        for frame in self.stack():
+            frame['soap_calls'] += 1
+            frame['soap_seconds'] += seconds
+
+    def push(self, name, is_phase=False):
+        stack = self.stack()
+        if stack:
+            name = stack[-1]['name'] + '/' + name
+        stack.append(dict(name=name, start=time.time(), phase=is_phase,
+                          soap_calls=0, soap_seconds=0.0))
+
+    def pop(self):
+        frame = self.stack().pop()
+        seconds = time.time() - frame['start']
+        with self.lock:
+            stats = self.spans.setdefault(frame['name'], [0, 0.0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += frame['soap_calls']
+            stats[3] += frame['soap_seconds']
+            if len(self.events) < MAX_EVENTS:
+                self.events.append(dict(name=frame['name'], thread=threading.current_thread().name,
+                                        start=round(frame['start'] - self.started, 6),
+                                        seconds=round(seconds, 6), soap_calls=frame['soap_calls'],
+                                        soap_seconds=round(frame['soap_seconds'], 6)))
+
+    def summary(self):
+        with self.lock:
+            calls = [dict(kind=k[0], type=k[1], method=k[2], count=v[0], seconds=round(v[1], 6),
+                          max_seconds=round(v[2], 6)) for k, v in self.calls.items()]
+            spans = [dict(name=k, count=v[0], seconds=round(v[1], 6), soap_calls=v[2],
+                          soap_seconds=round(v[3], 6)) for k, v in self.spans.items()]
+            events = sorted(self.events, key=lambda e: e['start'])
+        calls.sort(key=lambda c: -c['seconds'])
+        spans.sort(key=lambda s: s['name'])
+        return dict(wall_seconds=round(time.time() - self.started, 6),
+                    soap_calls=sum(c['count'] for c in calls),
+                    soap_seconds=round(sum(c['seconds'] for c in calls), 6),
+                    calls=calls, spans=spans, trace=events)
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+                lines.append('%s{%s} %s' % (name, label_text, value))
+
+        call_labels = lambda c: [('kind', c['kind']), ('type', c['type']), ('method', c['method'])]
+        metric('vsphere_soap_calls_total', 'counter', 'SOAP round trips by managed object type and method.',
+               [(call_labels(c), c['count']) for c in summary['calls']])
+        metric('vsphere_soap_seconds_total', 'counter', 'Seconds spent in SOAP round trips.',
+               [(call_labels(c), c['seconds']) for c in summary['calls']])
+        metric('vsphere_span_total', 'counter', 'Number of times a workflow phase ran.',
+               [([('span', s['name'])], s['count']) for s in summary['spans']])
+        metric('vsphere_span_seconds_total', 'counter', 'Seconds spent in a workflow phase.',
+               [([('span', s['name'])], s['seconds']) for s in summary['spans']])
+        metric('vsphere_span_soap_calls_total', 'counter', 'SOAP round trips made during a workflow phase.',
+               [([('span', s['name'])], s['soap_calls']) for s in summary['spans']])
+        lines.append('# TYPE vsphere_wall_seconds gauge')
+        lines.append('vsphere_wall_seconds %s' % summary['wall_seconds'])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, output_format, path=None):
+        if output_format == 'prometheus':
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.summary(), indent=2, sort_keys=True) + '\n'
+        if path:
+            with open(path, 'w') as out:
+                out.write(text)
+        else:
+            sys.stderr.write(text)
+
+
+tracer = Tracer()
+
+# Callables notified of each span and phase started, tracing enabled or not (job progress)
+listeners = []
+
+_report_lock = threading.Lock()
+_report_registered = []
+
+
+def reset():
+    """Forget what was recorded so far, e.g. in a forked process."""
+    global tracer
+    tracer = Tracer()
+    del _report_registered[:]
+
+
+def _report():
+    tracer.write(trace_format(), os.environ.get('VSPHERE_TRACE_FILE'))
+
+
+def _register_report():
+    with _report_lock:
+        if not _report_registered:
+            atexit.register(_report)
+            _report_registered.append(True)
+
+
+def instrument(stub):
+    """Count and time every SOAP call made through a pyVmomi stub.
+
+    Property reads go through InvokeAccessor, which itself calls
+    RetrievePropertiesEx: only the property read is recorded.
+    """
+    if trace_format() is None or getattr(stub, '_traced', False):
+        return stub
+    _register_report()
+    invoke_method = stub.InvokeMethod
+    invoke_accessor = stub.InvokeAccessor
+    local = threading.local()
+
+    def traced_method(mo, info, args):
+        if getattr(local, 'accessor', False):
+            return invoke_method(mo, info, args)
+        start = time.time()
+        try:
+            return invoke_method(mo, info, args)
+        finally:
+            tracer.record_call('method', mo._wsdlName, info.wsdlName, time.time() - start)
+
+    def traced_accessor(mo, info):
+        start = time.time()
+        local.accessor = True
+        try:
+            return invoke_accessor(mo, info)
+        finally:
+            local.accessor = False
+            tracer.record_call('property', mo._wsdlName, info.name, time.time() - start)
+
+    stub.InvokeMethod = traced_method
+    stub.InvokeAccessor = traced_accessor
+    stub._traced = True
+    return stub
+
+
+def _notify(name):
+    for listener in listeners:
+        listener(name)
+
+
+def current():
+    """Name of the innermost span of the thread, None outside spans."""
+    if trace_format() is None:
+        return None
+    spans = [frame['name'] for frame in tracer.stack() if not frame['phase']]
+    return spans[-1] if spans else None
+
+
+@contextmanager
+def span(name, parent=None):
+    """Time a block as a span nested in the current span of the thread.
+
+    :param parent: current() of another thread the block runs for, used when this thread has no span
+    """
+    _notify(name)
+    if trace_format() is None:
+        yield
+        return
+    _register_report()
+    stack = tracer.stack()
+    depth = len(stack)
+    tracer.push(parent + '/' + name if parent and not stack else name)
+    try:
+        yield
+    finally:
+        # Also closes the phases left open in the block
+        while len(stack) > depth:
+            tracer.pop()
+
+
+def phase(name):
+    """End the current phase of the innermost span and start a new one."""
+    _notify(name)
+    if trace_format() is None:
+        return
+    stack = tracer.stack()
+    if not stack:
+        # Only phases of a span are recorded
+        return
+    if stack[-1]['phase']:
+        tracer.pop()
+    tracer.push(name, is_phase=True)
+
+
+def traced(name):
+    """Decorator running a function in a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,888 @@
+"""
+In-process vCenter simulator.
+
+SimStub is a pyVmomi stub adapter: real pyVmomi managed objects are bound
+to it, so the scripts run unchanged against an in-memory inventory of
+configurable size instead of a live vCenter. Every SOAP call (method or
+property accessor) is counted per managed object type and method, and can
+be delayed by a fixed round trip time. Tasks complete after a configurable
+latency and are reported through the simulated PropertyCollector.
+
+Only what the scripts use is simulated: ContainerView/PropertyCollector
+retrieval (views hold every object of the requested types, whatever their
+root), filters and WaitForUpdatesEx, SearchIndex lookups, clone/create/
+power off/destroy/reconfigure/snapshot tasks and guest operations.
+"""
+
+import collections
+import copy
+import datetime
+import itertools
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+from pyVmomi import vim, vmodl, VmomiSupport
+from pyVmomi.Iso8601 import TZManager
+
+# Default seconds a simulated task runs
+TASK_LATENCY = 0.05
+
+# Default seconds added to every simulated SOAP call
+RTT = 0.001
+
+PC = vmodl.query.PropertyCollector
+
+_MISSING = object()
+
+
+def _typed(value):
+    # Property values travel as typed arrays, not plain lists
+    if isinstance(value, list) and not hasattr(type(value), 'Item'):
+        if value and isinstance(value[0], basestring):
+            return VmomiSupport.GetVmodlType('string[]')(value)
+        item = type(value[0]) if value else vmodl.ManagedObject
+        return item.Array(value)
+    return value
+
+
+class SimStub(object):
+    """pyVmomi stub adapter answering from a Simulator."""
+
+    def __init__(self, sim, rtt=RTT):
+        self.sim = sim
+        self.rtt = rtt
+        self.cookie = None
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, mo, name):
+        with self._lock:
+            self.calls['%s.%s' % (mo._wsdlName, name)] += 1
+        if self.rtt:
+            time.sleep(self.rtt)
+
+    def InvokeMethod(self, mo, info, args):
+        self._count(mo, info.wsdlName)
+        return self.sim.invoke(mo, info, args)
+
+    def InvokeAccessor(self, mo, info):
+        self._count(mo, info.name)
+        return self.sim.get(mo, info.name)
+
+    def round_trips(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+
+class _GuestFileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Accept guest file uploads and serve empty downloads
+
+    def do_PUT(self):
+        remaining = int(self.headers.get('Content-Length') or 0)
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 65536)))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class _GuestFileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class Simulator(object):
+    """In-memory vCenter inventory.
+
+    :param vms: Number of VMs created in the inventory (named vm-00001, ...)
+    :param datastores: Number of datastores
+    :param hosts: Number of hosts in the cluster
+    :param portgroups: Number of distributed portgroups (named vlan-1, ...)
+    :param datacenter: Datacenter name
+    :param cluster: Cluster name
+    :param template: Name of the template VM
+    :param task_latency: Seconds a task runs, or dict task name -> seconds
+    :param rtt: Seconds added to every SOAP call
+    :param power_on: Whether the generated VMs are powered on
+    :param task_slots: Number of tasks running at once, the next ones are queued
+    :param task_queue: Number of queued tasks beyond which new tasks fail with HostCommunication
+    """
+
+    def __init__(self, vms=10, datastores=4, hosts=4, portgroups=8, datacenter='MyDC',
+                 cluster='prod', template='Centos7-x86', task_latency=TASK_LATENCY, rtt=RTT,
+                 power_on=True, task_slots=None, task_queue=None):
+        self.stub = SimStub(self, rtt)
+        self.task_latency = task_latency
+        self.task_slots = task_slots
+        self.task_queue = task_queue
+        self._queued_tasks = collections.deque()
+        self._running_tasks = 0
+        self._objects = dict()
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._version = 0
+        self._tokens = dict()
+        self._events = []
+        self._event_collectors = set()
+        self._tasks = []
+        # Paths of the VMDKs made by the virtual disk manager
+        self._disks = set()
+        self._http = None
+
+        self.si = vim.ServiceInstance('ServiceInstance', self.stub)
+        self._register(self.si)
+
+        root = self._new(vim.Folder, 'group-d', name='Datacenters', childEntity=[],
+                         childType=['Folder', 'Datacenter'])
+        dc = self._new(vim.Datacenter, 'datacenter', name=datacenter, parent=root)
+        vm_folder = self._new(vim.Folder, 'group-v', name='vm', childEntity=[], parent=dc,
+                              childType=['Folder', 'VirtualMachine', 'VirtualApp'])
+        host_folder = self._new(vim.Folder, 'group-h', name='host', childEntity=[], parent=dc,
+                                childType=['Folder', 'ComputeResource'])
+        self.vm_folder = vm_folder
+        self._props(dc).update(vmFolder=vm_folder, hostFolder=host_folder)
+        self._props(root)['childEntity'].append(dc)
+
+        pool = self._new(vim.ResourcePool, 'resgroup', name='Resources')
+        # Hosts and datastores start with different loads
+        self.hosts = [self._new(vim.HostSystem, 'host', name='esx%02d' % i,
+                                runtime=vim.host.RuntimeInfo(connectionState='connected', inMaintenanceMode=False),
+                                summary=vim.host.Summary(
+                                    hardware=vim.host.Summary.HardwareSummary(
+                                        cpuMhz=2400, numCpuCores=32, memorySize=256 * 1024 ** 3),
+                                    quickStats=vim.host.Summary.QuickStats(
+                                        overallCpuUsage=2400 * (2 + 3 * i % 11),
+                                        overallMemoryUsage=1024 * (40 + 37 * i % 120))))
+                      for i in range(1, hosts + 1)]
+        self.datastores = [self._new(vim.Datastore, 'datastore', name='svc1_esx_poc-%d' % (55 + i),
+                                     summary=vim.Datastore.Summary(
+                                         name='svc1_esx_poc-%d' % (55 + i), type='VMFS', accessible=True,
+                                         maintenanceMode='normal', capacity=4 * 1024 ** 4,
+                                         freeSpace=(1 + 7 * i % 30) * 100 * 1024 ** 3,
+                                         uncommitted=(5 * i % 13) * 100 * 1024 ** 3))
+                           for i in range(datastores)]
+        for host in self.hosts:
+            self._props(host)['datastore'] = list(self.datastores)
+        cl = self._new(vim.ClusterComputeResource, 'domain-c', name=cluster,
+                       resourcePool=pool, host=list(self.hosts), datastore=list(self.datastores))
+        self._props(host_folder)['childEntity'].append(cl)
+
+        dvs = self._new(vim.dvs.VmwareDistributedVirtualSwitch, 'dvs', name='dvs0',
+                        uuid='50 00 00 00 00 00 00 00-00 00 00 00 00 00 00 01')
+        for i in range(1, portgroups + 1):
+            pg = self._new(vim.dvs.DistributedVirtualPortgroup, 'dvportgroup', name='vlan-%d' % i)
+            self._props(pg).update(key=pg._moId, config=vim.dvs.DistributedVirtualPortgroup.ConfigInfo(
+                key=pg._moId, name='vlan-%d' % i, distributedVirtualSwitch=dvs))
+
+        content = vim.ServiceInstanceContent(
+            rootFolder=root,
+            propertyCollector=self._new(PC, 'propertyCollector'),
+            viewManager=self._new(vim.view.ViewManager, 'ViewManager'),
+            searchIndex=self._new(vim.SearchIndex, 'SearchIndex'),
+            sessionManager=self._new(vim.SessionManager, 'SessionManager'),
+            virtualDiskManager=self._new(vim.VirtualDiskManager, 'virtualDiskManager'),
+            fileManager=self._new(vim.FileManager, 'FileManager'),
+            eventManager=self._new(vim.event.EventManager, 'EventManager'),
+            taskManager=self._new(vim.TaskManager, 'TaskManager'),
+            guestOperationsManager=self._new(vim.vm.guest.GuestOperationsManager, 'guestOperationsManager'))
+        guest_ops = content.guestOperationsManager
+        self._props(guest_ops).update(
+            fileManager=self._new(vim.vm.guest.FileManager, 'guestFileManager'),
+            processManager=self._new(vim.vm.guest.ProcessManager, 'guestProcessManager'))
+        self._props(content.propertyCollector).update(filters=[], cancel=False, reported=dict())
+        self._props(content.sessionManager)['currentSession'] = vim.UserSession(key='sim', userName='sim')
+        self._props(self.si)['content'] = content
+        self.content = content
+
+        self.template = self._create_vm(template, self.datastores[0], template=True)
+        for i in range(1, vms + 1):
+            self._create_vm('vm-%05d' % i, self.datastores[i % len(self.datastores)], power_on=power_on)
+
+    # Object store
+
+    def _register(self, mo, **props):
+        self._objects[mo._moId] = (mo, props)
+        return mo
+
+    def _new(self, vimtype, prefix, **props):
+        mo = vimtype('%s-%d' % (prefix, next(self._ids)), self.stub)
+        return self._register(mo, **props)
+
+    def _props(self, mo):
+        return self._objects[mo._moId][1]
+
+    def _exists(self, mo):
+        return mo._moId in self._objects
+
+    def _value(self, mo, path):
+        props = self._props(mo)
+        head, _, rest = path.partition('.')
+        value = props.get(head, _MISSING)
+        for part in rest.split('.') if rest else []:
+            if value is _MISSING or value is None:
+                return _MISSING
+            value = getattr(value, part)
+        if value is None:
+            return _MISSING
+        return value
+
+    def _touch(self):
+        # Wake up WaitForUpdatesEx callers after a change
+        with self._changed:
+            self._version += 1
+            self._changed.notify_all()
+
+    def get(self, mo, name):
+        with self._lock:
+            if not self._exists(mo):
+                raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+            value = self._value(mo, name)
+        return None if value is _MISSING else value
+
+    def invoke(self, mo, info, args):
+        handler = getattr(self, '_' + info.wsdlName, None)
+        if handler is None:
+            raise vmodl.fault.NotSupported(msg='%s not simulated' % info.wsdlName)
+        kwargs = dict((param.name, arg) for param, arg in zip(info.params, args))
+        with self._lock:
+            if not self._exists(mo):
+                raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        return handler(mo, **kwargs)
+
+    def vms(self):
+        with self._lock:
+            return [mo for mo, props in self._objects.values()
+                    if isinstance(mo, vim.VirtualMachine) and not props.get('template')]
+
+    def add_snapshots(self, vm, names):
+        """Give a VM a chain of snapshots without going through tasks."""
+        with self._lock:
+            props = self._props(vm)
+            trees = []
+            for name in names:
+                snap = self._new(vim.vm.Snapshot, 'snapshot', vm=vm)
+                tree = vim.vm.SnapshotTree(snapshot=snap, vm=vm, name=name, description='Snapshot from api',
+                                           id=next(self._ids), createTime=_now(), state='poweredOn',
+                                           quiesced=False, childSnapshotList=[])
+                self._props(snap)['tree'] = tree
+                if trees:
+                    trees[-1].childSnapshotList.append(tree)
+                trees.append(tree)
+            if trees:
+                props['snapshot'] = vim.vm.SnapshotInfo(currentSnapshot=trees[-1].snapshot,
+                                                        rootSnapshotList=[trees[0]])
+
+    # Inventory objects
+
+    def _create_vm(self, name, datastore, template=False, devices=None, cpus=1, mem=1024, power_on=False,
+                   folder=None):
+        controller = vim.vm.device.VirtualLsiLogicController(
+            key=1000, busNumber=0, device=[2000],
+            deviceInfo=vim.Description(label='SCSI controller 0', summary='LSI Logic'))
+        disk = vim.vm.device.VirtualDisk(
+            key=2000, controllerKey=1000, unitNumber=0, capacityInKB=16 * 1024 * 1024,
+            deviceInfo=vim.Description(label='Hard disk 1', summary='16 GB'),
+            backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+                fileName='[%s] %s/%s.vmdk' % (self._props(datastore)['name'], name, name), diskMode='persistent'))
+        if devices is None:
+            devices = [controller, disk]
+        config = vim.vm.ConfigInfo(name=name, template=template, hardware=vim.vm.VirtualHardware(
+            numCPU=cpus, memoryMB=mem, device=devices))
+        state = 'poweredOn' if power_on else 'poweredOff'
+        tools = 'guestToolsRunning' if power_on else 'guestToolsNotRunning'
+        summary = vim.vm.Summary(storage=vim.vm.Summary.StorageSummary(committed=16 * 1024 ** 3))
+        vm = self._new(vim.VirtualMachine, 'vm', name=name, template=template, config=config, summary=summary,
+                       datastore=[datastore], vmx='[%s] %s/%s.vmx' % (self._props(datastore)['name'], name, name),
+                       parent=folder or self.vm_folder,
+                       runtime=vim.vm.RuntimeInfo(powerState=state),
+                       guest=vim.vm.GuestInfo(hostName=name, toolsStatus='toolsOk' if power_on else 'toolsNotRunning',
+                                              toolsRunningStatus=tools, guestOperationsReady=power_on))
+        return vm
+
+    def _task(self, mo, name, work, latency_name=None):
+        """Create a task finishing after the task latency with work(), queued while task_slots are taken."""
+        latency = self.task_latency
+        if isinstance(latency, dict):
+            latency = latency.get(latency_name or name, latency.get('default', TASK_LATENCY))
+        with self._lock:
+            task = self._new(vim.Task, 'task')
+            # Tasks of managers (disk manager, ...) have no entity
+            entity = mo if isinstance(mo, vim.ManagedEntity) else None
+            info = vim.TaskInfo(key=task._moId, task=task, descriptionId=name, entity=entity,
+                                entityName=self._props(entity).get('name') if entity else None,
+                                reason=vim.TaskReasonUser(userName='sim'),
+                                state='queued', progress=0, queueTime=_now())
+            self._props(task)['info'] = info
+            self._tasks.append(task)
+            vm_arg = None
+            if isinstance(entity, vim.VirtualMachine):
+                vm_arg = vim.event.VmEventArgument(vm=entity, name=info.entityName)
+            self._post_event(vim.event.TaskEvent(key=next(self._ids), chainId=0, createdTime=info.queueTime,
+                                                 userName='sim', info=info, vm=vm_arg,
+                                                 fullFormattedMessage='Task: %s' % name))
+            if self.task_queue is not None and len(self._queued_tasks) >= self.task_queue:
+                info.error = vmodl.fault.HostCommunication(msg='Too many tasks queued')
+                info.state = 'error'
+                return task
+            self._queued_tasks.append((task, work, latency))
+            self._start_tasks()
+        return task
+
+    def _start_tasks(self):
+        # Called with the lock held
+        while self._queued_tasks and (self.task_slots is None or self._running_tasks < self.task_slots):
+            task, work, latency = self._queued_tasks.popleft()
+            self._running_tasks += 1
+            info = self._props(task)['info']
+            info.state = 'running'
+            info.startTime = _now()
+
+            def finish(task=task, work=work):
+                with self._lock:
+                    info = self._props(task)['info']
+                    try:
+                        info.result = work()
+                        info.state = 'success'
+                    except vmodl.MethodFault, error:
+                        info.error = error
+                        info.state = 'error'
+                    info.progress = 100
+                    info.completeTime = _now()
+                    self._running_tasks -= 1
+                    self._start_tasks()
+                self._touch()
+
+            timer = threading.Timer(latency, finish)
+            timer.daemon = True
+            timer.start()
+
+    # ServiceInstance / views / property collector
+
+    def _RetrieveServiceContent(self, mo):
+        return self.content
+
+    def _CreateContainerView(self, mo, container, type, recursive):
+        with self._lock:
+            return self._new(vim.view.ContainerView, 'session[sim]', types=tuple(type), container=container,
+                             recursive=recursive)
+
+    def _view(self, view):
+        # Container views follow objects created and destroyed after them
+        props = self._props(view)
+        return [obj for obj, obj_props in self._objects.values()
+                if isinstance(obj, props['types']) and 'name' in obj_props and
+                self._under(obj, props['container'], props['recursive'])]
+
+    def _under(self, obj, container, recursive):
+        # Only VMs, folders and datacenters have a parent, other objects are in every view
+        parent = self._props(obj).get('parent')
+        if parent is None or container._moId == self.content.rootFolder._moId:
+            return True
+        while parent is not None:
+            if parent._moId == container._moId:
+                return True
+            if not recursive or not self._exists(parent):
+                return False
+            parent = self._props(parent).get('parent')
+        return False
+
+    def _CreateFolder(self, mo, name):
+        with self._lock:
+            folder = self._new(vim.Folder, 'group-v', name=name, childEntity=[], parent=mo,
+                               childType=list(self._props(mo)['childType']))
+            self._props(mo)['childEntity'].append(folder)
+        self._touch()
+        return folder
+
+    def _DestroyView(self, mo):
+        with self._lock:
+            del self._objects[mo._moId]
+
+    def _objects_of(self, filter_spec):
+        objects = []
+        for obj_spec in filter_spec.objectSet:
+            if not obj_spec.skip:
+                objects.append(obj_spec.obj)
+            for select in obj_spec.selectSet or []:
+                if isinstance(obj_spec.obj, vim.view.ContainerView) and select.path == 'view':
+                    objects.extend(self._view(obj_spec.obj))
+                else:
+                    objects.extend(self._value(obj_spec.obj, select.path) or [])
+        return objects
+
+    def _content_of(self, obj, prop_specs):
+        prop_set = []
+        for prop_spec in prop_specs:
+            if not isinstance(obj, prop_spec.type):
+                continue
+            for path in prop_spec.pathSet:
+                value = self._value(obj, path)
+                if value is not _MISSING:
+                    prop_set.append(vmodl.DynamicProperty(name=path, val=_typed(value)))
+        return PC.ObjectContent(obj=obj, propSet=prop_set)
+
+    def _page(self, contents, size):
+        token = None
+        if size and len(contents) > size:
+            token = 'token-%d' % next(self._ids)
+            self._tokens[token] = (contents[size:], size)
+            contents = contents[:size]
+        return PC.RetrieveResult(objects=contents, token=token)
+
+    def _RetrievePropertiesEx(self, mo, specSet, options):
+        with self._lock:
+            contents = []
+            for filter_spec in specSet:
+                for obj in self._objects_of(filter_spec):
+                    if self._exists(obj):
+                        contents.append(self._content_of(obj, filter_spec.propSet))
+            if not contents:
+                return None
+            return self._page(contents, options.maxObjects if options else None)
+
+    def _ContinueRetrievePropertiesEx(self, mo, token):
+        with self._lock:
+            contents, size = self._tokens.pop(token)
+            return self._page(contents, size)
+
+    def _CreatePropertyCollector(self, mo):
+        with self._lock:
+            return self._new(PC, 'session[sim]', filters=[], cancel=False, reported=dict())
+
+    def _DestroyPropertyCollector(self, mo):
+        with self._lock:
+            for pc_filter in self._props(mo)['filters']:
+                self._objects.pop(pc_filter._moId, None)
+            del self._objects[mo._moId]
+        self._touch()
+
+    def _CreateFilter(self, mo, spec, partialUpdates):
+        with self._lock:
+            pc_filter = self._new(PC.Filter, 'session[sim]', spec=spec, collector=mo)
+            self._props(mo)['filters'].append(pc_filter)
+        self._touch()
+        return pc_filter
+
+    def _DestroyPropertyFilter(self, mo):
+        with self._lock:
+            collector = self._props(mo)['collector']
+            if self._exists(collector):
+                self._props(collector)['filters'].remove(mo)
+                self._props(collector)['reported'].pop(mo._moId, None)
+            del self._objects[mo._moId]
+
+    def _CancelWaitForUpdates(self, mo):
+        with self._changed:
+            self._props(mo)['cancel'] = True
+            self._changed.notify_all()
+
+    def _updates(self, collector):
+        # Changes of every filtered property since last report
+        props = self._props(collector)
+        filter_updates = []
+        for pc_filter in props['filters']:
+            # moId -> (object, property name -> repr of the value reported)
+            reported = props['reported'].setdefault(pc_filter._moId, dict())
+            spec = self._props(pc_filter)['spec']
+            obj_updates = []
+            current = set()
+            for obj in self._objects_of(spec):
+                if not self._exists(obj):
+                    continue
+                current.add(obj._moId)
+                kind = 'modify' if obj._moId in reported else 'enter'
+                values = reported.setdefault(obj._moId, (obj, dict()))[1]
+                changes = []
+                for prop in self._content_of(obj, spec.propSet).propSet:
+                    if values.get(prop.name) != repr(prop.val):
+                        values[prop.name] = repr(prop.val)
+                        changes.append(PC.Change(name=prop.name, op='assign', val=prop.val))
+                if changes or kind == 'enter':
+                    obj_updates.append(PC.ObjectUpdate(kind=kind, obj=obj, changeSet=changes))
+            for mo_id in set(reported) - current:
+                obj_updates.append(PC.ObjectUpdate(kind='leave', obj=reported.pop(mo_id)[0], changeSet=[]))
+            if obj_updates:
+                filter_updates.append(PC.FilterUpdate(filter=pc_filter, objectSet=obj_updates))
+        return filter_updates
+
+    def _WaitForUpdatesEx(self, mo, version, options):
+        max_wait = options.maxWaitSeconds if options and options.maxWaitSeconds is not None else None
+        deadline = None if max_wait is None else time.time() + max_wait
+        with self._changed:
+            while True:
+                props = self._props(mo)
+                if props['cancel']:
+                    props['cancel'] = False
+                    raise vmodl.fault.RequestCanceled()
+                filter_updates = self._updates(mo)
+                if filter_updates:
+                    return PC.UpdateSet(version=str(self._version), filterSet=filter_updates)
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._changed.wait(remaining if remaining is not None else 1)
+
+    # Search index
+
+    def _FindByDnsName(self, mo, datacenter, dnsName, vmSearch):
+        with self._lock:
+            for obj, props in self._objects.values():
+                if isinstance(obj, vim.VirtualMachine) and props['guest'].hostName == dnsName:
+                    return obj
+        return None
+
+    def _FindByDatastorePath(self, mo, datacenter, path):
+        with self._lock:
+            for obj, props in self._objects.values():
+                if isinstance(obj, vim.VirtualMachine) and props.get('vmx') == path:
+                    return obj
+        return None
+
+    def _FindChild(self, mo, entity, name):
+        with self._lock:
+            for obj, props in self._objects.values():
+                if props.get('name') == name and props.get('parent') is not None and \
+                        props['parent']._moId == entity._moId:
+                    return obj
+        return None
+
+    # Virtual machine tasks
+
+    def _apply_devices(self, vm, device_changes):
+        devices = self._props(vm)['config'].hardware.device
+        for change in device_changes or []:
+            device = change.device
+            if change.operation == 'add':
+                if device.key is None or device.key < 0:
+                    device.key = next(self._ids) + 10000
+                if device.deviceInfo is None:
+                    device.deviceInfo = vim.Description(label=device.__class__.__name__, summary='')
+                if isinstance(device, vim.vm.device.VirtualDisk):
+                    # Disks created along are named after the VM like vCenter does
+                    count = len([d for d in devices if isinstance(d, vim.vm.device.VirtualDisk)])
+                    device.deviceInfo.label = 'Hard disk %d' % (count + 1)
+                    if device.backing is not None and not device.backing.fileName:
+                        vmx = self._props(vm)['vmx']
+                        device.backing.fileName = '%s_%d.vmdk' % (vmx[:-len('.vmx')], count)
+                if isinstance(device, vim.vm.device.VirtualSCSIController):
+                    device.deviceInfo.label = 'SCSI controller %s' % (device.busNumber or 0)
+                    device.device = []
+                devices.append(device)
+                for controller in devices:
+                    if controller.key == device.controllerKey and isinstance(
+                            controller, vim.vm.device.VirtualController):
+                        controller.device.append(device.key)
+            elif change.operation == 'remove':
+                devices[:] = [d for d in devices if d.key != device.key]
+
+    def _duplicate(self, folder, name):
+        # Names are unique in a folder
+        for obj, props in self._objects.values():
+            if isinstance(obj, vim.VirtualMachine) and props['name'] == name and props['parent']._moId == folder._moId:
+                raise vim.fault.DuplicateName(name=name, object=obj)
+
+    def _CloneVM_Task(self, mo, folder, name, spec):
+        def work():
+            self._duplicate(folder, name)
+            source = self._props(mo)
+            datastore = spec.location.datastore or source['datastore'][0]
+            config = spec.config or vim.vm.ConfigSpec()
+            devices = copy.deepcopy(source['config'].hardware.device)
+            linked = spec.snapshot is not None and spec.location.diskMoveType == 'createNewChildDiskBacking'
+            disks = [d for d in devices if isinstance(d, vim.vm.device.VirtualDisk) and d.backing]
+            for position, disk in enumerate(disks):
+                # Full clones copy the disks, linked clones add a delta over them
+                parent = disk.backing if linked else None
+                disk.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+                    fileName='[%s] %s/%s%s.vmdk' % (self._props(datastore)['name'], name, name,
+                                                    '_%d' % position if position else ''),
+                    diskMode='persistent', parent=parent)
+            vm = self._create_vm(name, datastore, devices=devices, power_on=spec.powerOn,
+                                 cpus=config.numCPUs or 1, mem=config.memoryMB or 1024, folder=folder)
+            self._apply_devices(vm, config.deviceChange)
+            info = self._props(vm)['config']
+            info.cpuHotAddEnabled = bool(config.cpuHotAddEnabled)
+            info.memoryHotAddEnabled = bool(config.memoryHotAddEnabled)
+            if spec.customization is not None:
+                self._customize(vm, spec.customization)
+            return vm
+        return self._task(mo, 'CloneVM_Task', work)
+
+    def _customize(self, vm, spec):
+        # The guest applies the spec at first boot and reboots, tools are away meanwhile
+        guest = self._props(vm)['guest']
+        guest.toolsRunningStatus = 'guestToolsNotRunning'
+        guest.guestOperationsReady = False
+        latency = self.task_latency
+        if isinstance(latency, dict):
+            latency = latency.get('Customization', latency.get('default', TASK_LATENCY))
+
+        def finish():
+            with self._lock:
+                if not self._exists(vm):
+                    return
+                guest.hostName = spec.identity.hostName.name
+                fixed = [m.adapter.ip for m in spec.nicSettingMap or []
+                         if isinstance(m.adapter.ip, vim.vm.customization.FixedIp)]
+                guest.ipAddress = fixed[0].ipAddress if fixed else None
+                guest.toolsRunningStatus = 'guestToolsRunning'
+                guest.guestOperationsReady = True
+                self._post_event(vim.event.CustomizationSucceeded(
+                    key=next(self._ids), chainId=0, createdTime=_now(), userName='sim',
+                    vm=vim.event.VmEventArgument(vm=vm, name=self._props(vm)['name'])))
+            self._touch()
+
+        timer = threading.Timer(latency, finish)
+        timer.daemon = True
+        timer.start()
+
+    def _CreateVM_Task(self, mo, config, pool, host):
+        def work():
+            self._duplicate(mo, config.name)
+            path = config.files.vmPathName
+            ds_name = path[1:path.index(']')]
+            datastore = [d for d in self.datastores if self._props(d)['name'] == ds_name][0]
+            vm = self._create_vm(config.name, datastore, devices=[], cpus=config.numCPUs or 1,
+                                 mem=config.memoryMB or 1024, folder=mo)
+            self._apply_devices(vm, config.deviceChange)
+            return vm
+        return self._task(mo, 'CreateVM_Task', work)
+
+    def _ReconfigVM_Task(self, mo, spec):
+        def work():
+            hardware = self._props(mo)['config'].hardware
+            hardware.numCPU = spec.numCPUs or hardware.numCPU
+            hardware.memoryMB = spec.memoryMB or hardware.memoryMB
+            self._apply_devices(mo, spec.deviceChange)
+        return self._task(mo, 'ReconfigVM_Task', work)
+
+    def _PowerOffVM_Task(self, mo):
+        def work():
+            props = self._props(mo)
+            if props['runtime'].powerState != 'poweredOn':
+                raise vim.fault.InvalidPowerState(existingState=props['runtime'].powerState,
+                                                  requestedState='poweredOff')
+            props['runtime'].powerState = 'poweredOff'
+            props['guest'].toolsRunningStatus = 'guestToolsNotRunning'
+            props['guest'].guestOperationsReady = False
+        return self._task(mo, 'PowerOffVM_Task', work)
+
+    def _Destroy_Task(self, mo):
+        def work():
+            if self._props(mo)['runtime'].powerState == 'poweredOn':
+                raise vim.fault.InvalidPowerState(existingState='poweredOn', requestedState='poweredOff')
+            # Files of the VM directory go with it
+            directory = self._props(mo)['vmx'].rsplit('/', 1)[0] + '/'
+            self._disks = set(disk for disk in self._disks if not disk.startswith(directory))
+            del self._objects[mo._moId]
+        return self._task(mo, 'Destroy_Task', work)
+
+    def _CreateVirtualDisk_Task(self, mo, name, datacenter, spec):
+        def work():
+            if name in self._disks:
+                raise vim.fault.FileAlreadyExists(file=name)
+            self._disks.add(name)
+            return name
+        return self._task(mo, 'CreateVirtualDisk_Task', work)
+
+    def _QueryVirtualDiskUuid(self, mo, name, datacenter):
+        if name not in self._disks:
+            raise vim.fault.FileNotFound(file=name)
+        return '60 00 c2 9f %08x' % (hash(name) & 0xffffffff)
+
+    def _MakeDirectory(self, mo, name, datacenter, createParentDirectories):
+        # Datastore files are not simulated
+        return None
+
+    def _CreateSnapshot_Task(self, mo, name, description, memory, quiesce):
+        def work():
+            props = self._props(mo)
+            if props.get('template'):
+                raise vim.fault.NotSupported(msg='Templates can not be snapshotted')
+            snap = self._new(vim.vm.Snapshot, 'snapshot', vm=mo)
+            tree = vim.vm.SnapshotTree(snapshot=snap, vm=mo, name=name, description=description,
+                                       id=next(self._ids), createTime=_now(),
+                                       state=props['runtime'].powerState, quiesced=quiesce,
+                                       childSnapshotList=[])
+            self._props(snap)['tree'] = tree
+            info = props.get('snapshot')
+            if info is None:
+                props['snapshot'] = vim.vm.SnapshotInfo(currentSnapshot=snap, rootSnapshotList=[tree])
+            else:
+                parent = self._props(info.currentSnapshot)['tree']
+                parent.childSnapshotList.append(tree)
+                info.currentSnapshot = snap
+            return snap
+        return self._task(mo, 'CreateSnapshot_Task', work)
+
+    def _RemoveSnapshot_Task(self, mo, removeChildren, consolidate):
+        vm = self._props(mo)['vm']
+
+        def work():
+            props = self._props(vm)
+            info = props['snapshot']
+            tree = self._props(mo)['tree']
+
+            def detach(trees):
+                for position, node in enumerate(trees):
+                    if node is tree:
+                        kept = [] if removeChildren else list(node.childSnapshotList)
+                        trees[position:position + 1] = kept
+                        return True
+                    if detach(node.childSnapshotList):
+                        return True
+                return False
+
+            detach(info.rootSnapshotList)
+            del self._objects[mo._moId]
+            if not info.rootSnapshotList:
+                del props['snapshot']
+            elif not self._exists(info.currentSnapshot):
+                info.currentSnapshot = info.rootSnapshotList[-1].snapshot
+        return self._task(vm, 'RemoveSnapshot_Task', work)
+
+    def _ConsolidateVMDisks_Task(self, mo):
+        return self._task(mo, 'ConsolidateVMDisks_Task', lambda: None)
+
+    # Events
+
+    def _history_matches(self, history_filter, entity, time, user):
+        # Entities below a folder or datacenter are not tracked, they all match
+        if history_filter.entity is not None and isinstance(history_filter.entity.entity, vim.VirtualMachine):
+            if entity is None or entity._moId != history_filter.entity.entity._moId:
+                return False
+        if history_filter.time is not None:
+            if history_filter.time.beginTime is not None and (time is None or time < history_filter.time.beginTime):
+                return False
+            if history_filter.time.endTime is not None and (time is None or time > history_filter.time.endTime):
+                return False
+        if history_filter.userName is not None and history_filter.userName.userList:
+            return user in history_filter.userName.userList
+        return True
+
+    def _event_matches(self, event_filter, event):
+        if event_filter.eventTypeId and event._wsdlName not in event_filter.eventTypeId:
+            return False
+        return self._history_matches(event_filter, event.vm.vm if event.vm is not None else None,
+                                     event.createdTime, event.userName)
+
+    def _post_event(self, event):
+        self._events.append(event)
+        for moid in self._event_collectors:
+            props = self._objects[moid][1]
+            if self._event_matches(props['filter'], event):
+                props['latestPage'] = vim.event.Event.Array(list(props['latestPage']) + [event])
+
+    def _CreateCollectorForEvents(self, mo, filter):
+        with self._lock:
+            collector = self._new(vim.event.EventHistoryCollector, 'session[sim]', filter=filter, position=0,
+                                  latestPage=vim.event.Event.Array(
+                                      [e for e in self._events if self._event_matches(filter, e)]))
+            self._event_collectors.add(collector._moId)
+            return collector
+
+    def _task_matches(self, task_filter, info):
+        if task_filter.state and info.state not in task_filter.state:
+            return False
+        time = None
+        if task_filter.time is not None:
+            time = dict(queuedTime=info.queueTime, startedTime=info.startTime,
+                        completedTime=info.completeTime)[task_filter.time.timeType]
+        return self._history_matches(task_filter, info.entity, time, info.reason.userName)
+
+    def _CreateCollectorForTasks(self, mo, filter):
+        with self._lock:
+            return self._new(vim.TaskHistoryCollector, 'session[sim]', filter=filter, position=0)
+
+    def _history(self, collector):
+        props = self._props(collector)
+        if isinstance(collector, vim.event.EventHistoryCollector):
+            return [e for e in self._events if self._event_matches(props['filter'], e)]
+        infos = [self._props(task)['info'] for task in self._tasks]
+        return [info for info in infos if self._task_matches(props['filter'], info)]
+
+    def _read_next(self, collector, maxCount):
+        with self._lock:
+            props = self._props(collector)
+            page = self._history(collector)[props['position']:props['position'] + maxCount]
+            props['position'] += len(page)
+            return page
+
+    def _ReadNextEvents(self, mo, maxCount):
+        return vim.event.Event.Array(self._read_next(mo, maxCount))
+
+    def _ReadNextTasks(self, mo, maxCount):
+        return vim.TaskInfo.Array(self._read_next(mo, maxCount))
+
+    def _RewindCollector(self, mo):
+        with self._lock:
+            self._props(mo)['position'] = 0
+
+    def _DestroyCollector(self, mo):
+        with self._lock:
+            self._event_collectors.discard(mo._moId)
+            del self._objects[mo._moId]
+
+    # Guest operations
+
+    def _guest_url(self):
+        with self._lock:
+            if self._http is None:
+                self._http = _GuestFileServer(('127.0.0.1', 0), _GuestFileHandler)
+                thread = threading.Thread(target=self._http.serve_forever)
+                thread.daemon = True
+                thread.start()
+            return 'http://127.0.0.1:%d/guestFile' % self._http.server_address[1]
+
+    def _check_guest(self, vm):
+        if not self._props(vm)['guest'].guestOperationsReady:
+            raise vim.fault.GuestOperationsUnavailable()
+
+    def _InitiateFileTransferToGuest(self, mo, vm, auth, guestFilePath, fileAttributes, fileSize, overwrite):
+        self._check_guest(vm)
+        return self._guest_url()
+
+    def _InitiateFileTransferFromGuest(self, mo, vm, auth, guestFilePath):
+        self._check_guest(vm)
+        return vim.vm.guest.FileManager.FileTransferInformation(size=0, url=self._guest_url())
+
+    def _StartProgramInGuest(self, mo, vm, auth, spec):
+        self._check_guest(vm)
+        with self._lock:
+            pid = next(self._ids)
+            latency = self.task_latency
+            if isinstance(latency, dict):
+                latency = latency.get('StartProgramInGuest', latency.get('default', TASK_LATENCY))
+            self._props(vm).setdefault('processes', dict())[pid] = (spec, time.time() + latency)
+        return pid
+
+    def _ListProcessesInGuest(self, mo, vm, auth, pids):
+        self._check_guest(vm)
+        result = []
+        with self._lock:
+            for pid, (spec, end) in self._props(vm).get('processes', dict()).items():
+                if pids and pid not in pids:
+                    continue
+                done = time.time() >= end
+                result.append(vim.vm.guest.ProcessManager.ProcessInfo(
+                    pid=pid, name=spec.programPath, cmdLine=spec.arguments, owner=auth.username,
+                    startTime=_now(), endTime=_now() if done else None, exitCode=0 if done else None))
+        return result
+
+
+def _now():
+    return datetime.datetime.now(TZManager.GetTZInfo())
@@ -0,0 +1,29 @@
+#!/usr/bin/bash
+
+# Post boot script of VMs configured by a customization spec
+# (create_clone.py --customization spec): hostname, IPs, gateway
+# and DNS are already set, only the salt agent is installed here
+
+logfile="/var/log/bootstrap.log"
+salt_master="mysalt-master.local"
+salt_minion_config_file="/etc/salt/minion"
+
+# Definition du package salt
+salt_pkg="salt-minion"
+
+# Export du proxy
+export HTTP_PROXY=proxy.local:8080
+export HTTPS_PROXY=proxy.local:8080
+
+# Installation SALT agent
+echo "Installation salt minion"  >>$logfile
+yum install -y --nogpgcheck $salt_pkg
+status=$?
+echo "status de l'installation : $status" >>$logfile
+if [ $status -ne 0 ]
+        then
+                exit $status
+fi
+echo "master: $salt_master" >> $salt_minion_config_file
+systemctl enable salt-minion
+systemctl start salt-minion